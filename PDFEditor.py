@@ -1,13 +1,28 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
+import tkinter.font as tkfont
 import fitz
-from PIL import Image, ImageTk
+from PIL import Image, ImageChops, ImageTk
 import io
 import math 
 import os
 import sys 
 import re 
-from typing import Optional, List, Set, Dict, Union
+import hashlib
+import zlib
+import mmap
+import tempfile
+import csv
+from array import array
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import time
+from collections import OrderedDict
+import weakref
+from contextlib import contextmanager
+from typing import Optional, List, Set, Dict, Tuple, Union
 from datetime import date, datetime 
 import pypdf
 from pypdf import PdfReader, PdfWriter, Transformation
@@ -283,7 +298,72 @@ def add_watermark_to_pdf(pdf_bytes):
     output_buffer = io.BytesIO()
     writer.write(output_buffer)
     return output_buffer.getvalue()
-  
+
+
+# Miniatury stron zapisywane w pliku (/Thumb) - małe obrazy JPEG
+EMBEDDED_THUMB_MAX_SIZE = 200
+EMBEDDED_THUMB_JPEG_QUALITY = 70
+
+
+def embed_page_thumbnails(pdf_bytes, thumbnails):
+    """
+    Zapisuje miniatury stron jako obrazy /Thumb w słownikach stron PDF.
+
+    thumbnails: słownik {indeks strony: obraz PIL}. Obrazy są zmniejszane do
+    EMBEDDED_THUMB_MAX_SIZE (dłuższy bok) i kodowane jako JPEG (/DCTDecode);
+    wcześniejsze /Thumb tych stron są zastępowane. Zwraca bajty nowego PDF.
+    """
+    doc = fitz.open("pdf", pdf_bytes)
+    try:
+        for page_index, image in thumbnails.items():
+            if not 0 <= page_index < len(doc):
+                continue
+            image = image.convert("RGB")
+            image.thumbnail((EMBEDDED_THUMB_MAX_SIZE, EMBEDDED_THUMB_MAX_SIZE), Image.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=EMBEDDED_THUMB_JPEG_QUALITY, optimize=True)
+            xref = doc.get_new_xref()
+            doc.update_object(xref, f"<< /Width {image.width} /Height {image.height} "
+                                    f"/ColorSpace /DeviceRGB /BitsPerComponent 8 >>")
+            doc.update_stream(xref, buffer.getvalue(), compress=0)
+            doc.xref_set_key(xref, "Filter", "/DCTDecode")
+            doc.xref_set_key(doc.page_xref(page_index), "Thumb", f"{xref} 0 R")
+        # garbage=1 usuwa zastąpione, nieużywane już obrazy /Thumb
+        return doc.tobytes(garbage=1)
+    finally:
+        doc.close()
+
+
+def read_embedded_thumbnail(doc, page_index):
+    """
+    Zwraca obraz /Thumb strony jako obraz PIL RGB albo None (brak lub nieobsługiwany obraz).
+    Obsługiwane są miniatury JPEG (/DCTDecode) i 8-bitowe próbki DeviceRGB/DeviceGray
+    (strumień /Thumb nie ma /Subtype /Image, więc MuPDF nie wyodrębni go jako obrazu).
+    Miniatura jest ustawiana w orientacji strony po obrocie, jeśli zapisano ją bez obrotu.
+    """
+    try:
+        page_xref = doc.page_xref(page_index)
+        kind, value = doc.xref_get_key(page_xref, "Thumb")
+        if kind != "xref":
+            return None
+        xref = int(value.split()[0])
+        if doc.xref_get_key(xref, "Filter")[1] == "/DCTDecode":
+            image = Image.open(io.BytesIO(doc.xref_stream_raw(xref)))
+        else:
+            mode = {"/DeviceRGB": "RGB", "/DeviceGray": "L"}.get(doc.xref_get_key(xref, "ColorSpace")[1])
+            if mode is None or doc.xref_get_key(xref, "BitsPerComponent")[1] != "8":
+                return None
+            size = (int(doc.xref_get_key(xref, "Width")[1]), int(doc.xref_get_key(xref, "Height")[1]))
+            image = Image.frombytes(mode, size, doc.xref_stream(xref))
+        image = image.convert("RGB")
+    except Exception:
+        return None
+    page = doc.load_page(page_index)
+    rect = page.rect
+    if page.rotation in (90, 270) and (image.width > image.height) != (rect.width > rect.height):
+        image = image.transpose(Image.ROTATE_270 if page.rotation == 90 else Image.ROTATE_90)
+    return image
+
 import tkinter as tk
 from tkinter import ttk, messagebox
 
@@ -476,6 +556,25 @@ class PreferencesManager:
             
             # Ghostscript settings
             'ghostscript_path': '',
+            
+            # Miniatury
+            'thumbnail_render_workers': '2',  # Liczba wątków renderujących miniatury w tle
+            'thumbnail_cache_mb': '256',      # Budżet pamięci cache miniatur (MB)
+            'thumbnail_disk_cache_mb': '512', # Limit cache miniatur na dysku (MB, 0 = wyłączony)
+            'thumbnail_progressive': 'True',  # Szybki podgląd w niskiej rozdzielczości przed ostrą miniaturą
+            'thumbnail_grid_mode': 'frames',  # Siatka miniatur: 'frames' (widgety) lub 'canvas' (elementy canvasu)
+            'displaylist_cache_mb': '128',    # Budżet cache sparsowanych stron (fitz.DisplayList, MB)
+            'thumbnail_aa_level': '8',        # Antyaliasing miniatur (0-8, mniej = szybciej)
+            'thumbnail_annots': 'True',       # Renderowanie adnotacji na miniaturach
+            'thumbnail_gray_while_scrolling': 'False',  # Szkice w skali szarości w trakcie przewijania
+            'thumbnail_render_budget_ms': '3000',  # Budżet czasu renderu miniatury (ms, 0 = bez limitu)
+            'thumbnail_render_backend': 'threads',  # Render miniatur: 'threads' (wątki) lub 'processes' (procesy)
+            'thumbnail_embed_on_save': 'False',  # Zapis miniatur stron (/Thumb) w pliku PDF
+            
+            # Historia zmian
+            'undo_memory_mb': '512',  # Budżet pamięci historii cofnij/ponów (MB, nadmiar trafia na dysk)
+            'undo_backend': 'pages',  # Cofanie edycji w miejscu: 'pages' (kopie stron) lub 'journal' (dziennik MuPDF)
+            'session_journal': 'True',  # Dziennik sesji na dysku - odzyskiwanie pracy po awarii programu
         }
         self.load_preferences()
     
@@ -544,6 +643,19 @@ class PreferencesManager:
 class PreferencesDialog(tk.Toplevel):
     """Okno dialogowe preferencji programu"""
     
+    GRID_MODES = {
+        'frames': "Ramki (widgety)",
+        'canvas': "Elementy canvasu",
+    }
+    RENDER_BACKENDS = {
+        'threads': "Wątki",
+        'processes': "Procesy (izolowane)",
+    }
+    UNDO_BACKENDS = {
+        'pages': "Kopie stron",
+        'journal': "Dziennik MuPDF",
+    }
+    
     def __init__(self, parent, prefs_manager):
         super().__init__(parent)
         self.parent = parent
@@ -622,7 +734,7 @@ class PreferencesDialog(tk.Toplevel):
         samples_entry.grid(row=1, column=1, sticky="w", padx=4, pady=4)
         ttk.Label(color_detect_frame, text="(10-1000, domyślnie 300)", foreground="gray").grid(row=1, column=2, sticky="w", padx=4, pady=4)
         
-        # Skala renderowania
+        # Skala renderowania (strony bez miniatury - pozostałe korzystają z wyniku renderu miniatury)
         ttk.Label(color_detect_frame, text="Skala renderowania:").grid(row=2, column=0, sticky="w", padx=4, pady=4)
         self.color_scale_var = tk.StringVar()
         scale_entry = ttk.Entry(color_detect_frame, textvariable=self.color_scale_var, width=10)
@@ -666,6 +778,107 @@ class PreferencesDialog(tk.Toplevel):
         
         ghostscript_frame.columnconfigure(1, weight=1)
         
+        # Sekcja Miniatury
+        thumbnails_frame = ttk.LabelFrame(main_frame, text="Miniatury", padding="8")
+        thumbnails_frame.pack(fill="x", pady=(0, 8))
+        
+        # Liczba wątków renderujących
+        ttk.Label(thumbnails_frame, text="Wątki renderujące:").grid(row=0, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_workers_var = tk.StringVar()
+        ttk.Entry(thumbnails_frame, textvariable=self.thumbnail_workers_var, width=10).grid(row=0, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(thumbnails_frame, text="(1-8, po ponownym uruchomieniu)", foreground="gray").grid(row=0, column=2, sticky="w", padx=4, pady=4)
+        
+        # Budżet pamięci cache miniatur
+        ttk.Label(thumbnails_frame, text="Pamięć cache (MB):").grid(row=1, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_cache_mb_var = tk.StringVar()
+        ttk.Entry(thumbnails_frame, textvariable=self.thumbnail_cache_mb_var, width=10).grid(row=1, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(thumbnails_frame, text="(16-4096, po ponownym uruchomieniu)", foreground="gray").grid(row=1, column=2, sticky="w", padx=4, pady=4)
+        
+        # Limit cache miniatur na dysku
+        ttk.Label(thumbnails_frame, text="Cache na dysku (MB):").grid(row=2, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_disk_cache_mb_var = tk.StringVar()
+        ttk.Entry(thumbnails_frame, textvariable=self.thumbnail_disk_cache_mb_var, width=10).grid(row=2, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(thumbnails_frame, text="(0 = wyłączony, maks. 65536, po ponownym uruchomieniu)", foreground="gray").grid(row=2, column=2, sticky="w", padx=4, pady=4)
+        
+        # Renderowanie progresywne
+        ttk.Label(thumbnails_frame, text="Szybki podgląd przed ostrą miniaturą:").grid(row=3, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_progressive_var = tk.BooleanVar()
+        progressive_check = ttk.Checkbutton(thumbnails_frame, variable=self.thumbnail_progressive_var)
+        progressive_check.grid(row=3, column=1, sticky="w", padx=4, pady=4)
+        
+        # Tryb siatki miniatur
+        ttk.Label(thumbnails_frame, text="Siatka miniatur:").grid(row=4, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_grid_mode_var = tk.StringVar()
+        ttk.Combobox(thumbnails_frame, textvariable=self.thumbnail_grid_mode_var, values=list(self.GRID_MODES.values()),
+                     state="readonly", width=18).grid(row=4, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(thumbnails_frame, text="(po ponownym uruchomieniu)", foreground="gray").grid(row=4, column=2, sticky="w", padx=4, pady=4)
+        
+        # Budżet cache sparsowanych stron
+        ttk.Label(thumbnails_frame, text="Pamięć sparsowanych stron (MB):").grid(row=5, column=0, sticky="w", padx=4, pady=4)
+        self.displaylist_cache_mb_var = tk.StringVar()
+        ttk.Entry(thumbnails_frame, textvariable=self.displaylist_cache_mb_var, width=10).grid(row=5, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(thumbnails_frame, text="(8-4096, po ponownym uruchomieniu)", foreground="gray").grid(row=5, column=2, sticky="w", padx=4, pady=4)
+        
+        # Polityka jakości renderowania miniatur
+        ttk.Label(thumbnails_frame, text="Antyaliasing miniatur:").grid(row=6, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_aa_level_var = tk.StringVar()
+        ttk.Entry(thumbnails_frame, textvariable=self.thumbnail_aa_level_var, width=10).grid(row=6, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(thumbnails_frame, text="(0-8, mniej = szybciej; podgląd i eksport zawsze 8)", foreground="gray").grid(row=6, column=2, sticky="w", padx=4, pady=4)
+        
+        ttk.Label(thumbnails_frame, text="Adnotacje na miniaturach:").grid(row=7, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_annots_var = tk.BooleanVar()
+        ttk.Checkbutton(thumbnails_frame, variable=self.thumbnail_annots_var).grid(row=7, column=1, sticky="w", padx=4, pady=4)
+        
+        ttk.Label(thumbnails_frame, text="Szare szkice podczas przewijania:").grid(row=8, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_gray_scroll_var = tk.BooleanVar()
+        ttk.Checkbutton(thumbnails_frame, variable=self.thumbnail_gray_scroll_var).grid(row=8, column=1, sticky="w", padx=4, pady=4)
+        
+        # Budżet czasu renderu (strony zbyt złożone dostają placeholder z renderem na żądanie)
+        ttk.Label(thumbnails_frame, text="Limit czasu renderu strony (ms):").grid(row=9, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_render_budget_var = tk.StringVar()
+        ttk.Entry(thumbnails_frame, textvariable=self.thumbnail_render_budget_var, width=10).grid(row=9, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(thumbnails_frame, text="(0 = bez limitu, maks. 600000)", foreground="gray").grid(row=9, column=2, sticky="w", padx=4, pady=4)
+        
+        # Backend renderowania: wątki albo izolowane procesy (skalują się na wiele rdzeni)
+        ttk.Label(thumbnails_frame, text="Renderowanie w:").grid(row=10, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_render_backend_var = tk.StringVar()
+        ttk.Combobox(thumbnails_frame, textvariable=self.thumbnail_render_backend_var, values=list(self.RENDER_BACKENDS.values()),
+                     state="readonly", width=18).grid(row=10, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(thumbnails_frame, text="(po ponownym uruchomieniu)", foreground="gray").grid(row=10, column=2, sticky="w", padx=4, pady=4)
+        
+        # Miniatury w pliku (/Thumb) - zapisany plik otwiera się od razu z podglądami stron
+        ttk.Label(thumbnails_frame, text="Zapisuj miniatury w pliku PDF:").grid(row=11, column=0, sticky="w", padx=4, pady=4)
+        self.thumbnail_embed_var = tk.BooleanVar()
+        ttk.Checkbutton(thumbnails_frame, variable=self.thumbnail_embed_var).grid(row=11, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(thumbnails_frame, text="(/Thumb, ok. kilka KB na stronę)", foreground="gray").grid(row=11, column=2, sticky="w", padx=4, pady=4)
+        
+        thumbnails_frame.columnconfigure(2, weight=1)
+        
+        # Sekcja Historia zmian
+        history_frame = ttk.LabelFrame(main_frame, text="Historia zmian", padding="8")
+        history_frame.pack(fill="x", pady=(0, 8))
+        
+        # Budżet pamięci historii cofnij/ponów - starsze stany są pakowane i zrzucane na dysk
+        ttk.Label(history_frame, text="Pamięć historii cofnij (MB):").grid(row=0, column=0, sticky="w", padx=4, pady=4)
+        self.undo_memory_mb_var = tk.StringVar()
+        ttk.Entry(history_frame, textvariable=self.undo_memory_mb_var, width=10).grid(row=0, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(history_frame, text="(16-65536, nadmiar w plikach tymczasowych)", foreground="gray").grid(row=0, column=2, sticky="w", padx=4, pady=4)
+        
+        # Cofanie obrotów i usuwania numerów stron: kopie stron albo dziennik MuPDF (bez ponownego otwierania dokumentu)
+        ttk.Label(history_frame, text="Cofanie edycji w miejscu:").grid(row=1, column=0, sticky="w", padx=4, pady=4)
+        self.undo_backend_var = tk.StringVar()
+        ttk.Combobox(history_frame, textvariable=self.undo_backend_var, values=list(self.UNDO_BACKENDS.values()),
+                     state="readonly", width=18).grid(row=1, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(history_frame, text="(obroty, usuwanie numerów stron)", foreground="gray").grid(row=1, column=2, sticky="w", padx=4, pady=4)
+        
+        # Dziennik sesji - zmiany dopisywane na dysk na bieżąco, odtwarzane po awarii programu
+        ttk.Label(history_frame, text="Odzyskiwanie po awarii:").grid(row=2, column=0, sticky="w", padx=4, pady=4)
+        self.session_journal_var = tk.BooleanVar()
+        ttk.Checkbutton(history_frame, variable=self.session_journal_var).grid(row=2, column=1, sticky="w", padx=4, pady=4)
+        ttk.Label(history_frame, text="(dziennik zmian na dysku, od następnego otwarcia pliku)", foreground="gray").grid(row=2, column=2, sticky="w", padx=4, pady=4)
+        
+        history_frame.columnconfigure(2, weight=1)
+        
         # Informacja
        # info_frame = ttk.Frame(main_frame)
        # info_frame.pack(fill="x", pady=8)
@@ -720,6 +933,24 @@ class PreferencesDialog(tk.Toplevel):
         self.watermark_on_save_var.set(self.prefs_manager.get('watermark_on_save') == 'True')
         self.watermark_on_save_restricted_var.set(self.prefs_manager.get('watermark_on_save_restricted') == 'True')
         self.ghostscript_path_var.set(self.prefs_manager.get('ghostscript_path'))
+        self.thumbnail_workers_var.set(self.prefs_manager.get('thumbnail_render_workers'))
+        self.thumbnail_cache_mb_var.set(self.prefs_manager.get('thumbnail_cache_mb'))
+        self.thumbnail_disk_cache_mb_var.set(self.prefs_manager.get('thumbnail_disk_cache_mb'))
+        self.thumbnail_progressive_var.set(self.prefs_manager.get('thumbnail_progressive') == 'True')
+        grid_mode = self.prefs_manager.get('thumbnail_grid_mode')
+        self.thumbnail_grid_mode_var.set(self.GRID_MODES.get(grid_mode, self.GRID_MODES['frames']))
+        self.displaylist_cache_mb_var.set(self.prefs_manager.get('displaylist_cache_mb'))
+        self.thumbnail_aa_level_var.set(self.prefs_manager.get('thumbnail_aa_level'))
+        self.thumbnail_annots_var.set(self.prefs_manager.get('thumbnail_annots') == 'True')
+        self.thumbnail_gray_scroll_var.set(self.prefs_manager.get('thumbnail_gray_while_scrolling') == 'True')
+        self.thumbnail_render_budget_var.set(self.prefs_manager.get('thumbnail_render_budget_ms'))
+        self.undo_memory_mb_var.set(self.prefs_manager.get('undo_memory_mb'))
+        undo_backend = self.prefs_manager.get('undo_backend')
+        self.undo_backend_var.set(self.UNDO_BACKENDS.get(undo_backend, self.UNDO_BACKENDS['pages']))
+        self.session_journal_var.set(self.prefs_manager.get('session_journal') == 'True')
+        render_backend = self.prefs_manager.get('thumbnail_render_backend')
+        self.thumbnail_render_backend_var.set(self.RENDER_BACKENDS.get(render_backend, self.RENDER_BACKENDS['threads']))
+        self.thumbnail_embed_var.set(self.prefs_manager.get('thumbnail_embed_on_save') == 'True')
     
     def reset_all_defaults(self):
         """Przywraca domyślne wartości we wszystkich dialogach"""
@@ -776,6 +1007,69 @@ class PreferencesDialog(tk.Toplevel):
             custom_messagebox(self, "Błąd", "Skala renderowania musi być liczbą.", typ="error")
             return
         
+        try:
+            thumbnail_workers = int(self.thumbnail_workers_var.get())
+            if thumbnail_workers < 1 or thumbnail_workers > 8:
+                custom_messagebox(self, "Błąd", "Liczba wątków renderujących musi być z zakresu 1-8.", typ="error")
+                return
+        except ValueError:
+            custom_messagebox(self, "Błąd", "Liczba wątków renderujących musi być liczbą całkowitą.", typ="error")
+            return
+        
+        try:
+            thumbnail_cache_mb = int(self.thumbnail_cache_mb_var.get())
+            if thumbnail_cache_mb < 16 or thumbnail_cache_mb > 4096:
+                custom_messagebox(self, "Błąd", "Pamięć cache miniatur musi być z zakresu 16-4096 MB.", typ="error")
+                return
+        except ValueError:
+            custom_messagebox(self, "Błąd", "Pamięć cache miniatur musi być liczbą całkowitą.", typ="error")
+            return
+        
+        try:
+            thumbnail_disk_cache_mb = int(self.thumbnail_disk_cache_mb_var.get())
+            if thumbnail_disk_cache_mb < 0 or thumbnail_disk_cache_mb > 65536:
+                custom_messagebox(self, "Błąd", "Limit cache miniatur na dysku musi być z zakresu 0-65536 MB.", typ="error")
+                return
+        except ValueError:
+            custom_messagebox(self, "Błąd", "Limit cache miniatur na dysku musi być liczbą całkowitą.", typ="error")
+            return
+        
+        try:
+            displaylist_cache_mb = int(self.displaylist_cache_mb_var.get())
+            if displaylist_cache_mb < 8 or displaylist_cache_mb > 4096:
+                custom_messagebox(self, "Błąd", "Pamięć sparsowanych stron musi być z zakresu 8-4096 MB.", typ="error")
+                return
+        except ValueError:
+            custom_messagebox(self, "Błąd", "Pamięć sparsowanych stron musi być liczbą całkowitą.", typ="error")
+            return
+        
+        try:
+            thumbnail_aa_level = int(self.thumbnail_aa_level_var.get())
+            if thumbnail_aa_level < 0 or thumbnail_aa_level > 8:
+                custom_messagebox(self, "Błąd", "Antyaliasing miniatur musi być z zakresu 0-8.", typ="error")
+                return
+        except ValueError:
+            custom_messagebox(self, "Błąd", "Antyaliasing miniatur musi być liczbą całkowitą.", typ="error")
+            return
+        
+        try:
+            thumbnail_render_budget = int(self.thumbnail_render_budget_var.get())
+            if thumbnail_render_budget < 0 or thumbnail_render_budget > 600000:
+                custom_messagebox(self, "Błąd", "Limit czasu renderu strony musi być z zakresu 0-600000 ms.", typ="error")
+                return
+        except ValueError:
+            custom_messagebox(self, "Błąd", "Limit czasu renderu strony musi być liczbą całkowitą.", typ="error")
+            return
+        
+        try:
+            undo_memory_mb = int(self.undo_memory_mb_var.get())
+            if undo_memory_mb < 16 or undo_memory_mb > 65536:
+                custom_messagebox(self, "Błąd", "Pamięć historii cofnij musi być z zakresu 16-65536 MB.", typ="error")
+                return
+        except ValueError:
+            custom_messagebox(self, "Błąd", "Pamięć historii cofnij musi być liczbą całkowitą.", typ="error")
+            return
+        
         # Validate Ghostscript path if provided
         gs_path = self.ghostscript_path_var.get().strip()
         if gs_path:
@@ -796,6 +1090,26 @@ class PreferencesDialog(tk.Toplevel):
         self.prefs_manager.set('watermark_on_save', 'True' if self.watermark_on_save_var.get() else 'False')
         self.prefs_manager.set('watermark_on_save_restricted', 'True' if self.watermark_on_save_restricted_var.get() else 'False')
         self.prefs_manager.set('ghostscript_path', gs_path)
+        self.prefs_manager.set('thumbnail_render_workers', str(thumbnail_workers))
+        self.prefs_manager.set('thumbnail_cache_mb', str(thumbnail_cache_mb))
+        self.prefs_manager.set('thumbnail_disk_cache_mb', str(thumbnail_disk_cache_mb))
+        self.prefs_manager.set('thumbnail_progressive', 'True' if self.thumbnail_progressive_var.get() else 'False')
+        grid_mode = next((mode for mode, label in self.GRID_MODES.items() if label == self.thumbnail_grid_mode_var.get()), 'frames')
+        self.prefs_manager.set('thumbnail_grid_mode', grid_mode)
+        self.prefs_manager.set('displaylist_cache_mb', str(displaylist_cache_mb))
+        self.prefs_manager.set('thumbnail_aa_level', str(thumbnail_aa_level))
+        self.prefs_manager.set('thumbnail_annots', 'True' if self.thumbnail_annots_var.get() else 'False')
+        self.prefs_manager.set('thumbnail_gray_while_scrolling', 'True' if self.thumbnail_gray_scroll_var.get() else 'False')
+        self.prefs_manager.set('thumbnail_render_budget_ms', str(thumbnail_render_budget))
+        render_backend = next((backend for backend, label in self.RENDER_BACKENDS.items()
+                               if label == self.thumbnail_render_backend_var.get()), 'threads')
+        self.prefs_manager.set('thumbnail_render_backend', render_backend)
+        self.prefs_manager.set('thumbnail_embed_on_save', 'True' if self.thumbnail_embed_var.get() else 'False')
+        self.prefs_manager.set('undo_memory_mb', str(undo_memory_mb))
+        undo_backend = next((backend for backend, label in self.UNDO_BACKENDS.items()
+                             if label == self.undo_backend_var.get()), 'pages')
+        self.prefs_manager.set('undo_backend', undo_backend)
+        self.prefs_manager.set('session_journal', 'True' if self.session_journal_var.get() else 'False')
         self.result = True
         self.destroy()
     
@@ -2510,7 +2824,11 @@ class PagePreviewPopup(tk.Toplevel):
         
     def _render_page(self):
         """Render page at high resolution"""
-        page = self.pdf_document.load_page(self.page_index)
+        # Sparsowana strona z cache przeglądarki (jeśli dostępna)
+        if self.viewer_app is not None and self.viewer_app.pdf_document is self.pdf_document:
+            page = self.viewer_app.get_page_displaylist(self.page_index)
+        else:
+            page = self.pdf_document.load_page(self.page_index)
         
         # Calculate target width (600px or more, keeping aspect ratio)
         target_width = 650
@@ -2523,12 +2841,12 @@ class PagePreviewPopup(tk.Toplevel):
         # Create matrix for rendering
         mat = fitz.Matrix(zoom, zoom)
         
-        # Render page
-        self.pix = page.get_pixmap(matrix=mat, alpha=False)
+        # Render page (pełny antyaliasing niezależnie od jakości miniatur)
+        with full_quality_rendering():
+            self.pix = page.get_pixmap(matrix=mat, alpha=False)
         
-        # Convert to PIL Image
-        img_data = self.pix.tobytes("ppm")
-        pil_image = Image.open(io.BytesIO(img_data))
+        # Convert to PIL Image (self.pix żyje razem z oknem, więc bez kopii pikseli)
+        pil_image = pixmap_to_image(self.pix, copy=False)
         
         # Convert to PhotoImage
         self.photo_image = ImageTk.PhotoImage(pil_image)
@@ -2593,189 +2911,2815 @@ class PagePreviewPopup(tk.Toplevel):
         self.destroy()
 
 # ====================================================================
-# KLASA: RAMKA MINIATURY (Bez zmian)
+# KLASA: RENDERER MINIATUR W TLE (PULA WĄTKÓW)
 # ====================================================================
 
-class ThumbnailFrame(tk.Frame):
-    def __init__(self, parent, viewer_app, page_index, column_width):
-        super().__init__(parent, bg="#F5F5F5") 
-        self.page_index = page_index
-        self.viewer_app = viewer_app
-        self.column_width = column_width
-        self.bg_normal = "#F5F5F5"
-        self.bg_selected = "#B3E5FC"
-        self.outer_frame = tk.Frame(
-            self, 
-            bg=self.bg_normal, 
-            borderwidth=0, 
-            relief=tk.FLAT,
-            highlightthickness=FOCUS_HIGHLIGHT_WIDTH, 
-            highlightbackground=self.bg_normal 
-        )
-        self.outer_frame.pack(fill="both", expand=True, padx=0, pady=0)
-        self.img_label = None 
-        self.setup_ui(self.outer_frame)
+THUMB_PLACEHOLDER_COLOR = "#D9D9D9"  # Szare tło miniatury, która jeszcze się renderuje
 
-    def _bind_all_children(self, sequence, func):
-        self.bind(sequence, func)
-        self.outer_frame.bind(sequence, func)
-        for child in self.outer_frame.winfo_children():
-            child.bind(sequence, func)
-            if child.winfo_class() == 'Frame':
-                 for grandchild in child.winfo_children():
-                     grandchild.bind(sequence, func)
 
+def thumbnail_size(page_rect, column_width, max_height=None):
+    """
+    Zwraca (szerokość, wysokość) miniatury strony dla zadanej szerokości kolumny.
+    Jeśli podano max_height, zbyt wysokie strony są zmniejszane do tej wysokości.
+    """
+    page_width = page_rect.width
+    page_height = page_rect.height
+    aspect_ratio = page_height / page_width if page_width != 0 else 1
+    final_thumb_width = max(1, int(column_width))
+    final_thumb_height = max(1, int(final_thumb_width * aspect_ratio))
+    if max_height and final_thumb_height > max_height:
+        final_thumb_height = max(1, int(max_height))
+        final_thumb_width = max(1, int(final_thumb_height / aspect_ratio))
+    return final_thumb_width, final_thumb_height
+
+
+def pixmap_to_image(pix, copy=True):
+    """
+    Tworzy obraz PIL bezpośrednio z pikseli pixmapy (Image.frombuffer), bez
+    kodowania do PPM/PNG i ponownego parsowania.
 
-    def setup_ui(self, parent_frame):
-        img_tk = self.viewer_app._render_and_scale(self.page_index, self.column_width)
-        # Cache is now handled inside _render_and_scale
-        
-        image_container = tk.Frame(parent_frame, bg="white") 
-        image_container.pack(padx=5, pady=(5, 0))
-        
-        self.img_label = tk.Label(image_container, image=img_tk, bg="white")
-        self.img_label.pack() 
-        
-        tk.Label(parent_frame, text=f"Strona {self.page_index + 1}", bg=self.bg_normal, font=("Helvetica", 10, "bold")).pack(pady=(5, 0))
-        
-        format_label = self.viewer_app._get_page_size_label(self.page_index)
-        tk.Label(parent_frame, text=format_label, fg="gray", bg=self.bg_normal, font=("Helvetica", 9)).pack(pady=(0, 5))
+    copy=True kopiuje piksele raz (pix.samples), więc obraz jest niezależny od
+    pixmapy. copy=False mapuje bufor pixmapy bez kopii - wywołujący musi wtedy
+    trzymać referencję do pix tak długo, jak używa obrazu.
+    """
+    if pix.alpha:
+        mode = {2: "LA", 4: "RGBA"}.get(pix.n)
+    else:
+        mode = {1: "L", 3: "RGB", 4: "CMYK"}.get(pix.n)
+    if mode is None:
+        # Nietypowa przestrzeń barw - sprowadź do RGB
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+        mode = "RGBA" if pix.alpha else "RGB"
+    data = pix.samples if copy else pix.samples_mv
+    return Image.frombuffer(mode, (pix.width, pix.height), data, "raw", mode, pix.stride, 1)
 
-        self._bind_all_children("<Button-1>", lambda event, idx=self.page_index: self.viewer_app._handle_lpm_click(idx, event))
-        # Handler środkowego przycisku myszy (Mouse-3) do otwierania popupu
-        def mouse3_handler(event, idx):
-            self._handle_double_click(idx)
-            return "break"
-        self._bind_all_children("<Button-2>", lambda event, idx=self.page_index: mouse3_handler(event, idx) or "break")
 
-        self._bind_all_children("<Button-3>", lambda event, idx=self.page_index: self._handle_ppm_click(event, idx))
-       # parent_frame.bind("<Enter>", lambda event, idx=self.page_index: self.viewer_app._focus_by_mouse(idx))
-    
-    def _handle_double_click(self, page_index):
-        """Handle double-click to show page preview popup"""
-        # Close previous popup if exists
-        if self.viewer_app.current_preview_popup:
-            try:
-                if self.viewer_app.current_preview_popup.winfo_exists():
-                    self.viewer_app.current_preview_popup._cleanup_and_close()
-            except tk.TclError:
-                # Widget already destroyed, just clear the reference
-                self.viewer_app.current_preview_popup = None
-        
-        # Create new popup and store reference
-        self.viewer_app.current_preview_popup = PagePreviewPopup(
-            self.viewer_app.master, 
-            self.viewer_app.pdf_document, 
-            page_index,
-            self.viewer_app
-        )
-        return "break"  # Prevent event propagation to single-click handler
+def max_channel_difference(image, samples=None):
+    """
+    Największa różnica między kanałami R, G, B w obrazie (0 dla stron czarno-białych).
+    Liczona operacjami PIL (w C), bez pętli po pikselach. samples to liczba pikseli
+    próbkowanych co stały krok (preferencja color_detect_samples); None - cały obraz.
+    Zwraca None dla obrazów bez kanałów RGB (np. miniatura w skali szarości).
+    """
+    if image.mode not in ("RGB", "RGBA"):
+        return None
+    red, green, blue = image.convert("RGB").split()
+    spread = ImageChops.lighter(ImageChops.difference(red, green), ImageChops.difference(green, blue))
+    spread = ImageChops.lighter(spread, ImageChops.difference(red, blue))
+    if samples is None:
+        return spread.getextrema()[1]
+    step = max(1, (image.width * image.height) // max(1, samples))
+    return max(spread.tobytes()[::step])
 
-    def _handle_ppm_click(self, event, page_index):
-        self.viewer_app.active_page_index = page_index
-        
-        if page_index not in self.viewer_app.selected_pages:
-             self.viewer_app.selected_pages.clear()
-             self.viewer_app.selected_pages.add(page_index)
-             self.viewer_app.update_selection_display()
-        
-        self.viewer_app.update_focus_display(hide_mouse_focus=False) 
-        self.viewer_app.context_menu.tk_popup(event.x_root, event.y_root)
 
-# ====================================================================
-# DIALOG SCALANIA STRON NA ARKUSZU
-# ====================================================================
+def render_page_thumbnail(page, column_width, max_height=None, draft_scale=1.0, gray=False, annots=True):
+    """
+    Renderuje stronę PDF do obrazu PIL o szerokości column_width (z zachowaniem proporcji).
+    Funkcja nie dotyka Tk, więc może być wywoływana z wątków roboczych.
+    Zamiast strony można podać jej fitz.DisplayList (ma to samo rect i get_pixmap).
+
+    draft_scale < 1 renderuje szkic w zmniejszonej rozdzielczości i powiększa go
+    do docelowego rozmiaru - dużo taniej dla ciężkich stron (obrazy dekodowane
+    są z podpróbkowaniem), kosztem ostrości. gray=True renderuje w skali szarości
+    (jeden kanał zamiast trzech). annots=False pomija adnotacje - dotyczy tylko
+    strony; DisplayList ma adnotacje ustalone przy tworzeniu (get_displaylist(annots=...)).
+    """
+    final_thumb_width, final_thumb_height = thumbnail_size(page.rect, column_width, max_height)
 
-class MergePageGridDialog(tk.Toplevel):
-    PAPER_FORMATS = {
-        'A0': (841, 1189),
-        'A1': (594, 841),
-        'A2': (420, 594),
-        'A3': (297, 420),
-        'A4': (210, 297),
-        'A5': (148, 210),
-        'A6': (105, 148),
-    }
-    
-    DEFAULTS = {
-        'sheet_format': 'A4',
-        'orientation': 'Pionowa',
-        'margin_top_mm': '5',
-        'margin_bottom_mm': '5',
-        'margin_left_mm': '5',
-        'margin_right_mm': '5',
-        'spacing_x_mm': '10',
-        'spacing_y_mm': '10',
-        'dpi_var': '300',
-        'scaling_mode': 'stretch',
-        'page_width_mm': '100',
-        'page_height_mm': '100',
-        'output_mode': 'new_file',  # 'new_file' or 'append'
+    # PyMuPDF renderuje w 72 DPI domyślnie, więc skalę liczymy względem wymiarów w punktach
+    scale_x = final_thumb_width / page.rect.width if page.rect.width else 1
+    scale_y = final_thumb_height / page.rect.height if page.rect.height else 1
+    scale = min(scale_x, scale_y) * draft_scale
+
+    options = {}
+    if not annots and isinstance(page, fitz.Page):
+        options['annots'] = False
+    colorspace = fitz.csGRAY if gray else fitz.csRGB
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=colorspace, alpha=False, **options)
+    image = pixmap_to_image(pix)
+
+    # Zaokrąglenia macierzy mogą dać piksel różnicy - dopasuj do dokładnego rozmiaru
+    if image.size != (final_thumb_width, final_thumb_height):
+        image = image.resize((final_thumb_width, final_thumb_height), Image.BILINEAR)
+    return image
+
+
+MAX_AA_LEVEL = 8
+# Poziom antyaliasingu MuPDF jest globalny dla procesu - render z własnym poziomem
+# ustawia go i przywraca pod tą blokadą, więc renderowania w innych wątkach czekają
+AA_LEVEL_LOCK = threading.RLock()
+
+
+@contextmanager
+def aa_level_rendering(aa_level):
+    """
+    Renderuje z poziomem antyaliasingu MuPDF aa_level (0-8) - dla tekstu i grafiki -
+    i przywraca potem oba poprzednie poziomy. Wątki renderujące miniatury ustawiają
+    poziom tylko na czas własnego renderu, więc nie zmieniają jakości innych renderów.
+    """
+    with AA_LEVEL_LOCK:
+        previous = fitz.TOOLS.show_aa_level()
+        if previous['graphics'] != aa_level or previous['text'] != aa_level:
+            fitz.TOOLS.set_aa_level(aa_level)
+        try:
+            yield
+        finally:
+            if previous['graphics'] != aa_level or previous['text'] != aa_level:
+                fitz.mupdf.fz_set_graphics_aa_level(previous['graphics'])
+                fitz.mupdf.fz_set_text_aa_level(previous['text'])
+
+
+def full_quality_rendering():
+    """Pełny antyaliasing MuPDF na czas renderu (np. podglądu lub eksportu) - patrz aa_level_rendering."""
+    return aa_level_rendering(MAX_AA_LEVEL)
+
+
+THUMB_DISK_CACHE_VERSION = 1
+PDF_REF_PATTERN = re.compile(rb"(\d+)\s+0\s+R")
+
+
+def page_content_digest(doc, page, max_objects=256):
+    """
+    Zwraca skrót (hex) treści strony: surowych strumieni zawartości, drzewa zasobów
+    (definicje obiektów, do których prowadzą odwołania), obrotu i pól strony.
+    Ta sama treść w tym samym pliku daje ten sam skrót niezależnie od numeru strony.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"v{THUMB_DISK_CACHE_VERSION}|{page.rotation}|{tuple(page.mediabox)}|{tuple(page.cropbox)}".encode())
+
+    for xref in page.get_contents():
+        digest.update(doc.xref_stream_raw(xref) or b"")
+
+    # Zasoby mogą być dziedziczone z drzewa stron - szukaj w górę po /Parent
+    resources = None
+    xref = page.xref
+    for _ in range(32):
+        kind, value = doc.xref_get_key(xref, "Resources")
+        if kind != "null":
+            resources = value
+            break
+        kind, value = doc.xref_get_key(xref, "Parent")
+        if kind != "xref":
+            break
+        xref = int(value.split()[0])
+
+    # Definicje obiektów zasobów (czcionki, obrazy, formularze) - bez samych strumieni,
+    # ale ze słownikami, w których są m.in. /Length i /Filter
+    pending = [resources.encode()] if resources else []
+    visited = set()
+    while pending and len(visited) < max_objects:
+        source = pending.pop()
+        digest.update(source)
+        for match in PDF_REF_PATTERN.finditer(source):
+            ref = int(match.group(1))
+            if ref in visited or ref <= 0 or ref >= doc.xref_length():
+                continue
+            visited.add(ref)
+            pending.append(doc.xref_object(ref, compressed=True).encode())
+    return digest.hexdigest()
+
+
+CONTENT_OPERATOR_PATTERN = re.compile(rb"(?<![^\s\]\)>])(re|m|l|c|v|y|f\*?|F|B\*?|b\*?|S|s|n|sh|Do|Tj|TJ|BI)(?=[\s\[\(/<]|$)")
+CONTENT_OPERATOR_GROUPS = {
+    b"m": "ścieżki", b"l": "ścieżki", b"c": "ścieżki", b"v": "ścieżki", b"y": "ścieżki", b"re": "ścieżki",
+    b"f": "malowanie", b"f*": "malowanie", b"F": "malowanie", b"B": "malowanie", b"B*": "malowanie",
+    b"b": "malowanie", b"b*": "malowanie", b"S": "malowanie", b"s": "malowanie", b"n": "malowanie",
+    b"sh": "cieniowania", b"Do": "xobiekty", b"BI": "obrazy", b"Tj": "tekst", b"TJ": "tekst",
+}
+THUMBNAIL_CACHE_DIR = os.path.join(BASE_DIR, "thumbnail_cache")
+# Dziennik złożonych stron leży w katalogu cache programu, a nie obok plików użytkownika
+COMPLEX_PAGES_LOG = os.path.join(THUMBNAIL_CACHE_DIR, "complex_pages.log")
+# Strony z większą (rozpakowaną) treścią renderuje proces roboczy z limitem czasu
+COMPLEX_CONTENT_BYTES = 1024 * 1024
+# Po edycji wątki renderujące dostają bazę i nakładkę zmienionych stron; przy większej
+# liczbie zmienionych stron taniej jest przekazać bajty całego dokumentu (nowa baza)
+RENDER_OVERLAY_MAX_PAGES = 64
+
+
+def page_content_streams(doc, page, max_xobjects=64):
+    """Rozpakowane strumienie treści strony wraz ze strumieniami używanych formularzy (Form XObject)."""
+    streams = [page.read_contents()]
+    for xref, *_ in page.get_xobjects()[:max_xobjects]:
+        if doc.xref_get_key(xref, "Subtype")[1] == "/Form":
+            streams.append(doc.xref_stream(xref) or b"")
+    return streams
+
+
+def count_content_operators(doc, page, max_xobjects=64):
+    """
+    Zlicza operatory treści strony wg grup (ścieżki, malowanie, tekst, xobiekty...),
+    łącznie ze strumieniami formularzy (Form XObject) używanych przez stronę.
+    Liczby są przybliżone (bez pełnego parsowania), wystarczają do diagnozy ciężkich stron.
+    """
+    counts = {group: 0 for group in dict.fromkeys(CONTENT_OPERATOR_GROUPS.values())}
+    streams = page_content_streams(doc, page, max_xobjects)
+    for stream in streams:
+        for match in CONTENT_OPERATOR_PATTERN.finditer(stream):
+            counts[CONTENT_OPERATOR_GROUPS[match.group(1)]] += 1
+    counts["bajty treści"] = sum(len(stream) for stream in streams)
+    return counts
+
+
+def page_profile(doc, page):
+    """
+    Miary złożoności strony do profilu renderowania: bajty treści, rysunki
+    (operatory malowania i cieniowania), obrazy (XObject i wstawione w treść)
+    z największym z nich w pikselach i łączną liczbą megapikseli, oraz fonty.
+    """
+    counts = count_content_operators(doc, page)
+    images = page.get_images(full=True)
+    largest = max(images, key=lambda item: item[2] * item[3], default=None)
+    return {
+        "bajty treści": counts["bajty treści"],
+        "rysunki": counts["malowanie"] + counts["cieniowania"],
+        "obrazy": len(images) + counts["obrazy"],
+        "największy obraz": f"{largest[2]}x{largest[3]}" if largest else "",
+        "megapiksele obrazów": round(sum(item[2] * item[3] for item in images) / 1e6, 2),
+        "fonty": len(page.get_fonts(full=True)),
     }
 
-    def __init__(self, parent, page_count, prefs_manager=None):
-        super().__init__(parent)
-        self.title("Scalanie strony na arkuszu")
-        self.transient(parent)
-        self.result = None
-        self.prefs_manager = prefs_manager
-        
-        # Pozycjonuj poza ekranem, aby uniknąć migotania
-        self.geometry("+10000+10000")
 
-        self.configure(bg=parent.cget('bg'))
+def log_complex_page(document_id, page_index, render_seconds, counts, interrupted=False):
+    """Dopisuje stronę renderowaną dłużej niż budżet do COMPLEX_PAGES_LOG (i na konsolę)."""
+    details = ", ".join(f"{name}: {value}" for name, value in counts.items())
+    duration = f"{'przerwano po ' if interrupted else ''}{render_seconds * 1000:.0f} ms"
+    line = (f"{datetime.now().isoformat(timespec='seconds')}\t{document_id or '(dokument bez pliku)'}\t"
+            f"strona {page_index + 1}\t{duration}\t{details}")
+    print(f"[RENDER] Złożona strona: {line}")
+    try:
+        os.makedirs(os.path.dirname(COMPLEX_PAGES_LOG), exist_ok=True)
+        with open(COMPLEX_PAGES_LOG, "a", encoding="utf-8") as log_file:
+            log_file.write(line + "\n")
+    except OSError as e:
+        print(f"[RENDER] Nie można zapisać {COMPLEX_PAGES_LOG}: {e}")
 
-        self.sheet_format = tk.StringVar(value=self._get_pref('sheet_format'))
-        self.orientation = tk.StringVar(value=self._get_pref('orientation'))
-        self.margin_top_mm = tk.StringVar(value=self._get_pref('margin_top_mm'))
-        self.margin_bottom_mm = tk.StringVar(value=self._get_pref('margin_bottom_mm'))
-        self.margin_left_mm = tk.StringVar(value=self._get_pref('margin_left_mm'))
-        self.margin_right_mm = tk.StringVar(value=self._get_pref('margin_right_mm'))
-        self.spacing_x_mm = tk.StringVar(value=self._get_pref('spacing_x_mm'))
-        self.spacing_y_mm = tk.StringVar(value=self._get_pref('spacing_y_mm'))
-        self.rows_var = tk.StringVar()
-        self.cols_var = tk.StringVar()
-        self.dpi_var = tk.StringVar(value=self._get_pref('dpi_var'))
-        self.scaling_mode = tk.StringVar(value=self._get_pref('scaling_mode'))
-        self.page_width_mm = tk.StringVar(value=self._get_pref('page_width_mm'))
-        self.page_height_mm = tk.StringVar(value=self._get_pref('page_height_mm'))
-        self.output_mode = tk.StringVar(value=self._get_pref('output_mode'))
-        self.page_count = page_count
 
-        self.vcmd_200 = (self.register(lambda v: validate_float_range(v, 0, 200)), "%P")
-        self.vcmd_500 = (self.register(lambda v: validate_float_range(v, 0, 500)), "%P")
-        self.grid_range = [str(i) for i in range(1, 21)]
+class ThumbnailDiskCache:
+    """
+    Trwały cache miniatur w katalogu na dysku (pliki PNG), z limitem rozmiaru.
 
-        if page_count == 1:
-            self.rows_var.set("1")
-            self.cols_var.set("1")
-        else:
-            import math
-            sq = min(max(math.ceil(page_count ** 0.5), 1), 10)
-            if (sq - 1) * sq >= page_count:
-                self.rows_var.set(str(min(max(sq - 1, 1), 10)))
-                self.cols_var.set(str(min(max(sq, 1), 10)))
+    Klucz wpisu to identyfikator dokumentu (ścieżka pliku), skrót treści strony
+    i rozmiar renderowania. Metody są bezpieczne wątkowo - wywołują je wątki
+    renderujące. Przy przekroczeniu limitu usuwane są najdawniej używane pliki
+    (czas modyfikacji odświeżany przy każdym trafieniu).
+    """
+
+    PRUNE_TARGET_RATIO = 0.8
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max(0, int(max_bytes))
+        self._lock = threading.Lock()
+        self._total_bytes = None  # Liczone leniwie przy pierwszym zapisie
+        self.enabled = self.max_bytes > 0
+        if self.enabled:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+            except OSError as e:
+                print(f"[CACHE] Nie można utworzyć katalogu cache miniatur {self.directory}: {e}")
+                self.enabled = False
+
+    @staticmethod
+    def make_key(document_id, content_digest, width, max_height):
+        raw = f"{document_id}|{content_digest}|{width}|{max_height}".encode("utf-8")
+        return hashlib.blake2b(raw, digest_size=20).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".png")
+
+    def get(self, key):
+        """Zwraca obraz PIL z dysku albo None."""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with Image.open(path) as image:
+                image.load()
+                result = image.convert("RGB") if image.mode != "RGB" else image.copy()
+            os.utime(path, None)
+            return result
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, image):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            image.save(tmp_path, format="PNG", compress_level=1)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[CACHE] Nie można zapisać miniatury na dysk: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan()[1]
             else:
-                self.rows_var.set(str(min(max(sq, 1), 10)))
-                self.cols_var.set(str(min(max(sq, 1), 10)))
+                self._total_bytes += size
+            if self._total_bytes > self.max_bytes:
+                self._prune()
+
+    def _scan(self):
+        """Zwraca (lista (mtime, rozmiar, ścieżka), łączny rozmiar) plików cache."""
+        entries = []
+        total = 0
+        for root, _dirs, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        return entries, total
+
+    def _prune(self):
+        entries, total = self._scan()
+        entries.sort()
+        target = self.max_bytes * self.PRUNE_TARGET_RATIO
+        for _mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._total_bytes = total
 
-        self.build_ui()
-        self._on_scaling_mode_changed()  # Initialize UI state based on scaling mode
-        self._update_grid_preview()
-        self.center_dialog(parent)
-        self.grab_set()
-        self.focus_force()
-        self.protocol("WM_DELETE_WINDOW", self.cancel)
-        self.resizable(False, False)
-        self.bind("<Return>", lambda e: self.ok())
-        self.bind("<KP_Enter>", lambda e: self.ok())
-        self.bind("<Escape>", lambda e: self.cancel())
-        self.wait_window(self)
 
-    def _combo_key_num(self, combo, var, event):
-        if event.char in "123456789":
-            var.set(event.char)
-            combo.event_generate('<<ComboboxSelected>>')
+def _attach_shared_memory(name):
+    """
+    Dołącza do bloku pamięci współdzielonej utworzonego przez proces główny (blok
+    zwalnia właściciel). Starsze wersje Pythona rejestrują blok ponownie, ale proces
+    uruchomiony metodą "spawn" dzieli resource_tracker z procesem głównym, więc to
+    ten sam wpis - wyrejestrowanie go tutaj zgubiłoby wpis właściciela.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def _render_process_main(conn):
+    """
+    Pętla procesu renderującego (backend "processes"). Polecenia przychodzą potokiem
+    od RenderProcess; piksele miniatury trafiają do bloku pamięci współdzielonej
+    wskazanego w poleceniu, a potokiem wraca tylko opis obrazu.
+    """
+    doc = None
+    displaylists = OrderedDict()
+    blocks = {}
+    last_pixels = None
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        command = message[0]
+        try:
+            if command == "open":
+                _, filepath, source_name, source_size, password = message
+                if doc is not None:
+                    doc.close()
+                displaylists.clear()
+                if filepath:
+                    doc = fitz.open(filepath)
+                else:
+                    source = _attach_shared_memory(source_name)
+                    try:
+                        data = bytes(source.buf[:source_size])
+                    finally:
+                        source.close()
+                    doc = fitz.open("pdf", data)
+                if password and doc.needs_pass:
+                    doc.authenticate(password)
+                conn.send(("ok",))
+            elif command == "render":
+                _, page_index, width, max_height, draft_scale, gray, annots, aa_level, block_name = message
+                if fitz.TOOLS.show_aa_level()["graphics"] != aa_level:
+                    fitz.TOOLS.set_aa_level(aa_level)
+                started = time.perf_counter()
+                displaylist = displaylists.get((page_index, annots))
+                if displaylist is None:
+                    displaylist = doc.load_page(page_index).get_displaylist(annots=annots)
+                    displaylists[(page_index, annots)] = displaylist
+                    while len(displaylists) > ThumbnailRenderer.WORKER_DISPLAYLISTS:
+                        displaylists.popitem(last=False)
+                else:
+                    displaylists.move_to_end((page_index, annots))
+                image = render_page_thumbnail(displaylist, width, max_height, draft_scale=draft_scale, gray=gray)
+                seconds = time.perf_counter() - started
+                last_pixels = (image.mode, image.size, image.tobytes(), seconds)
+            elif command == "counts":
+                conn.send(("counts", count_content_operators(doc, doc.load_page(message[1]))))
+            elif command == "quit":
+                break
+            if command in ("render", "fetch"):
+                # Ostatni argument to blok na piksele ("fetch" ponawia zapis do większego bloku)
+                block_name = message[-1]
+                mode, size, pixels, seconds = last_pixels
+                block = blocks.get(block_name)
+                if block is None:
+                    for old in blocks.values():
+                        old.close()
+                    blocks = {block_name: _attach_shared_memory(block_name)}
+                    block = blocks[block_name]
+                if len(pixels) > block.size:
+                    conn.send(("grow", len(pixels)))
+                    continue
+                block.buf[:len(pixels)] = pixels
+                conn.send(("done", mode, size, len(pixels), seconds))
+        except Exception as e:
+            conn.send(("error", str(e)))
+    for block in blocks.values():
+        block.close()
+
+
+class RenderProcessError(RuntimeError):
+    """Proces renderujący zakończył się nieoczekiwanie (np. awaria MuPDF na uszkodzonym pliku)."""
+
+
+class RenderProcess:
+    """
+    Proces renderujący miniatury, obsługiwany przez jeden wątek roboczy ThumbnailRenderer.
+
+    Proces otwiera własną kopię dokumentu (plik albo bajty z bloku pamięci współdzielonej)
+    i renderuje poza GIL procesu GUI. Piksele wracają przez blok pamięci współdzielonej
+    należący do tego obiektu (powiększany w razie potrzeby) - potokiem idzie tylko opis
+    obrazu. Render z limitem czasu, który go przekroczył, zatrzymuje proces; następne
+    polecenie uruchamia nowy.
+    """
+    INITIAL_BLOCK_BYTES = 1024 * 1024
+    STARTUP_TIMEOUT = 60.0
+    POLL_SECONDS = 0.1
+
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.block = None
+        self.generation = None
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_render_process_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.generation = None
+
+    def is_running(self):
+        return self.process is not None and self.process.is_alive()
+
+    def _call(self, message, timeout=None, is_cancelled=None):
+        """Wysyła polecenie i czeka na odpowiedź. Zwraca None po przekroczeniu limitu lub anulowaniu."""
+        if not self.is_running():
+            self.start()
+        self.conn.send(message)
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not self.conn.poll(self.POLL_SECONDS):
+            if not self.process.is_alive():
+                self.stop()
+                raise RenderProcessError("proces renderujący zakończył się nieoczekiwanie")
+            if (deadline is not None and time.perf_counter() > deadline) or (is_cancelled is not None and is_cancelled()):
+                self.stop()
+                return None
+        try:
+            reply = self.conn.recv()
+        except EOFError:
+            self.stop()
+            raise RenderProcessError("proces renderujący zakończył się nieoczekiwanie")
+        if reply[0] == "error":
+            raise RuntimeError(reply[1])
+        return reply
+
+    def open(self, generation, filepath, source_name, source_size, password):
+        if generation == self.generation and self.is_running():
+            return True
+        if self._call(("open", filepath, source_name, source_size, password), timeout=self.STARTUP_TIMEOUT) is None:
+            return False
+        self.generation = generation
+        return True
+
+    def render(self, page_index, width, max_height, draft_scale=1.0, gray=False, annots=True,
+               aa_level=MAX_AA_LEVEL, timeout=None, is_cancelled=None):
+        """Zwraca (image, sekundy renderu) albo None po przekroczeniu limitu czasu lub anulowaniu."""
+        if self.block is None:
+            self.block = shared_memory.SharedMemory(create=True, size=self.INITIAL_BLOCK_BYTES)
+        reply = self._call(("render", page_index, width, max_height, draft_scale, gray, annots, aa_level,
+                            self.block.name), timeout, is_cancelled)
+        if reply is None:
+            return None
+        if reply[0] == "grow":
+            self._release_block()
+            self.block = shared_memory.SharedMemory(create=True, size=reply[1])
+            reply = self._call(("fetch", self.block.name))
+        _, mode, size, length, seconds = reply
+        # Kopia z bloku do obrazu - blok jest używany ponownie przy następnym renderze
+        return Image.frombytes(mode, size, self.block.buf[:length]), seconds
+
+    def counts(self, page_index):
+        reply = self._call(("counts", page_index), timeout=self.STARTUP_TIMEOUT)
+        return reply[1] if reply is not None else {}
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                self.process.kill()
+            self.process.join(1)
+        if self.conn is not None:
+            self.conn.close()
+        self.process = None
+        self.conn = None
+        self.generation = None
+
+    def _release_block(self):
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+    def close(self):
+        self.stop()
+        self._release_block()
+
+
+class RenderJob:
+    """Zlecenie renderowania miniatury w kolejce ThumbnailRenderer."""
+    __slots__ = ("generation", "key", "page_index", "width", "max_height",
+                 "content_digest", "draft", "gray", "unbounded", "enqueued_at", "sequence")
+
+    def __init__(self, generation, key, page_index, width, max_height, content_digest, draft, gray, unbounded,
+                 enqueued_at, sequence):
+        self.generation = generation
+        self.key = key
+        self.page_index = page_index
+        self.width = width
+        self.max_height = max_height
+        self.content_digest = content_digest
+        self.draft = draft
+        self.gray = gray
+        self.unbounded = unbounded  # Bez budżetu czasu (render na żądanie)
+        self.enqueued_at = enqueued_at
+        self.sequence = sequence
+
+
+class ThumbnailRenderer:
+    """
+    Renderuje miniatury stron w wątkach roboczych, poza głównym wątkiem Tk.
+
+    Każdy wątek roboczy otwiera własną instancję fitz.Document (tylko do odczytu)
+    ze źródła ustawionego przez set_source() - ścieżki pliku lub bajtów PDF.
+    W backendzie "processes" wątek roboczy tylko pośredniczy: render wykonuje jego
+    proces (RenderProcess) z własnym dokumentem, bez udziału GIL procesu GUI,
+    a awaria MuPDF kończy tylko ten proces.
+    Gotowe obrazy PIL trafiają do kolejki, którą wątek GUI odpytuje przez after()
+    i przekazuje do callbacku on_result(key, page_index, image, final).
+    Przy ostrym, kolorowym renderze z adnotacjami wątek liczy też przy okazji
+    max_channel_difference obrazu (color_samples próbek) i przekazuje ją do
+    on_color(key, spread, samples).
+    Czas każdego ostrego renderu (bez trafień w cache dyskowy) trafia do
+    on_render_time(key, sekundy) - dane dla profilu stron.
+
+    Każda zmiana źródła podnosi numer generacji - wyniki zleceń ze starszych
+    generacji są odrzucane, bo indeksy stron mogły się już zmienić.
+    Źródło z nakładką (set_source(..., overlay=...)) opisuje dokument po edycji jako
+    poprzednie źródło (bazę) plus mały PDF ze zmienionymi stronami - wątki i procesy
+    robocze nie otwierają wtedy bazy od nowa, a wątek GUI nie serializuje całego pliku.
+
+    Jeśli podano disk_cache, a źródło ma document_id, wątek przed renderowaniem
+    szuka miniatury na dysku po skrócie treści strony i zapisuje tam nowe rendery.
+
+    W trybie progresywnym każde zlecenie najpierw daje szkic (final=False) w
+    rozdzielczości DRAFT_SCALE, a ostry render wraca do kolejki jako osobne zlecenie.
+
+    Kolejka jest priorytetowa: wątek bierze zlecenie wg bieżącego widoku ustawionego
+    przez set_viewport() - najpierw strony widoczne (szkice przed ostrymi), potem
+    strony w kierunku przewijania, na końcu pozostałe. Zlecenia dla stron poza
+    zakresem "keep" są anulowane. Po każdym odpytaniu kolejki on_stats(stats)
+    dostaje głębokość kolejki i opóźnienia (do paska stanu).
+
+    Polityka jakości (set_quality): poziom antyaliasingu, pomijanie adnotacji i
+    szkice w skali szarości w trakcie przewijania (set_scrolling). Szary szkic
+    jest zleceniem typu draft, więc ostry, kolorowy render wraca do kolejki za nim
+    - dla stron, które zostały na ekranie; dla pozostałych jest anulowany.
+
+    Budżet czasu (time_budget_ms > 0): render MuPDF trzyma GIL i nie da się go
+    przerwać, więc strony o treści większej niż COMPLEX_CONTENT_BYTES są renderowane
+    w procesie roboczym wątku (render_isolated), zabijanym po przekroczeniu
+    budżetu. Wywołujący dostaje wtedy on_timeout(key, page_index, elapsed) i nie
+    zleca strony ponownie; render na żądanie (request(..., unbounded=True)) idzie
+    tą samą drogą bez limitu. Strony renderowane dłużej niż budżet (lub przerwane)
+    trafiają do logu z czasem i liczbą operatorów treści.
+    """
+
+    POLL_INTERVAL_MS = 30
+    MAX_RESULTS_PER_POLL = 24
+    DRAFT_SCALE = 0.3
+    LATENCY_SMOOTHING = 0.2
+    WORKER_DISPLAYLISTS = 8
+
+    def __init__(self, master, on_result, max_workers=2, disk_cache=None, progressive=False, on_stats=None,
+                 on_timeout=None, time_budget_ms=0, backend="threads", on_color=None, on_render_time=None):
+        self.master = master
+        self.backend = backend
+        self.on_result = on_result
+        self.on_color = on_color
+        self.on_render_time = on_render_time
+        self.on_stats = on_stats
+        self.on_timeout = on_timeout
+        self.time_budget_ms = time_budget_ms
+        self.disk_cache = disk_cache
+        self.progressive = progressive
+        # Polityka jakości (patrz set_quality)
+        self.aa_level = MAX_AA_LEVEL
+        self.annots = True
+        self.color_samples = None  # Próbki do wykrywania koloru (None - cały obraz)
+        self.gray_while_scrolling = False
+        self.scrolling = False
+        self.max_workers = max(1, int(max_workers))
+        self._workers: List[threading.Thread] = []
+        # Procesy robocze - po jednym na wątek (backend "processes" i render ciężkich stron)
+        self._processes: List[RenderProcess] = []
+        # Bajty źródła w pamięci współdzielonej dla procesów roboczych: "base"/"overlay" -> (data, blok)
+        self._source_blocks = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._jobs: List[RenderJob] = []  # Oczekujące zlecenia (chronione przez _cond)
+        self._running = 0
+        self._sequence = 0
+        self._stopped = False
+        self._results = queue.Queue()
+        self._timeouts = queue.Queue()  # Zlecenia przerwane po przekroczeniu budżetu czasu
+        self._generation = 0
+        self._source = None
+        self._overlay = None  # (bajty PDF ze zmienionymi stronami, mapa stron) - patrz set_source
+        self._base_serial = 0  # Numer bazy źródła (zmienia się przy set_source bez nakładki)
+        self._pending = set()
+        self._poll_id = None
+        # Widok: zakres widocznych stron, kierunek przewijania i zakres, poza którym zlecenia są anulowane
+        self._viewport = None
+        self._direction = 0
+        self._keep = None
+        # Statystyki (wątek GUI)
+        self.avg_latency_ms = 0.0
+        self.last_latency_ms = 0.0
+        self.completed = 0
+        self.cancelled = 0
+        self.timed_out = 0
+
+    def set_source(self, filepath=None, data=None, password=None, document_id=None, overlay=None):
+        """
+        Ustawia nowe źródło dokumentu (lub None) i unieważnia zlecenia w toku.
+
+        overlay=(bajty, strony) opisuje dokument jako zmianę bazy - źródła ustawionego
+        ostatnio bez nakładki (filepath i data muszą być wtedy te same): strony[i] >= 0
+        to indeks strony i w bazie, -1-k oznacza stronę k małego PDF-u z bajtów.
+        """
+        with self._lock:
+            self._generation += 1
+            if filepath is None and data is None:
+                self._source = None
+            else:
+                if overlay is None:
+                    self._base_serial += 1
+                self._source = (filepath, data, password, document_id)
+            self._overlay = overlay
+            base_block = self._source_blocks.get("base")
+            if base_block is not None and base_block[0] is not data:
+                self._release_source_block("base")
+            self._release_source_block("overlay")  # Nakładka jest nowa w każdej generacji
+            # Zlecenia starej generacji nie mają już sensu
+            self._jobs.clear()
+        self._pending.clear()
+        return self._generation
+
+    def has_source(self):
+        return self._source is not None
+
+    def set_quality(self, aa_level=MAX_AA_LEVEL, annots=True, gray_while_scrolling=False):
+        """
+        Ustawia politykę jakości miniatur. Zwraca True, jeśli zmieniła się treść
+        ostrych miniatur (antyaliasing, adnotacje) - wtedy wywołujący powinien
+        wyczyścić swój cache obrazów.
+
+        Poziom antyaliasingu MuPDF jest globalny dla procesu, więc nie jest tu ustawiany -
+        wątki robocze stosują go tylko na czas własnego renderu (aa_level_rendering),
+        a procesy robocze dostają go z każdym zleceniem.
+        """
+        aa_level = max(0, min(MAX_AA_LEVEL, int(aa_level)))
+        changed = aa_level != self.aa_level or bool(annots) != self.annots
+        self.aa_level = aa_level
+        self.annots = bool(annots)
+        self.gray_while_scrolling = bool(gray_while_scrolling)
+        if changed:
+            # Ostre wyniki zleceń w toku miałyby już nieaktualną jakość
+            with self._lock:
+                self._generation += 1
+                self._jobs.clear()
+            self._pending.clear()
+        return changed
+
+    def set_scrolling(self, scrolling):
+        """Informuje o trwającym przewijaniu (szkice przed ostrymi renderami, opcjonalnie w szarości)."""
+        with self._lock:
+            self.scrolling = bool(scrolling)
+
+    def _quality_tag(self):
+        """Część klucza cache na dysku zależna od polityki jakości ostrych renderów."""
+        return f"aa{self.aa_level}" + ("" if self.annots else "-noannots")
+
+    def request(self, key, page_index, width, max_height=None, content_digest=None, sharp_only=False, unbounded=False):
+        """
+        Zleca wyrenderowanie miniatury strony. key to klucz cache, z którym wynik
+        wróci do on_result - powtórne zlecenie tego samego klucza jest ignorowane.
+        content_digest (jeśli znany) oszczędza wątkowi liczenia skrótu dla cache na dysku.
+        sharp_only=True pomija szkic (wywołujący ma już obraz zastępczy).
+        unbounded=True wyłącza budżet czasu dla tego zlecenia.
+        """
+        if self._source is None or self._stopped:
+            return
+        if (self._generation, key) in self._pending:
+            return
+        self._pending.add((self._generation, key))
+        self._start_workers()
+        gray = self.gray_while_scrolling and self.scrolling and not sharp_only
+        draft = (self.progressive and not sharp_only) or gray
+        self._enqueue(self._generation, key, page_index, width, max_height, content_digest,
+                      draft, gray, unbounded, time.perf_counter())
+        self._schedule_poll()
+
+    def set_viewport(self, visible, direction=0, keep=None):
+        """
+        Ustawia widoczny zakres stron (range) i kierunek przewijania (-1/0/1).
+        Oczekujące zlecenia dla stron spoza zakresu keep (range) są anulowane.
+        """
+        cancelled = []
+        with self._cond:
+            self._viewport = (visible.start, visible.stop)
+            self._direction = direction
+            self._keep = (keep.start, keep.stop) if keep is not None else None
+            if self._keep is not None:
+                first, last = self._keep
+                remaining = []
+                for job in self._jobs:
+                    if first <= job.page_index < last:
+                        remaining.append(job)
+                    else:
+                        cancelled.append(job)
+                self._jobs = remaining
+        for job in cancelled:
+            self._pending.discard((job.generation, job.key))
+        self.cancelled += len(cancelled)
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def stats(self):
+        """Głębokość kolejki (oczekujące + w trakcie) i opóźnienia renderowania."""
+        with self._lock:
+            queued = len(self._jobs)
+            running = self._running
+        return {
+            'queued': queued,
+            'running': running,
+            'depth': queued + running,
+            'avg_latency_ms': self.avg_latency_ms,
+            'last_latency_ms': self.last_latency_ms,
+            'completed': self.completed,
+            'cancelled': self.cancelled,
+            'timed_out': self.timed_out,
+        }
+
+    def _start_workers(self):
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker_loop, name=f"thumb-render-{len(self._workers)}", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _enqueue(self, generation, key, page_index, width, max_height, content_digest, draft, gray, unbounded, enqueued_at):
+        with self._cond:
+            if generation != self._generation or self._stopped:
+                return
+            self._sequence += 1
+            self._jobs.append(RenderJob(generation, key, page_index, width, max_height,
+                                        content_digest, draft, gray, unbounded, enqueued_at, self._sequence))
+            self._cond.notify()
+
+    def _priority(self, job):
+        """Klucz sortowania zleceń (mniejszy = pilniejszy). Wołane pod blokadą."""
+        if self._viewport is None:
+            return (0, 0 if job.draft else 1, job.sequence)
+        first, last = self._viewport
+        page = job.page_index
+        if first <= page < last:
+            tier, distance = 0, page - first
+        elif page >= last:
+            tier, distance = (1 if self._direction >= 0 else 2), page - last
+        else:
+            tier, distance = (1 if self._direction < 0 else 2), first - page
+        if self.scrolling:
+            # W trakcie przewijania wszystkie szkice przed ostrymi renderami
+            return (0 if job.draft else 1, tier, distance, job.sequence)
+        return (tier, 0 if job.draft else 1, distance, job.sequence)
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._jobs and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                job = min(self._jobs, key=self._priority)
+                self._jobs.remove(job)
+                self._running += 1
+            try:
+                self._render_job(job)
+            finally:
+                with self._cond:
+                    self._running -= 1
+
+    def _page_source(self, generation, index):
+        """
+        Źródło strony o indeksie index: (klucz dokumentu, filepath, data, password, indeks strony
+        w tym dokumencie) - z bazy albo z nakładki. Klucz bazy nie zmienia się między
+        generacjami. None dla nieaktualnej generacji. Wołane pod blokadą.
+        """
+        if generation != self._generation or self._source is None:
+            return None
+        filepath, data, password, _ = self._source
+        if self._overlay is not None:
+            overlay_data, pages = self._overlay
+            if index >= len(pages):
+                return None
+            index = pages[index]
+            if index < 0:
+                return ("overlay", generation), None, overlay_data, None, -1 - index
+        return ("base", self._base_serial), filepath, data, password, index
+
+    def _get_document(self, job):
+        """
+        Zwraca (dokument wątku roboczego, indeks strony zlecenia w nim) albo (None, None)
+        dla nieaktualnego zlecenia. Wątek trzyma otwartą bazę i nakładkę - po edycji
+        dokumentu otwiera od nowa tylko nakładkę ze zmienionymi stronami.
+        """
+        with self._lock:
+            source = self._page_source(job.generation, job.page_index)
+            if source is None:
+                return None, None
+            document_id = self._source[3]
+        key, filepath, data, password, index = source
+        documents = getattr(self._local, "documents", None)
+        if documents is None:
+            documents = self._local.documents = {}
+        cached = documents.get(key[0])
+        if cached is not None and cached[0] == key:
+            doc = cached[1]
+        else:
+            if cached is not None:
+                cached[1].close()
+            doc = fitz.open(filepath) if filepath else fitz.open("pdf", data)
+            if password and doc.needs_pass:
+                doc.authenticate(password)
+            documents[key[0]] = (key, doc)
+        self._local.document_id = document_id
+        return doc, index
+
+    def _get_displaylist(self, job, page):
+        """
+        Sparsowana strona (DisplayList) wątku roboczego: szkic i ostry render tej
+        samej strony interpretują jej treść tylko raz. Trzymane są ostatnie
+        WORKER_DISPLAYLISTS stron bieżącej generacji (osobno z adnotacjami i bez).
+        """
+        cache = getattr(self._local, "displaylists", None)
+        if cache is None or self._local.displaylists_generation != job.generation:
+            cache = self._local.displaylists = OrderedDict()
+            self._local.displaylists_generation = job.generation
+        annots = self.annots
+        displaylist = cache.get((job.page_index, annots))
+        if displaylist is None:
+            displaylist = page.get_displaylist(annots=annots)
+            cache[(job.page_index, annots)] = displaylist
+            while len(cache) > self.WORKER_DISPLAYLISTS:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end((job.page_index, annots))
+        return displaylist
+
+    def _render_job(self, job):
+        image = None
+        final = True
+        render_seconds = None
+        page_index = job.page_index
+        if job.generation == self._generation:
+            try:
+                if self.backend == "processes":
+                    rendered = self._render_in_process(job)
+                else:
+                    rendered = self._render_in_thread(job)
+                if rendered is None:
+                    # Przekroczony budżet czasu albo anulowanie - bez wyniku
+                    return
+                image, final, render_seconds = rendered
+            except Exception as e:
+                if self._stopped:
+                    return
+                print(f"[RENDER] Błąd renderowania miniatury strony {page_index}: {e}")
+        latency = time.perf_counter() - job.enqueued_at
+        color_spread = None
+        if image is not None and final and self.annots and self.on_color is not None:
+            # Wykrywanie koloru jako produkt uboczny - taki sam obraz, jaki ocenia analiza
+            samples = self.color_samples
+            color_spread = (max_channel_difference(image, samples), samples)
+        self._results.put((job.generation, job.key, page_index, image, final, latency, color_spread, render_seconds))
+        if not final:
+            # Ostry render jako osobne zlecenie - kolejka zdecyduje, kiedy na niego pora
+            self._enqueue(job.generation, job.key, page_index, job.width, job.max_height,
+                          job.content_digest, False, False, job.unbounded, job.enqueued_at)
+
+    def _job_scale(self, job):
+        """(draft_scale, gray) renderu zlecenia - szary szkic bez trybu progresywnego ma pełną rozdzielczość."""
+        if not job.draft:
+            return 1.0, False
+        return (self.DRAFT_SCALE if self.progressive or not job.gray else 1.0), job.gray
+
+    def _report_timeout(self, job, document_id, seconds, counts):
+        """Loguje przerwany render i przekazuje go do on_timeout (przez _poll)."""
+        if job.generation != self._generation or self._stopped:
+            return
+        log_complex_page(document_id, job.page_index, seconds, counts, interrupted=True)
+        self._timeouts.put((job.generation, job.key, job.page_index, seconds))
+
+    def _render_in_thread(self, job):
+        """
+        Render w wątku roboczym (backend "threads"). Zwraca (image, final, sekundy renderu
+        ostrej miniatury albo None) lub None, gdy render przerwano (strona czeka na render na żądanie).
+        """
+        doc, page_index = self._get_document(job)
+        if doc is None or page_index >= len(doc):
+            return None, True, None
+        page = doc.load_page(page_index)
+        image = None
+        final = True
+        disk_key = None
+        # Jakość odczytana raz - render i klucz cache na dysku muszą jej odpowiadać,
+        # nawet jeśli wątek GUI zmieni ją w trakcie (set_quality)
+        aa_level, quality_tag = self.aa_level, self._quality_tag()
+        if self.disk_cache is not None and self.disk_cache.enabled and self._local.document_id:
+            digest = job.content_digest or page_content_digest(doc, page)
+            disk_key = ThumbnailDiskCache.make_key(
+                self._local.document_id, f"{digest}-{quality_tag}", job.width, job.max_height)
+            image = self.disk_cache.get(disk_key)
+            if image is not None:
+                return image, True, None
+        render_started = time.perf_counter()
+        counts = None
+        if self._needs_isolation(job, doc, page):
+            # Ciężka strona: jeden ostry render w procesie roboczym wątku, z limitem czasu
+            isolated = self.render_isolated(
+                job.page_index, job.width, job.max_height, aa_level=aa_level,
+                timeout=None if job.unbounded else self.time_budget_ms / 1000, generation=job.generation,
+                is_cancelled=lambda: self._stopped or job.generation != self._generation)
+            if isolated is None:
+                return None
+            image, render_seconds, counts = isolated
+            render_started = time.perf_counter() - render_seconds
+            if image is None:
+                self._report_timeout(job, self._local.document_id, render_seconds, counts)
+                return None
+        else:
+            draft_scale, gray = self._job_scale(job)
+            displaylist = self._get_displaylist(job, page)
+            with aa_level_rendering(aa_level):
+                image = render_page_thumbnail(displaylist, job.width, job.max_height,
+                                              draft_scale=draft_scale, gray=gray)
+            final = not job.draft
+        render_seconds = time.perf_counter() - render_started
+        if final and disk_key is not None:
+            self.disk_cache.put(disk_key, image)
+        if self.time_budget_ms and render_seconds * 1000 > self.time_budget_ms:
+            log_complex_page(self._local.document_id, job.page_index, render_seconds,
+                             counts or count_content_operators(doc, page))
+        return image, final, render_seconds if final else None
+
+    def _render_in_process(self, job):
+        """
+        Render w procesie roboczym (backend "processes"): wątek tylko zleca render
+        i czeka (bez GIL), a piksele odbiera z pamięci współdzielonej. Budżet czasu
+        obejmuje każdy render - po jego przekroczeniu proces jest zatrzymywany.
+        """
+        process = self._worker_process()
+        with self._lock:
+            source = self._page_source(job.generation, job.page_index)
+            if source is None:
+                return None, True, None
+            key, filepath, data, password, page_index = source
+            document_id = self._source[3]
+            if key[0] == "base":
+                source_name, source_size = (None, 0) if filepath else self._source_block_for(data, "base")
+        if key[0] == "overlay":
+            # Strona zmieniona od ustawienia bazy - proces roboczy ma otwartą tylko bazę
+            return self._render_in_thread(job)
+        # Proces trzyma bazę między generacjami - otwiera ją od nowa dopiero po zmianie bazy
+        if not process.open(key, filepath, source_name, source_size, password):
+            return None, True, None
+
+        disk_key = None
+        aa_level, annots, quality_tag = self.aa_level, self.annots, self._quality_tag()
+        if self.disk_cache is not None and self.disk_cache.enabled and document_id and job.content_digest:
+            disk_key = ThumbnailDiskCache.make_key(
+                document_id, f"{job.content_digest}-{quality_tag}", job.width, job.max_height)
+            image = self.disk_cache.get(disk_key)
+            if image is not None:
+                return image, True, None
+
+        draft_scale, gray = self._job_scale(job)
+        timeout = None if job.unbounded or not self.time_budget_ms else self.time_budget_ms / 1000
+        is_cancelled = lambda: self._stopped or job.generation != self._generation
+        try:
+            rendered = process.render(page_index, job.width, job.max_height, draft_scale, gray,
+                                      annots, aa_level, timeout, is_cancelled)
+        except RenderProcessError as e:
+            # Awaria MuPDF zabiła tylko proces roboczy - strona dostaje placeholder z renderem na żądanie
+            print(f"[RENDER] Strona {job.page_index + 1}: {e}")
+            self._report_timeout(job, document_id, 0.0, {})
+            return None
+        if rendered is None:
+            if is_cancelled():
+                return None
+            # Liczniki operatorów z nowego procesu (poprzedni został zatrzymany)
+            counts = {}
+            try:
+                if process.open(key, filepath, source_name, source_size, password):
+                    counts = process.counts(page_index)
+            except Exception:
+                pass
+            self._report_timeout(job, document_id, timeout, counts)
+            return None
+        image, seconds = rendered
+        if self.time_budget_ms and seconds * 1000 > self.time_budget_ms:
+            log_complex_page(document_id, job.page_index, seconds, process.counts(page_index))
+        final = not job.draft
+        if final and disk_key is not None:
+            self.disk_cache.put(disk_key, image)
+        return image, final, seconds if final else None
+
+    def _worker_process(self):
+        """Proces roboczy bieżącego wątku (tworzony przy pierwszym użyciu, zamykany przez close())."""
+        process = getattr(self._local, "process", None)
+        if process is None:
+            process = self._local.process = RenderProcess()
+            with self._lock:
+                self._processes.append(process)
+        return process
+
+    def render_isolated(self, page_index, width, max_height=None, aa_level=None, timeout=None,
+                        generation=None, is_cancelled=None):
+        """
+        Renderuje ostrą miniaturę strony w procesie roboczym wątku wywołującego - tym samym
+        RenderProcess, którego używa backend "processes" - więc ciężka strona nie uruchamia
+        nowego procesu. PyMuPDF trzyma GIL przez cały render, a proces można porzucić:
+        po przekroczeniu timeout (s) lub anulowaniu (is_cancelled()) jest zabijany,
+        a następne zlecenie uruchamia nowy.
+
+        Zwraca (image, sekundy renderu, liczniki operatorów) - image=None po przekroczeniu
+        limitu lub anulowaniu - albo None, gdy źródło generacji generation jest nieaktualne.
+        """
+        process = self._worker_process()
+        with self._lock:
+            source = self._page_source(self._generation if generation is None else generation, page_index)
+            if source is None:
+                return None
+            key, filepath, data, password, source_index = source
+            source_name, source_size = (None, 0) if filepath else self._source_block_for(data, key[0])
+        if aa_level is None:
+            aa_level = self.aa_level
+        if not process.open(key, filepath, source_name, source_size, password):
+            return None, 0.0, {}
+        # Liczniki przed renderem - po przekroczeniu limitu proces już ich nie poda
+        counts = process.counts(source_index)
+        rendered = process.render(source_index, width, max_height, annots=self.annots, aa_level=aa_level,
+                                  timeout=timeout, is_cancelled=is_cancelled)
+        if rendered is None:
+            return None, timeout or 0.0, counts
+        image, seconds = rendered
+        return image, seconds, counts
+
+    def _source_block_for(self, data, kind):
+        """
+        Blok pamięci współdzielonej z bajtami źródła - jeden na rodzaj źródła ("base" lub
+        "overlay"), wspólny dla wszystkich procesów roboczych. Pod blokadą.
+        """
+        entry = self._source_blocks.get(kind)
+        if entry is None or entry[0] is not data:
+            self._release_source_block(kind)
+            block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+            block.buf[:len(data)] = data
+            entry = self._source_blocks[kind] = (data, block)
+        return entry[1].name, len(data)
+
+    def _release_source_block(self, kind):
+        entry = self._source_blocks.pop(kind, None)
+        if entry is not None:
+            entry[1].close()
+            entry[1].unlink()
+
+    def _needs_isolation(self, job, doc, page):
+        """Czy stronę renderować w procesie roboczym (budżet czasu i treść ponad COMPLEX_CONTENT_BYTES)."""
+        if not self.time_budget_ms and not job.unbounded:
+            return False
+        if self._source is None:
+            return False
+        return sum(len(stream) for stream in page_content_streams(doc, page)) > COMPLEX_CONTENT_BYTES
+
+    def _schedule_poll(self):
+        if self._poll_id is None:
+            self._poll_id = self.master.after(self.POLL_INTERVAL_MS, self._poll)
+
+    def _poll(self):
+        self._poll_id = None
+        while True:
+            try:
+                generation, key, page_index, elapsed = self._timeouts.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self._generation:
+                continue
+            self._pending.discard((generation, key))
+            self.timed_out += 1
+            if self.on_timeout is not None:
+                self.on_timeout(key, page_index, elapsed)
+        for _ in range(self.MAX_RESULTS_PER_POLL):
+            try:
+                generation, key, page_index, image, final, latency, color_spread, render_seconds = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self._generation:
+                continue
+            if final:
+                self._pending.discard((generation, key))
+                self.completed += 1
+                self.last_latency_ms = latency * 1000
+                if self.completed == 1:
+                    self.avg_latency_ms = self.last_latency_ms
+                else:
+                    self.avg_latency_ms += self.LATENCY_SMOOTHING * (self.last_latency_ms - self.avg_latency_ms)
+            if color_spread is not None:
+                self.on_color(key, *color_spread)
+            if render_seconds is not None and self.on_render_time is not None:
+                self.on_render_time(key, render_seconds)
+            if image is not None:
+                self.on_result(key, page_index, image, final)
+        if self._pending or self._running or not self._results.empty():
+            self._schedule_poll()
+        if self.on_stats is not None:
+            self.on_stats(self.stats())
+
+    def shutdown(self):
+        """Zatrzymuje odpytywanie kolejki i wątki robocze (bez czekania na bieżące zlecenia)."""
+        if self._poll_id is not None:
+            try:
+                self.master.after_cancel(self._poll_id)
+            except Exception:
+                pass
+            self._poll_id = None
+        self.set_source(None)
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            processes = list(self._processes)
+        for process in processes:
+            process.close()
+
+# ====================================================================
+# KLASA: INDEKS METADANYCH STRON
+# ====================================================================
+
+# Popularne formaty (dopuszczamy tolerancję ±5mm)
+PAGE_SIZE_FORMATS_MM = {
+    "A6": (105, 148),
+    "A5": (148, 210),
+    "A4": (210, 297),
+    "A3": (297, 420),
+    "A2": (420, 594),
+    "A1": (594, 841),
+    "A0": (841, 1189),
+    # Format B (ISO 216)
+    "B0": (1000, 1414),
+    "B1": (707, 1000),
+    "B2": (500, 707),
+    "B3": (353, 500),
+    "B4": (250, 353),
+    "B5": (176, 250),
+    "B6": (125, 176),
+    "Letter": (216, 279),   # 8.5 × 11 in
+    "Legal": (216, 356),    # 8.5 × 14 in
+    "Tabloid": (279, 432),  # 11 × 17 in
+}
+
+
+def page_size_label(width_pt, height_pt):
+    """Etykieta formatu strony, np. "A4", "A4 (Poziom)" lub "210 x 250 mm"."""
+    width_mm = round(width_pt / 72 * 25.4)
+    height_mm = round(height_pt / 72 * 25.4)
+    # Tolerancja ±5mm
+    tol = 5
+    for name, (fw, fh) in PAGE_SIZE_FORMATS_MM.items():
+        if (abs(width_mm - fw) <= tol and abs(height_mm - fh) <= tol) or \
+           (abs(width_mm - fh) <= tol and abs(height_mm - fw) <= tol):
+            if abs(width_mm - fw) < abs(width_mm - fh):
+                return name
+            else:
+                return f"{name} (Poziom)"
+    return f"{width_mm} x {height_mm} mm"
+
+
+class PageMetadataIndex:
+    """
+    Zwarty indeks geometrii stron dokumentu trzymany w tablicach (array).
+
+    Dla każdej pozycji przechowuje xref strony, wymiary page.rect (po obrocie),
+    obrót i identyfikator etykiety formatu, dzięki czemu etykiety, zaznaczanie
+    wg orientacji czy analiza nie muszą wołać load_page dla każdej strony.
+
+    Indeks wypełniany jest raz przy pierwszym użyciu dokumentu. Po zmianach
+    struktury (mark_dirty) sync() dopasowuje pozycje po xrefach i wczytuje tylko
+    nowe strony; zmiany treści strony zgłasza się przez update_page().
+    Podmiana obiektu dokumentu (cofnij/ponów, operacje przez pypdf) oznacza
+    pełną przebudowę.
+
+    Oprócz geometrii indeks zbiera wynik wykrywania koloru (max_channel_difference)
+    - produkt uboczny renderowania miniatur - i czas ostatniego renderu miniatury
+    (profil stron). Oba są kluczowane odciskiem treści strony, więc przeżywają
+    przestawienia stron i cofnij/ponów, a edycja treści daje nowy odcisk bez wyniku.
+    """
+
+    def __init__(self):
+        self._document = None
+        self._dirty = False
+        self._color_spreads: Dict[str, Tuple[Optional[int], int]] = {}
+        self._render_times: Dict[str, float] = {}
+        self._clear_arrays()
+
+    def _clear_arrays(self):
+        self.xrefs = array('q')
+        self.widths = array('d')
+        self.heights = array('d')
+        self.rotations = array('h')
+        self.label_ids = array('i')
+        self._labels: List[str] = []
+        self._label_ids: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.xrefs)
+
+    def mark_dirty(self):
+        """Zgłasza możliwą zmianę struktury dokumentu - następny sync() uzgodni pozycje."""
+        self._dirty = True
+
+    def sync(self, doc):
+        """Uzgadnia indeks z dokumentem (pełna przebudowa tylko po podmianie dokumentu)."""
+        if doc is None:
+            self._document = None
+            self._color_spreads.clear()
+            self._render_times.clear()
+            self._clear_arrays()
+            return
+        if doc is not self._document:
+            self._document = doc
+            self._clear_arrays()
+            for i in range(len(doc)):
+                self._append_page(doc, i)
+        elif self._dirty or len(self.xrefs) != len(doc):
+            old_positions = {xref: i for i, xref in enumerate(self.xrefs)}
+            xrefs, widths, heights = array('q'), array('d'), array('d')
+            rotations, label_ids = array('h'), array('i')
+            for i in range(len(doc)):
+                xref = doc.page_xref(i)
+                j = old_positions.get(xref)
+                if j is None:
+                    page = doc.load_page(i)
+                    rect = page.rect
+                    width, height, rotation = rect.width, rect.height, page.rotation
+                    label_id = self._label_id(page_size_label(width, height))
+                else:
+                    width, height = self.widths[j], self.heights[j]
+                    rotation, label_id = self.rotations[j], self.label_ids[j]
+                xrefs.append(xref)
+                widths.append(width)
+                heights.append(height)
+                rotations.append(rotation)
+                label_ids.append(label_id)
+            self.xrefs, self.widths, self.heights = xrefs, widths, heights
+            self.rotations, self.label_ids = rotations, label_ids
+        self._dirty = False
+
+    def update_page(self, doc, page_index):
+        """Wczytuje ponownie metadane jednej strony (po zmianie jej treści, obrotu, rozmiaru)."""
+        if doc is not self._document or self._dirty or len(self.xrefs) != len(doc):
+            self.sync(doc)
+        if not 0 <= page_index < len(self.xrefs):
+            return
+        page = doc.load_page(page_index)
+        rect = page.rect
+        self.xrefs[page_index] = page.xref
+        self.widths[page_index] = rect.width
+        self.heights[page_index] = rect.height
+        self.rotations[page_index] = page.rotation
+        self.label_ids[page_index] = self._label_id(page_size_label(rect.width, rect.height))
+
+    def _append_page(self, doc, page_index):
+        page = doc.load_page(page_index)
+        rect = page.rect
+        self.xrefs.append(page.xref)
+        self.widths.append(rect.width)
+        self.heights.append(rect.height)
+        self.rotations.append(page.rotation)
+        self.label_ids.append(self._label_id(page_size_label(rect.width, rect.height)))
+
+    def _label_id(self, label):
+        label_id = self._label_ids.get(label)
+        if label_id is None:
+            label_id = len(self._labels)
+            self._labels.append(label)
+            self._label_ids[label] = label_id
+        return label_id
+
+    def size(self, page_index):
+        """Wymiary strony w punktach (page.rect, uwzględnia obrót)."""
+        return self.widths[page_index], self.heights[page_index]
+
+    def size_mm(self, page_index):
+        return (round(self.widths[page_index] / 72 * 25.4),
+                round(self.heights[page_index] / 72 * 25.4))
+
+    def rotation(self, page_index):
+        return self.rotations[page_index]
+
+    def size_label(self, page_index):
+        return self._labels[self.label_ids[page_index]]
+
+    def is_landscape(self, page_index):
+        """Strona pozioma: szerokość większa niż wysokość."""
+        return self.widths[page_index] > self.heights[page_index]
+
+    def is_portrait(self, page_index):
+        return self.heights[page_index] > self.widths[page_index]
+
+    def max_aspect(self):
+        """Największy stosunek wysokości do szerokości w dokumencie (0.0 dla pustego)."""
+        return max((h / w for w, h in zip(self.widths, self.heights) if w > 0), default=0.0)
+
+    def set_color_spread(self, fingerprint, spread, samples=None):
+        """Zapisuje największą różnicę kanałów RGB (z samples próbek) dla treści strony o danym odcisku."""
+        if spread is not None:
+            self._color_spreads[fingerprint] = (samples, spread)
+
+    def copy_color_spread(self, source_fingerprint, fingerprint):
+        """Przenosi wynik wykrywania koloru na kopię treści strony (kopia ma nowe xrefy, więc inny odcisk)."""
+        stored = self._color_spreads.get(source_fingerprint)
+        if stored is not None:
+            self._color_spreads[fingerprint] = stored
+
+    def color_spread(self, fingerprint, samples=None):
+        """
+        Największa różnica kanałów RGB treści strony albo None, jeśli strona nie była
+        jeszcze renderowana lub wynik policzono z inną liczbą próbek.
+        """
+        stored = self._color_spreads.get(fingerprint)
+        if stored is None or stored[0] != samples:
+            return None
+        return stored[1]
+
+    def set_render_time(self, fingerprint, seconds):
+        """Zapisuje czas renderu miniatury treści strony o danym odcisku."""
+        self._render_times[fingerprint] = seconds
+
+    def render_time(self, fingerprint):
+        """Czas ostatniego renderu miniatury (s) albo None."""
+        return self._render_times.get(fingerprint)
+
+# ====================================================================
+# KLASA: KROK HISTORII COFNIJ/PONÓW
+# ====================================================================
+
+UNDO_COMPRESS_MIN_BYTES = 1024  # Mniejsze bloki (głównie słowniki obiektów) zostają w pamięci bez zmian
+UNDO_COMPRESS_LEVEL = 1  # zlib: szybka kompresja w tle, dekompresja przy cofaniu w milisekundach
+
+
+class StoredBlob:
+    """
+    Blok danych w UndoBlobStore; żyje tak długo, jak odwołuje się do niego jakiś krok historii.
+
+    state jest podmieniany w całości (odczyt w wątku GUI jest bezpieczny w trakcie
+    porządkowania w tle): ("raw", dane), ("zlib", spakowane) albo
+    ("file", UndoSpillFile, offset, długość, czy spakowane).
+    """
+    __slots__ = ("state", "size", "is_text", "generation", "incompressible", "__weakref__")
+
+    def __init__(self, data, size, generation):
+        self.state = ("raw", data)
+        self.size = size
+        self.is_text = isinstance(data, str)
+        self.generation = generation  # Numer ostatniej migawki, która użyła bloku
+        self.incompressible = False
+
+    @property
+    def data(self):
+        state = self.state
+        if state[0] == "raw":
+            return state[1]
+        if state[0] == "zlib":
+            raw = zlib.decompress(state[1])
+        else:
+            _, spill_file, offset, length, packed = state
+            raw = spill_file.read(offset, length)
+            if packed:
+                raw = zlib.decompress(raw)
+        return raw.decode("utf-8", "surrogatepass") if self.is_text else raw
+
+    @property
+    def memory_bytes(self):
+        """Bajty zajmowane w pamięci (0 dla bloku zrzuconego na dysk)."""
+        state = self.state
+        if state[0] == "raw":
+            return self.size
+        if state[0] == "zlib":
+            return len(state[1])
+        return 0
+
+
+class UndoSpillFile:
+    """Plik tymczasowy z blokami historii zrzuconymi z pamięci, czytany przez mmap; znika razem z ostatnim blokiem."""
+
+    def __init__(self, chunks):
+        self._file = tempfile.TemporaryFile(prefix="pdfeditor_undo_")
+        self.offsets = []
+        for chunk in chunks:
+            self.offsets.append(self._file.tell())
+            self._file.write(chunk)
+        self._file.flush()
+        self.size = self._file.tell()
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, offset, length):
+        return self._map[offset:offset + length]
+
+
+class UndoBlobStore:
+    """
+    Magazyn danych historii cofnij/ponów adresowany skrótem treści (BLAKE2b).
+
+    Ten sam obiekt PDF (słownik lub surowy strumień: obraz, font, treść strony)
+    zapisany w wielu krokach historii jest przechowywany raz - kroki trzymają
+    referencje do wspólnych StoredBlob. Magazyn trzyma je słabo, więc blok znika
+    razem z ostatnim krokiem, który go używał (przycięcie stosu, czyszczenie redo).
+
+    Wątek magazynu zapisuje migawki zgłoszone przez submit(), a po każdej z nich
+    pakuje (zlib) bloki używane tylko przez starsze stany, a gdy pamięć historii
+    przekracza budget_bytes - zrzuca najstarsze bloki do plików tymczasowych
+    mapowanych w pamięć (UndoSpillFile).
+    """
+    SPILL_TARGET_RATIO = 0.8  # Po przekroczeniu budżetu zrzucaj do 80% budżetu
+    INCOMPRESSIBLE_RATIO = 0.9  # Bloki, które kurczą się mniej (JPEG, strumienie Flate), nie są pakowane
+
+    def __init__(self, budget_bytes=512 * 1024 * 1024):
+        self.budget_bytes = max(0, int(budget_bytes))
+        self._blobs = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._spill_files = weakref.WeakSet()
+        self._jobs = queue.Queue()  # Migawki do zapisu w tle; None - porządkowanie (kompresja, dysk)
+        self._thread = None
+        self._closed = False
+
+    def put(self, data):
+        """Zwraca StoredBlob z danymi (bytes lub str) - istniejący, jeśli treść już jest w magazynie."""
+        raw = data.encode("utf-8", "surrogatepass") if isinstance(data, str) else data
+        digest = hashlib.blake2b(raw, digest_size=20).digest()
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None:
+                blob = StoredBlob(data, len(raw), self._generation)
+                self._blobs[digest] = blob
+            else:
+                blob.generation = self._generation
+        return blob
+
+    def captured(self):
+        """Koniec zapisu migawki - bloki starszych stanów mogą zostać spakowane lub zrzucone w tle."""
+        with self._lock:
+            self._generation += 1
+        self._start_worker()
+        self._jobs.put(None)
+
+    def submit(self, snapshot, source):
+        """Kolejkuje zapis migawki w wątku magazynu (w kolejności zgłoszeń)."""
+        self._start_worker()
+        self._jobs.put((snapshot, source))
+
+    def close(self):
+        """Zatrzymuje wątek magazynu (pliki tymczasowe znikają razem z blokami)."""
+        self._closed = True
+        self._jobs.put(None)
+
+    def _start_worker(self):
+        with self._lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._worker_loop, name="UndoBlobStore", daemon=True)
+                self._thread.start()
+
+    def _live_blobs(self):
+        while True:
+            try:
+                with self._lock:
+                    return list(self._blobs.values()), self._generation
+            except RuntimeError:
+                continue  # Blok zwolniony w trakcie kopiowania listy - spróbuj ponownie
+
+    def _worker_loop(self):
+        while True:
+            job = self._jobs.get()
+            if self._closed:
+                return
+            if job is not None:
+                snapshot, source = job
+                snapshot._capture_in_background(source, self)
+                # Nie trzymaj migawki i kopii dokumentu w czasie oczekiwania na kolejne zadanie
+                job = snapshot = source = None
+                continue
+            if not self._jobs.empty():
+                continue  # Porządkowanie po ostatniej migawce z kolejki
+            try:
+                self._compress_old_blobs()
+                self._spill_over_budget()
+            except Exception as e:
+                print(f"[UNDO] Błąd porządkowania historii zmian: {e}")
+
+    def _compress_old_blobs(self):
+        blobs, generation = self._live_blobs()
+        for blob in blobs:
+            if self._closed or not self._jobs.empty():
+                return  # Nowa migawka ma pierwszeństwo - porządkowanie wróci po niej
+            # Bloki ostatniej migawki zostają rozpakowane - to one są przywracane najczęściej
+            if blob.generation >= generation - 1 or blob.incompressible or blob.size < UNDO_COMPRESS_MIN_BYTES:
+                continue
+            state = blob.state
+            if state[0] != "raw":
+                continue
+            raw = state[1].encode("utf-8", "surrogatepass") if blob.is_text else state[1]
+            packed = zlib.compress(raw, UNDO_COMPRESS_LEVEL)
+            if len(packed) > blob.size * self.INCOMPRESSIBLE_RATIO:
+                blob.incompressible = True
+            elif blob.state is state:
+                blob.state = ("zlib", packed)
+
+    def _spill_over_budget(self):
+        blobs, _ = self._live_blobs()
+        memory = sum(blob.memory_bytes for blob in blobs)
+        if memory <= self.budget_bytes:
+            return
+        to_free = memory - int(self.budget_bytes * self.SPILL_TARGET_RATIO)
+        candidates = sorted((blob for blob in blobs if blob.state[0] != "file" and blob.size >= UNDO_COMPRESS_MIN_BYTES),
+                            key=lambda blob: blob.generation)
+        chosen = []
+        for blob in candidates:
+            if to_free <= 0:
+                break
+            state = blob.state
+            if state[0] == "raw":
+                chunk = state[1].encode("utf-8", "surrogatepass") if blob.is_text else state[1]
+            else:
+                chunk = state[1]
+            chosen.append((blob, state, chunk))
+            to_free -= len(chunk)
+        if not chosen:
+            return
+        spill_file = UndoSpillFile(chunk for _, _, chunk in chosen)
+        self._spill_files.add(spill_file)
+        for (blob, state, chunk), offset in zip(chosen, spill_file.offsets):
+            if blob.state is state:
+                blob.state = ("file", spill_file, offset, len(chunk), state[0] == "zlib")
+
+    @property
+    def nbytes(self):
+        """Łączny rozmiar unikalnych danych w magazynie przed kompresją (bajty)."""
+        return sum(blob.size for blob in self._live_blobs()[0])
+
+    def stats(self):
+        """Podział danych historii: w pamięci (rozpakowane/spakowane) i na dysku."""
+        stats = {"raw_count": 0, "raw_bytes": 0, "packed_count": 0, "packed_bytes": 0, "packed_size": 0,
+                 "file_count": 0, "file_size": 0}
+        for blob in self._live_blobs()[0]:
+            state = blob.state
+            if state[0] == "raw":
+                stats["raw_count"] += 1
+                stats["raw_bytes"] += blob.size
+            elif state[0] == "zlib":
+                stats["packed_count"] += 1
+                stats["packed_bytes"] += len(state[1])
+                stats["packed_size"] += blob.size
+            else:
+                stats["file_count"] += 1
+                stats["file_size"] += blob.size
+        stats["disk_bytes"] = sum(spill_file.size for spill_file in list(self._spill_files))
+        return stats
+
+
+class DocumentSnapshot:
+    """
+    Migawka dokumentu jako lista obiektów PDF (słownik + surowy strumień) w UndoBlobStore.
+
+    Kolejne migawki tego samego dokumentu różnią się tylko zmienionymi obiektami,
+    więc zajmują tyle, ile faktycznie się zmieniło. open() odtwarza dokument
+    z tymi samymi numerami obiektów (xref), więc kroki stronowe (UndoStep) sprzed
+    migawki nadal do niego pasują. Strumienie są przepisywane bez dekompresji.
+
+    capture_async() przyjmuje szybką kopię (bajty z doc.tobytes() albo osobny
+    dokument) i rozkłada ją na obiekty w wątku magazynu - edycja nie czeka na
+    liczenie skrótów. open() i blobs() czekają na koniec zapisu (wait()).
+    """
+    __slots__ = ("texts", "streams", "trailer", "error", "_ready")
+
+    SKIPPED_TYPES = ("/ObjStm", "/XRef")  # Struktury pliku - odtwarzany dokument ich nie potrzebuje
+
+    def __init__(self):
+        self.texts = ()
+        self.streams = ()
+        self.trailer = ()
+        self.error = None
+        self._ready = None  # threading.Event zapisu w tle (None - migawka gotowa)
+
+    @classmethod
+    def capture_async(cls, source, store):
+        """
+        Zapisuje migawkę w wątku magazynu. source to bajty PDF z zachowanymi numerami
+        obiektów (doc.tobytes() bez garbage) albo dokument, którego nikt inny już
+        nie używa - zostanie zamknięty po zapisie.
+        """
+        snapshot = cls()
+        snapshot._ready = threading.Event()
+        store.submit(snapshot, source)
+        return snapshot
+
+    def _fill(self, doc, store):
+        texts = []
+        streams = []
+        for xref in range(1, doc.xref_length()):
+            stream = None
+            if doc.xref_is_stream(xref):
+                if doc.xref_get_key(xref, "Type")[1] in self.SKIPPED_TYPES:
+                    texts.append(store.put("null"))
+                    streams.append(None)
+                    continue
+                stream = store.put(doc.xref_stream_raw(xref) or b"")
+            texts.append(store.put(doc.xref_object(xref, compressed=True)))
+            streams.append(stream)
+        store.captured()
+        trailer = []
+        for key in ("Root", "Info"):
+            kind, value = doc.xref_get_key(-1, key)
+            if kind == "xref":
+                trailer.append((key, value))
+        self.texts, self.streams, self.trailer = tuple(texts), tuple(streams), tuple(trailer)
+
+    def _capture_in_background(self, source, store):
+        """Wywoływane przez wątek magazynu."""
+        try:
+            doc = fitz.open("pdf", source) if isinstance(source, bytes) else source
+            try:
+                self._fill(doc, store)
+            finally:
+                doc.close()
+        except Exception as e:
+            self.error = e
+        finally:
+            self._ready.set()
+
+    @property
+    def ready(self):
+        return self._ready is None or self._ready.is_set()
+
+    def wait(self):
+        """Czeka na koniec zapisu w tle; błąd zapisu zgłasza jako RuntimeError."""
+        if self._ready is not None:
+            self._ready.wait()
+        if self.error is not None:
+            raise RuntimeError(f"nie udało się zapisać stanu dokumentu w historii: {self.error}")
+
+    def blobs(self):
+        """Wszystkie bloki migawki (słowniki i strumienie)."""
+        self.wait()
+        yield from self.texts
+        yield from (stream for stream in self.streams if stream is not None)
+
+    def open(self):
+        """Odtwarza dokument (nowy obiekt fitz.Document)."""
+        self.wait()
+        doc = fitz.open()
+        while doc.xref_length() <= len(self.texts):
+            doc.get_new_xref()
+        for xref, (text, stream) in enumerate(zip(self.texts, self.streams), start=1):
+            doc.update_object(xref, text.data)
+            if stream is not None:
+                doc.update_stream(xref, stream.data, compress=False)
+                # update_stream bez kompresji usuwa /Filter - przywróć oryginalny słownik
+                doc.update_object(xref, text.data)
+        for key, value in self.trailer:
+            doc.xref_set_key(-1, key, value)
+        return doc
+
+
+class UndoStep:
+    """
+    Krok historii cofnij/ponów zapisany na poziomie stron zamiast kopii całego pliku.
+
+    capture(doc, store, pages) zapamiętuje kolejność stron (xrefy), ich klucze /Rotate
+    oraz - jako mały PDF - tylko strony z pages, które operacja usunie lub zmieni
+    w miejscu. Strony dodane, przestawione lub obrócone nie wymagają kopii: apply()
+    usuwa strony spoza zapisanej kolejności, wstawia zapisane z kopii, przywraca
+    kolejność (doc.select) i obroty. Zwraca krok odwrotny, więc ten sam mechanizm
+    obsługuje cofanie i ponawianie.
+
+    Strona zmieniona w miejscu (ten sam xref przed i po operacji) jest przywracana
+    w tym samym obiekcie strony: capture() zapamiętuje słownik strony i obiekty jej
+    treści (/Contents, /Resources) z ich numerami, a restore() zapisuje je z powrotem
+    (surowe strumienie bierze z kopii strony). Cele zakładek i odnośników wskazujące
+    stronę pozostają ważne, a fonty i obrazy nie są kopiowane przy każdym cofnięciu.
+
+    Strona wstawiona z kopii (np. usunięta przez operację) dostaje nowy xref. Kroki dalej na tym samym stosie
+    opisują stan, w którym strona miała stary numer - wywołujący przenumerowuje je
+    (renumber) słownikiem zwróconym przez apply().
+
+    capture(doc, store) bez pages zapisuje pełną migawkę dokumentu (punkt kontrolny)
+    - dla operacji, które budują dokument od nowa (numery xref tracą wtedy znaczenie).
+    Migawka zachowuje numery obiektów, więc kroki stronowe sprzed punktu kontrolnego
+    pozostają poprawne po jego cofnięciu. Migawki i kopie stron są zapisywane jako
+    DocumentSnapshot we wspólnym UndoBlobStore - niezmienione obiekty (fonty, obrazy,
+    treści stron) są przechowywane raz dla całej historii.
+    """
+    __slots__ = ("xrefs", "rotations", "page_xrefs", "saved_pages", "page_objects", "snapshot")
+
+    NO_ROTATE = -1  # Strona bez klucza /Rotate (obrót dziedziczony lub 0)
+    UNKNOWN_ROTATE = -2  # /Rotate w nietypowej postaci - nie jest przywracany
+    in_place = False  # Krok może zmienić liczbę i kolejność stron (zob. JournalStep)
+
+    def __init__(self):
+        self.xrefs = None
+        self.rotations = None
+        self.page_xrefs = ()  # xrefy stron zapisanych w saved_pages (w tej samej kolejności)
+        self.saved_pages = None
+        # Dla stron z page_xrefs: (słownik strony, obiekty treści) do przywrócenia w miejscu albo None
+        self.page_objects = ()
+        self.snapshot = None
+
+    @classmethod
+    def capture(cls, doc, store, pages=None):
+        """Zapisuje stan dokumentu przed operacją; pages=None oznacza pełną migawkę."""
+        step = cls()
+        if pages is None:
+            # Szybka kopia w pamięci (bez garbage - numery obiektów bez zmian), reszta w tle
+            step.snapshot = DocumentSnapshot.capture_async(doc.tobytes(garbage=0), store)
+            return step
+        step.xrefs = array('q', (doc.page_xref(i) for i in range(len(doc))))
+        step.rotations = array('h', (cls._read_rotate(doc, xref) for xref in step.xrefs))
+        pages = sorted(set(pages))
+        if pages:
+            pages_doc = fitz.open()
+            for page_index in pages:
+                pages_doc.insert_pdf(doc, from_page=page_index, to_page=page_index)
+            step.page_xrefs = tuple(step.xrefs[page_index] for page_index in pages)
+            step.page_objects = tuple(cls._capture_page_objects(doc, xref, pages_doc, pages_doc.page_xref(k), store)
+                                      for k, xref in enumerate(step.page_xrefs))
+            step.saved_pages = DocumentSnapshot.capture_async(pages_doc, store)
+        return step
+
+    @staticmethod
+    def _capture_page_objects(doc, xref, copy, copy_xref, store):
+        """
+        Słownik strony xref i obiekty jej treści (wszystko, do czego prowadzą /Contents
+        i /Resources) jako krotki (xref, słownik, xref strumienia w kopii strony albo 0).
+        Odwołania w oryginale i w kopii (insert_pdf zachowuje kolejność kluczy) są
+        parowane po kolei; None, jeśli struktura kopii nie odpowiada oryginałowi.
+        """
+        pairs = []
+        for key in ("Contents", "Resources"):
+            kind, value = doc.xref_get_key(xref, key)
+            copy_kind, copy_value = copy.xref_get_key(copy_xref, key)
+            refs = PDF_REF_PATTERN.findall(value.encode())
+            copy_refs = PDF_REF_PATTERN.findall(copy_value.encode())
+            if kind != copy_kind or len(refs) != len(copy_refs):
+                return None
+            pairs.extend(zip(refs, copy_refs))
+        paired = {}
+        objects = []
+        while pairs:
+            ref, copy_ref = (int(number) for number in pairs.pop())
+            if ref in paired:
+                if paired[ref] != copy_ref:
+                    return None
+                continue
+            paired[ref] = copy_ref
+            if doc.xref_get_key(ref, "Type")[1] in ("/Page", "/Pages"):
+                continue  # Odwołanie do drzewa stron - nie należy do treści strony
+            text = doc.xref_object(ref, compressed=True)
+            refs = PDF_REF_PATTERN.findall(text.encode())
+            copy_refs = PDF_REF_PATTERN.findall(copy.xref_object(copy_ref, compressed=True).encode())
+            if len(refs) != len(copy_refs) or doc.xref_is_stream(ref) != copy.xref_is_stream(copy_ref):
+                return None
+            pairs.extend(zip(refs, copy_refs))
+            objects.append((ref, store.put(text), copy_ref if doc.xref_is_stream(ref) else 0))
+        return store.put(doc.xref_object(xref, compressed=True)), tuple(objects)
+
+    @classmethod
+    def _read_rotate(cls, doc, xref):
+        kind, value = doc.xref_get_key(xref, "Rotate")
+        if kind == "null":
+            return cls.NO_ROTATE
+        if kind == "int":
+            return int(value)
+        return cls.UNKNOWN_ROTATE
+
+    @property
+    def ready(self):
+        """False, dopóki migawka kroku jest zapisywana w tle."""
+        return all(snapshot is None or snapshot.ready for snapshot in (self.snapshot, self.saved_pages))
+
+    def blobs(self):
+        """Bloki magazynu, do których odwołuje się krok (migawka lub kopie stron)."""
+        for snapshot in (self.snapshot, self.saved_pages):
+            if snapshot is not None:
+                yield from snapshot.blobs()
+        for page_objects in self.page_objects:
+            if page_objects is not None:
+                yield page_objects[0]
+                yield from (text for _, text, _ in page_objects[1])
+
+    def renumber(self, xref_map):
+        """Zamienia xrefy stron wg xref_map {stary: nowy} (po wstawieniu stron z kopii)."""
+        if self.snapshot is not None or not xref_map:
+            return
+        self.xrefs = array('q', (xref_map.get(xref, xref) for xref in self.xrefs))
+        # Nowy obiekt strony ma też nowe obiekty treści - zapisanych nie da się przywrócić w miejscu
+        self.page_objects = tuple(None if xref in xref_map else page_objects
+                                  for xref, page_objects in zip(self.page_xrefs, self.page_objects))
+        self.page_xrefs = tuple(xref_map.get(xref, xref) for xref in self.page_xrefs)
+
+    def apply(self, doc, store):
+        """
+        Przywraca zapisany stan. Zwraca (dokument, krok odwrotny, indeksy stron zmienionych
+        w miejscu - obrót lub treść, {zapisany xref: nowy xref} stron wstawionych z kopii).
+        Dla migawki dokument jest nowym obiektem - wywołujący zamyka stary; krok
+        stronowy zmienia doc w miejscu.
+        """
+        if self.snapshot is not None:
+            inverse = UndoStep.capture(doc, store)
+            return self.snapshot.open(), inverse, [], {}
+
+        inverse = UndoStep.capture(doc, store, self.changed_pages(doc))
+        pages_doc = self.saved_pages.open() if self.saved_pages is not None else None
+        try:
+            changed, restored = self.restore(doc, pages_doc)
+        finally:
+            if pages_doc is not None:
+                pages_doc.close()
+        return doc, inverse, changed, restored
+
+    def _plan(self, doc):
+        """
+        Strony bieżącego dokumentu do zachowania, xrefy stron do wstawienia z kopii
+        oraz {xref: indeks w page_xrefs} stron przywracanych w miejscu.
+        """
+        current = [doc.page_xref(i) for i in range(len(doc))]
+        saved = set(self.page_xrefs)
+        target = set(self.xrefs)
+        in_place = {}
+        xref_length = doc.xref_length()
+        for k, (xref, page_objects) in enumerate(zip(self.page_xrefs, self.page_objects)):
+            if (page_objects is not None and xref in target
+                    and all(ref < xref_length for ref, _, _ in page_objects[1])):
+                in_place[xref] = k
+        keep = {xref for xref in current if xref in target and (xref not in saved or xref in in_place)}
+        in_place = {xref: k for xref, k in in_place.items() if xref in keep}
+        restore = [xref for xref in self.xrefs if xref not in keep]
+        if any(xref not in saved for xref in restore):
+            raise RuntimeError("historia zmian nie pasuje do bieżącego dokumentu")
+        return current, keep, restore, in_place
+
+    def changed_pages(self, doc):
+        """Indeksy stron, które restore() usunie z dokumentu albo zmieni w miejscu."""
+        current, keep, _, in_place = self._plan(doc)
+        return [i for i, xref in enumerate(current) if xref not in keep or xref in in_place]
+
+    def restore(self, doc, pages_doc=None):
+        """
+        Przywraca zapisany stan kroku stronowego w doc; pages_doc to otwarte kopie stron
+        (saved_pages). Zwraca (indeksy stron zmienionych w miejscu - obrót lub treść,
+        {zapisany xref: nowy xref}).
+        """
+        current, keep, restore, in_place = self._plan(doc)
+        for xref, k in in_place.items():
+            self._restore_page_objects(doc, xref, self.page_objects[k], pages_doc)
+        removed = [i for i, xref in enumerate(current) if xref not in keep]
+        if removed:
+            doc.delete_pages(removed)
+        restored = {}
+        if restore:
+            inserted = [k for k, xref in enumerate(self.page_xrefs) if xref not in in_place]
+            if len(inserted) < len(pages_doc):
+                pages_doc.select(inserted)
+            first_new = len(doc)
+            doc.insert_pdf(pages_doc)
+            restored = {self.page_xrefs[k]: doc.page_xref(first_new + n) for n, k in enumerate(inserted)}
+        positions = {doc.page_xref(i): i for i in range(len(doc))}
+        order = [positions[restored.get(xref, xref)] for xref in self.xrefs]
+        if order != list(range(len(doc))):
+            doc.select(order)
+
+        changed = []
+        for page_index, (xref, rotation) in enumerate(zip(self.xrefs, self.rotations)):
+            if xref in in_place:
+                changed.append(page_index)
+            if xref not in keep or rotation == self.UNKNOWN_ROTATE:
+                continue
+            if self._read_rotate(doc, xref) != rotation:
+                doc.xref_set_key(xref, "Rotate", "null" if rotation == self.NO_ROTATE else str(rotation))
+                if xref not in in_place:
+                    changed.append(page_index)
+        return changed, restored
+
+    @staticmethod
+    def _restore_page_objects(doc, xref, page_objects, pages_doc):
+        """Zapisuje słownik strony i obiekty jej treści z capture() pod ich dawnymi numerami."""
+        page_text, objects = page_objects
+        for ref, text, copy_ref in objects:
+            # Obiekt mógł zostać w międzyczasie zwolniony (np. cofnięciem w dzienniku MuPDF)
+            doc.update_object(ref, text.data)
+            if copy_ref:
+                doc.update_stream(ref, pages_doc.xref_stream_raw(copy_ref) or b"", compress=False)
+                # update_stream bez kompresji usuwa /Filter - przywróć zapisany słownik
+                doc.update_object(ref, text.data)
+        # Strona zostaje w bieżącym miejscu drzewa stron (doc.select mógł zmienić /Parent)
+        kind, parent = doc.xref_get_key(xref, "Parent")
+        doc.update_object(xref, page_text.data)
+        if kind == "xref":
+            doc.xref_set_key(xref, "Parent", parent)
+
+
+class JournalStep:
+    """
+    Krok historii oparty na dzienniku MuPDF (doc.journal_*) - dla edycji w miejscu
+    (obroty stron, usuwanie numerów stron redakcją).
+
+    Krok pamięta tylko pozycje dziennika przed i po operacji; apply() przewija
+    dziennik (journal_undo/journal_redo) na tym samym obiekcie dokumentu, bez
+    kopiowania stron i bez ponownego otwierania pliku. Interfejs jak UndoStep
+    (ready, blobs, renumber), więc oba rodzaje kroków dzielą stosy historii.
+
+    Przy włączonym dzienniku PyMuPDF nie wykona insert_pdf, new_page ani nie doda
+    fontu do strony, dlatego operacje strukturalne najpierw zamieniają kroki
+    dziennika na UndoStep (SelectablePDFViewer._end_journal_session).
+    """
+    __slots__ = ("before", "after", "pages", "undo")
+
+    snapshot = None  # Nigdy nie jest punktem kontrolnym
+    ready = True
+    in_place = True
+
+    def __init__(self, before, pages, after=None, undo=True):
+        self.before = before  # Pozycja dziennika przed operacją
+        self.after = after  # ... i po niej (znana po zamknięciu operacji)
+        self.pages = tuple(sorted(set(pages)))  # Strony zmienione w miejscu
+        self.undo = undo  # True - krok cofa operację, False - ponawia ją
+
+    @staticmethod
+    def seek(doc, position):
+        """Przewija dziennik dokumentu do podanej pozycji."""
+        while doc.journal_position()[0] > position:
+            doc.journal_undo()
+        while doc.journal_position()[0] < position:
+            doc.journal_redo()
+
+    @staticmethod
+    def discard(doc):
+        """
+        Wyłącza dziennik MuPDF dokumentu i zwalnia zapisane w nim operacje. PyMuPDF
+        ma tylko journal_enable(), więc dziennik jest odpinany na poziomie MuPDF -
+        ten sam obiekt dokumentu, bez zapisu i ponownego otwierania.
+        """
+        pdf = fitz.mupdf.pdf_document_from_fz_document(doc.this)
+        journal = pdf.m_internal.journal
+        pdf.m_internal.journal = None
+        fitz.mupdf.ll_pdf_discard_journal(journal)
+
+    def blobs(self):
+        return iter(())
+
+    def renumber(self, xref_map):
+        pass  # Dziennik nie zmienia numerów obiektów
+
+    def apply(self, doc, store):
+        """
+        Przewija dziennik do stanu sprzed (cofanie) lub po (ponawianie) operacji.
+        Zwraca jak UndoStep.apply; zamiast stron ze zmienionym obrotem - wszystkie
+        strony do odświeżenia (zmienione w miejscu i obrócone).
+        """
+        rotations = [UndoStep._read_rotate(doc, doc.page_xref(i)) for i in range(len(doc))]
+        self.seek(doc, self.before if self.undo else self.after)
+        inverse = JournalStep(self.before, self.pages, self.after, not self.undo)
+        changed = {page_index for page_index in self.pages if page_index < len(doc)}
+        if len(doc) == len(rotations):
+            changed.update(page_index for page_index, rotation in enumerate(rotations)
+                           if UndoStep._read_rotate(doc, doc.page_xref(page_index)) != rotation)
+        return doc, inverse, sorted(changed), {}
+
+
+# ====================================================================
+# KLASA: DZIENNIK SESJI (ODZYSKIWANIE PO AWARII)
+# ====================================================================
+
+SESSION_JOURNAL_DIR = os.path.join(BASE_DIR, "session_journal")
+SESSION_RECORD_DELAY_MS = 500  # Zapis stanu po operacji - gdy pętla zdarzeń wróci do bezczynności
+
+class SessionJournal:
+    """
+    Dziennik sesji na dysku do odzyskiwania pracy po awarii programu.
+
+    Plik jest tylko dopisywany: nagłówek opisuje plik źródłowy (ścieżka, rozmiar,
+    czas modyfikacji) i xrefy jego stron, a każdy rekord - stan dokumentu po
+    operacji: kolejność stron (xrefy), obroty i - jako mały PDF - tylko strony,
+    których treści dziennik jeszcze nie zna (nowe lub zmienione w miejscu).
+    Rekord to linia JSON i dokładnie "length" bajtów danych; urwany zapis na
+    końcu pliku (awaria w trakcie dopisywania) jest przy odczycie pomijany.
+
+    replay() odtwarza sesję na świeżo otwartym pliku źródłowym mechanizmem kroków
+    stronowych (UndoStep.restore), więc koszt zapisu i odzyskania zależy od
+    rozmiaru zmian, a nie od rozmiaru dokumentu.
+
+    Wątek GUI tylko kopiuje zmienione strony do osobnego dokumentu - serializacja
+    kopii, dopisanie do pliku i fsync odbywają się w wątku dziennika, w kolejności
+    rekordów. Gdy dziennik nie zna żadnej strony (nowy obiekt dokumentu), record()
+    dostaje gotowe bajty wcześniejszego stanu dokumentu (base) i dopisuje do nich
+    tylko strony zmienione od tego stanu - cały dokument nie jest wtedy kopiowany.
+    """
+
+    MAGIC = b"PDFEDITOR-SESSION 1\n"
+    SUFFIX = ".pdfjournal"
+
+    def __init__(self, path, source_path, doc):
+        self.path = path
+        self._known = set()  # xrefy stron, których treść jest już w pliku źródłowym lub w dzienniku
+        self._jobs = queue.Queue()  # Rekordy czekające na zapis w wątku dziennika
+        self._thread = None
+        self._discard = False  # Zamknięcie z usunięciem pliku - oczekujące rekordy są pomijane
+        self.error = None  # Błąd zapisu w tle (dziennik przestaje wtedy zapisywać)
+        self._file = open(path, "wb")
+        try:
+            stat = os.stat(source_path)
+            xrefs = [doc.page_xref(i) for i in range(len(doc))]
+            header = {
+                "source": os.path.abspath(source_path),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "pid": os.getpid(),
+                "started": time.time(),
+                "xrefs": xrefs,
+            }
+            self._file.write(self.MAGIC + json.dumps(header).encode("utf-8") + b"\n")
+            self._sync()
+        except BaseException:
+            self.close()
+            raise
+        self._known = set(xrefs)
+
+    @classmethod
+    def start(cls, directory, source_path, doc):
+        """Tworzy dziennik bieżącego procesu dla dokumentu otwartego z source_path."""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"session_{os.getpid()}_{int(time.time() * 1000)}{cls.SUFFIX}")
+        return cls(path, source_path, doc)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, doc, label, changed_xrefs=(), reset=False, base=None):
+        """
+        Kolejkuje zapis stanu dokumentu po operacji. changed_xrefs to strony zmienione
+        w miejscu (ten sam xref, inna treść); reset=True oznacza nowy obiekt dokumentu -
+        numery xref tracą znaczenie i dziennik nie zna żadnej jego strony.
+
+        base=(bajty, strony) to wcześniejszy stan tego samego obiektu doc: bajty PDF
+        bez garbage (te same numery obiektów), których nikt już nie zmienia, i lista
+        (xref, obrót) jego stron. Bajty trafiają do dziennika w całości, a rekord stanu
+        doc zawiera już tylko strony spoza base i z changed_xrefs (zmienione od base).
+        Strony, których dziennik nie zna, są kopiowane do osobnego dokumentu; wątek GUI
+        nigdy nie serializuje całego doc. Błąd wcześniejszego zapisu w tle jest zgłaszany tutaj.
+        """
+        if self.error is not None:
+            raise OSError(f"zapis dziennika sesji nie powiódł się: {self.error}")
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writer_loop, name="SessionJournal", daemon=True)
+            self._thread.start()
+        if base is not None:
+            data, base_pages = base
+            base_xrefs = [xref for xref, _ in base_pages]
+            self._jobs.put(({"op": label, "time": time.time(), "xrefs": base_xrefs,
+                             "rotations": [rotation for _, rotation in base_pages], "pages": base_xrefs}, data))
+            self._known = set(base_xrefs)
+        elif reset:
+            self._known = set()
+        xrefs = [doc.page_xref(i) for i in range(len(doc))]
+        rotations = [UndoStep._read_rotate(doc, xref) for xref in xrefs]
+        known = self._known.difference(changed_xrefs)
+        pages = [page_index for page_index, xref in enumerate(xrefs) if xref not in known]
+        # Strony usunięte nie wracają pod tym samym xref (MuPDF nie używa ponownie numerów)
+        self._known = set(xrefs)
+        if base is not None and not pages and base_pages == list(zip(xrefs, rotations)):
+            return  # Stan doc to dokładnie base
+        source = b""
+        if pages:
+            # Osobny dokument, którego nikt poza wątkiem dziennika już nie używa
+            source = fitz.open()
+            for page_index in pages:
+                source.insert_pdf(doc, from_page=page_index, to_page=page_index)
+        meta = {
+            "op": label,
+            "time": time.time(),
+            "xrefs": xrefs,
+            "rotations": rotations,
+            "pages": [xrefs[page_index] for page_index in pages],
+        }
+        self._jobs.put((meta, source))
+
+    def _writer_loop(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                meta, source = job
+                if self._discard or self.error is not None:
+                    continue
+                if isinstance(source, fitz.Document):
+                    payload = source.tobytes()
+                    source.close()
+                else:
+                    payload = source
+                meta["length"] = len(payload)
+                meta["crc"] = zlib.crc32(payload)
+                self._file.write(json.dumps(meta).encode("utf-8") + b"\n" + payload)
+                if self._jobs.empty():
+                    self._sync()  # Jeden fsync dla serii rekordów zgłoszonych w krótkim czasie
+            except Exception as e:
+                self.error = e
+            finally:
+                # Nie trzymaj kopii stron w czasie oczekiwania na kolejny rekord
+                job = source = payload = None
+                self._jobs.task_done()
+
+    def flush(self):
+        """Czeka na zapis zakolejkowanych rekordów. Zwraca False, jeśli zapis się nie powiódł."""
+        self._jobs.join()
+        return self.error is None
+
+    def close(self, remove=True):
+        """Zamyka dziennik; remove=True usuwa plik (sesja zakończona bez awarii)."""
+        if self._thread is not None:
+            self._discard = remove
+            self._jobs.put(None)
+            self._thread.join()
+            self._thread = None
+        if not self._file.closed:
+            self._file.close()
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    @classmethod
+    def read(cls, path):
+        """Zwraca (nagłówek, lista (rekord, dane PDF)); pomija urwany ostatni rekord."""
+        records = []
+        with open(path, "rb") as journal_file:
+            if journal_file.readline() != cls.MAGIC:
+                raise ValueError("to nie jest dziennik sesji PDF Editor")
+            header = json.loads(journal_file.readline())
+            while True:
+                line = journal_file.readline()
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    meta = json.loads(line)
+                except ValueError:
+                    break
+                payload = journal_file.read(meta["length"])
+                if len(payload) != meta["length"] or zlib.crc32(payload) != meta["crc"]:
+                    break
+                records.append((meta, payload))
+        return header, records
+
+    @staticmethod
+    def _owner_alive(pid):
+        """Czy proces, który utworzył dziennik, nadal działa."""
+        if pid == os.getpid():
+            return True
+        if sys.platform == "win32":
+            import ctypes
+            handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+            if not handle:
+                return False
+            ctypes.windll.kernel32.CloseHandle(handle)
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True  # Proces istnieje, ale należy do innego użytkownika
+        return True
+
+    @classmethod
+    def find_orphans(cls, directory):
+        """Dzienniki sesji pozostawione przez procesy, które już nie działają (najnowsze pierwsze)."""
+        orphans = []
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return orphans
+        for name in names:
+            if not name.endswith(cls.SUFFIX):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                with open(path, "rb") as journal_file:
+                    if journal_file.readline() != cls.MAGIC:
+                        continue
+                    header = json.loads(journal_file.readline())
+            except (OSError, ValueError):
+                continue
+            if not cls._owner_alive(header.get("pid", 0)):
+                orphans.append((header.get("started", 0), path))
+        return [path for _, path in sorted(orphans, reverse=True)]
+
+    @staticmethod
+    def source_matches(header):
+        """Czy plik źródłowy sesji istnieje i nie zmienił się od jej rozpoczęcia."""
+        try:
+            stat = os.stat(header["source"])
+        except OSError:
+            return False
+        return stat.st_size == header["size"] and stat.st_mtime == header["mtime"]
+
+    @staticmethod
+    def replay(doc, header, records, before_record=None):
+        """
+        Odtwarza rekordy sesji na doc (świeżo otwarty plik źródłowy). before_record(indeksy)
+        jest wołane przed każdym rekordem ze stronami, które rekord usunie - np. do zapisu
+        historii cofnij.
+        """
+        if len(doc) != len(header["xrefs"]):
+            raise RuntimeError("plik źródłowy ma inną liczbę stron niż na początku sesji")
+        # xref strony w sesji -> xref tej strony w odtwarzanym dokumencie
+        xref_map = {xref: doc.page_xref(i) for i, xref in enumerate(header["xrefs"])}
+        for meta, payload in records:
+            # Strony z danych rekordu dostają ujemne identyfikatory - nie mylą się z xrefami doc
+            placeholders = {xref: -(k + 1) for k, xref in enumerate(meta["pages"])}
+            step = UndoStep()
+            try:
+                step.xrefs = array('q', (placeholders[xref] if xref in placeholders else xref_map[xref]
+                                         for xref in meta["xrefs"]))
+            except KeyError:
+                raise RuntimeError("dziennik sesji jest niespójny") from None
+            step.rotations = array('h', meta["rotations"])
+            step.page_xrefs = tuple(placeholders.values())
+            if before_record is not None:
+                before_record(step.changed_pages(doc))
+            pages_doc = fitz.open("pdf", payload) if payload else None
+            try:
+                _, restored = step.restore(doc, pages_doc)
+            finally:
+                if pages_doc is not None:
+                    pages_doc.close()
+            xref_map.update((xref, restored[placeholder]) for xref, placeholder in placeholders.items())
+
+
+# ====================================================================
+# KLASA: CACHE MINIATUR (LRU Z BUDŻETEM PAMIĘCI)
+# ====================================================================
+
+class ThumbnailCache:
+    """
+    Cache miniatur w pamięci: obrazy PIL z limitem bajtów i wyrzucaniem LRU.
+
+    Przechowuje surowe obrazy PIL (nie PhotoImage) - obiekty Tk tworzone są
+    tylko dla ramek widocznych na ekranie. Liczniki hits/misses/evictions
+    pozwalają ocenić, czy budżet jest dobrany do wielkości dokumentów.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max(1, int(max_bytes))
+        self._entries: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def image_bytes(image):
+        """Rozmiar pikseli obrazu w bajtach (szerokość * wysokość * liczba kanałów)."""
+        width, height = image.size
+        return width * height * len(image.getbands())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Zwraca obraz dla klucza (i oznacza go jako ostatnio użyty) albo None."""
+        image = self._entries.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return image
+
+    def put(self, key, image):
+        """Dodaje obraz do cache, wyrzucając najdawniej używane wpisy ponad budżet."""
+        self.discard(key)
+        self._entries[key] = image
+        self.current_bytes += self.image_bytes(image)
+        while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= self.image_bytes(evicted)
+            self.evictions += 1
+
+    def discard(self, key):
+        image = self._entries.pop(key, None)
+        if image is not None:
+            self.current_bytes -= self.image_bytes(image)
+
+    def discard_where(self, predicate):
+        """Usuwa wszystkie wpisy, których klucz spełnia predicate(key)."""
+        for key in [key for key in self._entries if predicate(key)]:
+            self.discard(key)
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits / total) if total else 0.0,
+        }
+
+# ====================================================================
+# KLASA: CACHE SPARSOWANYCH STRON (fitz.DisplayList)
+# ====================================================================
+
+def estimate_displaylist_bytes(doc, page):
+    """
+    Przybliżony rozmiar DisplayList strony - PyMuPDF go nie udostępnia, więc
+    szacujemy z długości (skompresowanych) strumieni zawartości strony.
+    """
+    stream_bytes = 0
+    for xref in page.get_contents():
+        kind, value = doc.xref_get_key(xref, "Length")
+        if kind == "int":
+            stream_bytes += int(value)
+    return 16 * 1024 + 4 * stream_bytes
+
+
+def displaylist_text(displaylist):
+    """Tekst sparsowanej strony (odpowiednik page.get_text())."""
+    textpage = displaylist.get_textpage()
+    # Część wersji PyMuPDF zwraca tu surowy obiekt MuPDF zamiast fitz.TextPage
+    if not hasattr(textpage, "extractText"):
+        textpage = fitz.TextPage(textpage)
+    return textpage.extractText()
+
+
+class DisplayListCache:
+    """
+    Cache sparsowanych stron (fitz.DisplayList) z budżetem bajtów i wyrzucaniem LRU.
+
+    Treść strony jest interpretowana raz, a potem rasteryzowana w dowolnej skali
+    (podgląd, analiza kolorów, eksport) albo przeszukiwana (tekst). Klucze nadaje
+    wywołujący - przeglądarka używa odcisku treści strony, więc edycja strony
+    automatycznie oznacza nowy wpis. Cache działa w wątku GUI (dokument główny).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max(1, int(max_bytes))
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()  # klucz -> (DisplayList, bajty)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, doc, page_index):
+        """Zwraca DisplayList strony dla klucza, parsując stronę przy braku w cache."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        page = doc.load_page(page_index)
+        displaylist = page.get_displaylist()
+        size = estimate_displaylist_bytes(doc, page)
+        self._entries[key] = (displaylist, size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+        return displaylist
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+# ====================================================================
+# KLASA: RAMKA MINIATURY (Bez zmian)
+# ====================================================================
+
+class ThumbnailFrame(tk.Frame):
+    """
+    Ramka jednej miniatury w wirtualizowanej siatce.
+    Ramki są wielokrotnie używane: bind_page() przypina ramkę do innej strony
+    zamiast tworzyć nowe widgety przy przewijaniu.
+    """
+    def __init__(self, parent, viewer_app, column_width):
+        super().__init__(parent, bg="#F5F5F5") 
+        self.page_index: Optional[int] = None
+        self.canvas = parent
+        self.viewer_app = viewer_app
+        self.column_width = column_width
+        self.window_id = None  # Identyfikator okna na canvasie przeglądarki
+        self.bg_normal = "#F5F5F5"
+        self.bg_selected = "#B3E5FC"
+        self.outer_frame = tk.Frame(
+            self, 
+            bg=self.bg_normal, 
+            borderwidth=0, 
+            relief=tk.FLAT,
+            highlightthickness=FOCUS_HIGHLIGHT_WIDTH, 
+            highlightbackground=self.bg_normal 
+        )
+        self.outer_frame.pack(fill="both", expand=True, padx=0, pady=0)
+        self.img_label = None 
+        self.page_label = None
+        self.format_label = None
+        self.setup_ui(self.outer_frame)
+
+    def _bind_all_children(self, sequence, func):
+        self.bind(sequence, func)
+        self.outer_frame.bind(sequence, func)
+        for child in self.outer_frame.winfo_children():
+            child.bind(sequence, func)
+            if child.winfo_class() == 'Frame':
+                 for grandchild in child.winfo_children():
+                     grandchild.bind(sequence, func)
+
+
+    def setup_ui(self, parent_frame):
+        image_container = tk.Frame(parent_frame, bg="white") 
+        image_container.pack(padx=5, pady=(5, 0))
+        
+        self.img_label = tk.Label(image_container, bg="white")
+        self.img_label.pack() 
+        
+        # Przycisk renderu na żądanie - widoczny tylko dla stron zbyt złożonych (set_complex)
+        self.render_button = tk.Button(
+            image_container, text="Złożona strona\nRenderuj", font=("Helvetica", 9),
+            command=lambda: self.page_index is not None and self.viewer_app.render_complex_page(self.page_index))
+        self._complex = False
+        
+        self.page_label = tk.Label(parent_frame, text="", bg=self.bg_normal, font=("Helvetica", 10, "bold"))
+        self.page_label.pack(pady=(5, 0))
+        
+        self.format_label = tk.Label(parent_frame, text="", fg="gray", bg=self.bg_normal, font=("Helvetica", 9))
+        self.format_label.pack(pady=(0, 5))
+
+        # Indeks strony czytamy w chwili zdarzenia - ramka może być już przypięta do innej strony
+        self._bind_all_children("<Button-1>", lambda event: self.page_index is not None and self.viewer_app._handle_lpm_click(self.page_index, event))
+        # Handler środkowego przycisku myszy (Mouse-3) do otwierania popupu
+        def mouse3_handler(event):
+            if self.page_index is not None:
+                self._handle_double_click(self.page_index)
+            return "break"
+        self._bind_all_children("<Button-2>", mouse3_handler)
+
+        self._bind_all_children("<Button-3>", lambda event: self.page_index is not None and self._handle_ppm_click(event, self.page_index))
+       # parent_frame.bind("<Enter>", lambda event, idx=self.page_index: self.viewer_app._focus_by_mouse(idx))
+
+    def bind_page(self, page_index):
+        """Przypina ramkę do strony: miniatura (lub placeholder), numer i format strony."""
+        self.page_index = page_index
+        self.set_image(self.viewer_app._render_and_scale(page_index, self.column_width))
+        self.set_complex(self.viewer_app.is_complex_page(page_index))
+        self.set_heat(self.viewer_app.page_heat_color(page_index))
+        self.page_label.config(text=f"Strona {page_index + 1}")
+        self.set_format_text(self.viewer_app._get_page_size_label(page_index))
+
+    def set_complex(self, complex_page):
+        """Pokazuje/ukrywa przycisk renderu na żądanie nad placeholderem złożonej strony."""
+        if complex_page == self._complex:
+            return
+        self._complex = complex_page
+        if complex_page:
+            self.render_button.place(relx=0.5, rely=0.5, anchor="center")
+        else:
+            self.render_button.place_forget()
+
+    def hit_render_button(self, x, y):
+        return False  # Przycisk jest widgetem - obsługuje kliknięcie sam
+
+    def set_heat(self, color):
+        """Koloruje numer strony wg mapy ciepła profilu renderowania (None = zwykły kolor)."""
+        self.page_label.config(fg=color or "black")
+
+    def set_image(self, img_tk):
+        self.img_label.config(image=img_tk if img_tk is not None else "")
+        self.img_label.image = img_tk
+
+    def set_format_text(self, text):
+        self.format_label.config(text=text)
+
+    def place_cell(self, x, y, width, height):
+        """Ustawia ramkę w komórce siatki (współrzędne canvasu)."""
+        self.canvas.coords(self.window_id, x, y)
+        self.canvas.itemconfigure(self.window_id, width=width, height=height)
+
+    def hide(self):
+        """Odpina ramkę od strony i przesuwa ją poza obszar widoku."""
+        self.page_index = None
+        self.set_complex(False)
+        self.set_heat(None)
+        # Zwolnij PhotoImage - obiekty Tk istnieją tylko dla ramek na ekranie
+        self.set_image(None)
+        self.canvas.coords(self.window_id, -10000, -10000)
+
+    def set_selected(self, selected):
+        bg = self.bg_selected if selected else self.bg_normal
+        self.config(bg=bg)
+        self.outer_frame.config(bg=bg)
+        self.page_label.config(bg=bg)
+        self.format_label.config(bg=bg)
+
+    def set_focused(self, focused):
+        color = FOCUS_HIGHLIGHT_COLOR if focused else self.bg_normal
+        self.outer_frame.config(highlightbackground=color, highlightcolor=color)
+    
+    def _handle_double_click(self, page_index):
+        """Handle double-click to show page preview popup"""
+        return self.viewer_app._show_page_preview(page_index)
+
+    def _handle_ppm_click(self, event, page_index):
+        self.viewer_app._show_page_context_menu(event, page_index)
+
+
+class ThumbnailCanvasCell:
+    """
+    Komórka siatki miniatur rysowana elementami na canvasie przeglądarki.
+
+    Alternatywa dla ThumbnailFrame bez widgetów: tło zaznaczenia, ramka fokusu,
+    obraz i podpisy są elementami canvasu, więc zmiana zaznaczenia lub fokusu
+    to przekolorowanie jednego elementu. Kliknięcia rozpoznaje przeglądarka
+    arytmetyką siatki (_page_at_canvas_point), a nie bindingi komórek.
+    Interfejs (bind_page, set_image, place_cell, hide...) jest taki sam jak w ThumbnailFrame.
+    """
+    IMAGE_PAD = 5
+    PAGE_FONT = ("Helvetica", 10, "bold")
+    FORMAT_FONT = ("Helvetica", 9)
+
+    def __init__(self, canvas, viewer_app, column_width):
+        self.canvas = canvas
+        self.viewer_app = viewer_app
+        self.column_width = column_width
+        self.page_index: Optional[int] = None
+        self.bg_normal = "#F5F5F5"
+        self.bg_selected = "#B3E5FC"
+        self._photo = None
+        self._origin = (-10000, -10000)
+        self._size = (0, 0)
+        self._tag = f"thumbcell{id(self)}"
+        self._page_line_height = tkfont.Font(font=self.PAGE_FONT).metrics("linespace")
+        options = {"state": "hidden", "tags": (self._tag, "thumbcell")}
+        self.bg_item = canvas.create_rectangle(0, 0, 0, 0, fill=self.bg_normal, outline="", **options)
+        self.focus_item = canvas.create_rectangle(0, 0, 0, 0, outline=self.bg_normal, width=FOCUS_HIGHLIGHT_WIDTH, **options)
+        self.image_bg_item = canvas.create_rectangle(0, 0, 0, 0, fill="white", outline="", **options)
+        self.image_item = canvas.create_image(0, 0, anchor="n", **options)
+        self.page_text_item = canvas.create_text(0, 0, anchor="n", font=self.PAGE_FONT, **options)
+        self.format_text_item = canvas.create_text(0, 0, anchor="n", fill="gray", font=self.FORMAT_FONT, **options)
+        # "Przycisk" renderu na żądanie dla stron zbyt złożonych - poza tagiem komórki,
+        # bo jego widoczność zależy od set_complex, a nie od place_cell/hide
+        self._complex = False
+        self._button_tag = f"{self._tag}-render"
+        button_options = {"state": "hidden", "tags": (self._button_tag, "thumbcell")}
+        self.button_item = canvas.create_rectangle(0, 0, 0, 0, fill="#E0E0E0", outline="gray", **button_options)
+        self.button_text_item = canvas.create_text(0, 0, text="Złożona strona\nRenderuj", justify="center",
+                                                   font=self.FORMAT_FONT, **button_options)
+
+    @classmethod
+    def cell_size(cls, column_width, max_height):
+        """Rozmiar komórki dla miniatury column_width x max_height (z podpisami i ramką fokusu)."""
+        page_line = tkfont.Font(font=cls.PAGE_FONT).metrics("linespace")
+        format_line = tkfont.Font(font=cls.FORMAT_FONT).metrics("linespace")
+        width = column_width + 2 * cls.IMAGE_PAD + 2 * FOCUS_HIGHLIGHT_WIDTH
+        height = (2 * FOCUS_HIGHLIGHT_WIDTH + 3 * cls.IMAGE_PAD + max_height + page_line + format_line)
+        return width, height
+
+    def bind_page(self, page_index):
+        """Przypina komórkę do strony: miniatura (lub placeholder), numer i format strony."""
+        self.page_index = page_index
+        self.canvas.itemconfigure(self.page_text_item, text=f"Strona {page_index + 1}")
+        self.set_format_text(self.viewer_app._get_page_size_label(page_index))
+        self.set_image(self.viewer_app._render_and_scale(page_index, self.column_width))
+        self.set_complex(self.viewer_app.is_complex_page(page_index))
+        self.set_heat(self.viewer_app.page_heat_color(page_index))
+
+    def set_image(self, img_tk):
+        self._photo = img_tk
+        self.canvas.itemconfigure(self.image_item, image=img_tk if img_tk is not None else "")
+        self._layout()
+
+    def set_complex(self, complex_page):
+        """Pokazuje/ukrywa przycisk renderu na żądanie nad placeholderem złożonej strony."""
+        self._complex = complex_page
+        self.canvas.itemconfigure(self._button_tag, state="normal" if complex_page and self.page_index is not None else "hidden")
+
+    def hit_render_button(self, x, y):
+        """Czy punkt (współrzędne canvasu) trafia w widoczny przycisk renderu na żądanie."""
+        if not self._complex:
+            return False
+        x1, y1, x2, y2 = self.canvas.coords(self.button_item)
+        return x1 <= x <= x2 and y1 <= y <= y2
+
+    def set_heat(self, color):
+        """Koloruje numer strony wg mapy ciepła profilu renderowania (None = zwykły kolor)."""
+        self.canvas.itemconfigure(self.page_text_item, fill=color or "black")
+
+    def set_format_text(self, text):
+        self.canvas.itemconfigure(self.format_text_item, text=text)
+
+    def place_cell(self, x, y, width, height):
+        self._origin = (x, y)
+        self._size = (width, height)
+        self._layout()
+        self.canvas.itemconfigure(self._tag, state="normal")
+
+    def hide(self):
+        self.page_index = None
+        self.canvas.itemconfigure(self._tag, state="hidden")
+        self.set_complex(False)
+        self.set_heat(None)
+        self.set_image(None)
+
+    def _layout(self):
+        x, y = self._origin
+        width, height = self._size
+        half_focus = FOCUS_HIGHLIGHT_WIDTH / 2
+        image_width = self._photo.width() if self._photo is not None else 0
+        image_height = self._photo.height() if self._photo is not None else 0
+        center_x = x + width / 2
+        image_top = y + FOCUS_HIGHLIGHT_WIDTH + self.IMAGE_PAD
+        text_top = image_top + image_height + self.IMAGE_PAD
+        self.canvas.coords(self.bg_item, x, y, x + width, y + height)
+        self.canvas.coords(self.focus_item, x + half_focus, y + half_focus, x + width - half_focus, y + height - half_focus)
+        self.canvas.coords(self.image_bg_item, center_x - image_width / 2, image_top, center_x + image_width / 2, image_top + image_height)
+        self.canvas.coords(self.image_item, center_x, image_top)
+        self.canvas.coords(self.page_text_item, center_x, text_top)
+        self.canvas.coords(self.format_text_item, center_x, text_top + self._page_line_height)
+        center_y = image_top + image_height / 2
+        button_width = min(110, image_width)
+        self.canvas.coords(self.button_item, center_x - button_width / 2, center_y - 20, center_x + button_width / 2, center_y + 20)
+        self.canvas.coords(self.button_text_item, center_x, center_y)
+
+    def set_selected(self, selected):
+        self.canvas.itemconfigure(self.bg_item, fill=self.bg_selected if selected else self.bg_normal)
+
+    def set_focused(self, focused):
+        self.canvas.itemconfigure(self.focus_item, outline=FOCUS_HIGHLIGHT_COLOR if focused else self.bg_normal)
+
+# ====================================================================
+# DIALOG SCALANIA STRON NA ARKUSZU
+# ====================================================================
+
+class MergePageGridDialog(tk.Toplevel):
+    PAPER_FORMATS = {
+        'A0': (841, 1189),
+        'A1': (594, 841),
+        'A2': (420, 594),
+        'A3': (297, 420),
+        'A4': (210, 297),
+        'A5': (148, 210),
+        'A6': (105, 148),
+    }
+    
+    DEFAULTS = {
+        'sheet_format': 'A4',
+        'orientation': 'Pionowa',
+        'margin_top_mm': '5',
+        'margin_bottom_mm': '5',
+        'margin_left_mm': '5',
+        'margin_right_mm': '5',
+        'spacing_x_mm': '10',
+        'spacing_y_mm': '10',
+        'dpi_var': '300',
+        'scaling_mode': 'stretch',
+        'page_width_mm': '100',
+        'page_height_mm': '100',
+        'output_mode': 'new_file',  # 'new_file' or 'append'
+    }
+
+    def __init__(self, parent, page_count, prefs_manager=None):
+        super().__init__(parent)
+        self.title("Scalanie strony na arkuszu")
+        self.transient(parent)
+        self.result = None
+        self.prefs_manager = prefs_manager
+        
+        # Pozycjonuj poza ekranem, aby uniknąć migotania
+        self.geometry("+10000+10000")
+
+        self.configure(bg=parent.cget('bg'))
+
+        self.sheet_format = tk.StringVar(value=self._get_pref('sheet_format'))
+        self.orientation = tk.StringVar(value=self._get_pref('orientation'))
+        self.margin_top_mm = tk.StringVar(value=self._get_pref('margin_top_mm'))
+        self.margin_bottom_mm = tk.StringVar(value=self._get_pref('margin_bottom_mm'))
+        self.margin_left_mm = tk.StringVar(value=self._get_pref('margin_left_mm'))
+        self.margin_right_mm = tk.StringVar(value=self._get_pref('margin_right_mm'))
+        self.spacing_x_mm = tk.StringVar(value=self._get_pref('spacing_x_mm'))
+        self.spacing_y_mm = tk.StringVar(value=self._get_pref('spacing_y_mm'))
+        self.rows_var = tk.StringVar()
+        self.cols_var = tk.StringVar()
+        self.dpi_var = tk.StringVar(value=self._get_pref('dpi_var'))
+        self.scaling_mode = tk.StringVar(value=self._get_pref('scaling_mode'))
+        self.page_width_mm = tk.StringVar(value=self._get_pref('page_width_mm'))
+        self.page_height_mm = tk.StringVar(value=self._get_pref('page_height_mm'))
+        self.output_mode = tk.StringVar(value=self._get_pref('output_mode'))
+        self.page_count = page_count
+
+        self.vcmd_200 = (self.register(lambda v: validate_float_range(v, 0, 200)), "%P")
+        self.vcmd_500 = (self.register(lambda v: validate_float_range(v, 0, 500)), "%P")
+        self.grid_range = [str(i) for i in range(1, 21)]
+
+        if page_count == 1:
+            self.rows_var.set("1")
+            self.cols_var.set("1")
+        else:
+            import math
+            sq = min(max(math.ceil(page_count ** 0.5), 1), 10)
+            if (sq - 1) * sq >= page_count:
+                self.rows_var.set(str(min(max(sq - 1, 1), 10)))
+                self.cols_var.set(str(min(max(sq, 1), 10)))
+            else:
+                self.rows_var.set(str(min(max(sq, 1), 10)))
+                self.cols_var.set(str(min(max(sq, 1), 10)))
+
+        self.build_ui()
+        self._on_scaling_mode_changed()  # Initialize UI state based on scaling mode
+        self._update_grid_preview()
+        self.center_dialog(parent)
+        self.grab_set()
+        self.focus_force()
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+        self.resizable(False, False)
+        self.bind("<Return>", lambda e: self.ok())
+        self.bind("<KP_Enter>", lambda e: self.ok())
+        self.bind("<Escape>", lambda e: self.cancel())
+        self.wait_window(self)
+
+    def _combo_key_num(self, combo, var, event):
+        if event.char in "123456789":
+            var.set(event.char)
+            combo.event_generate('<<ComboboxSelected>>')
         elif event.char == "0":
             var.set("10")
             combo.event_generate('<<ComboboxSelected>>')
@@ -4185,17 +7129,15 @@ class PDFAnalysisDialog(tk.Toplevel):
         
         # Analyze each page
         for page_idx in range(total_pages):
-            page = doc[page_idx]
-            
             # Detect color
-            is_color = self._detect_color(page)
+            is_color = self._detect_color(page_idx)
             color_type = "Kolor" if is_color else "Czarno-biały"
             
-            # Detect format
-            page_format = self._detect_format(page)
+            # Detect format (wymiary z indeksu metadanych przeglądarki)
+            page_format = self._detect_format(page_idx)
             
             # Detect orientation
-            is_landscape = self._is_landscape(page)
+            is_landscape = self._is_landscape(page_idx)
             
             # Create key for grouping
             key = f"{color_type}_{page_format}"
@@ -4217,58 +7159,33 @@ class PDFAnalysisDialog(tk.Toplevel):
         # Display results
         self._display_results()
     
-    def _detect_color(self, page):
+    def _detect_color(self, page_idx):
         """Wykrywa czy strona jest kolorowa czy czarno-biała"""
         try:
-            # Get settings from preferences
-            render_scale = float(self.prefs_manager.get('color_detect_scale', '0.2'))
-            max_samples = int(self.prefs_manager.get('color_detect_samples', '300'))
             threshold = int(self.prefs_manager.get('color_detect_threshold', '5'))
-            
-            # Render page at configured resolution
-            mat = fitz.Matrix(render_scale, render_scale)
-            pix = page.get_pixmap(matrix=mat, alpha=False, colorspace=fitz.csGRAY)
-            
-            # Get another pixmap in RGB
-            pix_rgb = page.get_pixmap(matrix=mat, alpha=False, colorspace=fitz.csRGB)
-            
-            # Sample pixels - check if RGB differs from grayscale
-            samples = min(max_samples, pix.width * pix.height)
-            step = max(1, (pix.width * pix.height) // samples)
-            
-            for i in range(0, pix.width * pix.height, step):
-                y = i // pix.width
-                x = i % pix.width
-                if x >= pix.width or y >= pix.height:
-                    continue
-                
-                # Get RGB pixel
-                offset = (y * pix_rgb.width + x) * 3
-                if offset + 2 >= len(pix_rgb.samples):
-                    continue
-                
-                r = pix_rgb.samples[offset]
-                g = pix_rgb.samples[offset + 1]
-                b = pix_rgb.samples[offset + 2]
-                
-                # If R, G, B are different by more than threshold, it's color
-                if abs(r - g) > threshold or abs(g - b) > threshold or abs(r - b) > threshold:
-                    return True
-            
-            return False
-        except:
+            samples = int(self.prefs_manager.get('color_detect_samples', '300'))
+            
+            # Wynik policzony przy renderze miniatury (indeks stron) - bez ponownego renderu
+            spread = self.viewer.page_color_spread(page_idx, samples)
+            if spread is None:
+                # Strona bez miniatury: render RGB w skali z preferencji ze sparsowanej strony
+                render_scale = float(self.prefs_manager.get('color_detect_scale', '0.2'))
+                mat = fitz.Matrix(render_scale, render_scale)
+                displaylist = self.viewer.get_page_displaylist(page_idx)
+                pix = displaylist.get_pixmap(matrix=mat, alpha=False, colorspace=fitz.csRGB)
+                spread = max_channel_difference(pixmap_to_image(pix, copy=False), samples)
+                self.viewer.set_page_color_spread(page_idx, spread, samples)
+            
+            # If R, G, B are different by more than threshold, it's color
+            return spread > threshold
+        except (ValueError, RuntimeError):
             # If error, assume grayscale
             return False
     
-    def _detect_format(self, page):
+    def _detect_format(self, page_idx):
         """Wykrywa format strony (A4, A3, itp.)"""
-        rect = page.rect
-        width_pt = rect.width
-        height_pt = rect.height
-        
-        # Convert to mm
-        width_mm = round(width_pt / 72 * 25.4)
-        height_mm = round(height_pt / 72 * 25.4)
+        # Wymiary w mm z indeksu metadanych (bez load_page)
+        width_mm, height_mm = self.viewer.page_metadata().size_mm(page_idx)
         
         # Check known formats with tolerance
         tol = 5
@@ -4279,10 +7196,9 @@ class PDFAnalysisDialog(tk.Toplevel):
         
         return "Niestandardowy"
     
-    def _is_landscape(self, page):
+    def _is_landscape(self, page_idx):
         """Sprawdza czy strona jest w orientacji poziomej"""
-        rect = page.rect
-        return rect.width > rect.height
+        return self.viewer.page_metadata().is_landscape(page_idx)
     
     def _display_results(self):
         """Wyświetla wyniki analizy jako klikalne przyciski"""
@@ -4302,16 +7218,13 @@ class PDFAnalysisDialog(tk.Toplevel):
                 dim_to_pages = {}
                 dim_to_landscape = {}
                 for idx in data['pages']:
-                    page = self.viewer.pdf_document[idx]
-                    rect = page.rect
-                    width_mm = round(rect.width / 72 * 25.4)
-                    height_mm = round(rect.height / 72 * 25.4)
+                    width_mm, height_mm = self.viewer.page_metadata().size_mm(idx)
                     dim_label = f"{width_mm}x{height_mm} mm"
                     if dim_label not in dim_to_pages:
                         dim_to_pages[dim_label] = []
                         dim_to_landscape[dim_label] = 0
                     dim_to_pages[dim_label].append(idx)
-                    if self._is_landscape(page):
+                    if self._is_landscape(idx):
                         dim_to_landscape[dim_label] += 1
                 for dim_label, idxs in dim_to_pages.items():
                     if dim_label not in color_format_groups[color]:
@@ -4399,12 +7312,9 @@ class PDFAnalysisDialog(tk.Toplevel):
                 dim_to_pages = {}
                 dim_to_orient = {}
                 for idx in data['pages']:
-                    page = self.viewer.pdf_document[idx]
-                    rect = page.rect
-                    width_mm = round(rect.width / 72 * 25.4)
-                    height_mm = round(rect.height / 72 * 25.4)
+                    width_mm, height_mm = self.viewer.page_metadata().size_mm(idx)
                     dim_label = f"{width_mm}x{height_mm} mm"
-                    orient = 'Poziome' if self._is_landscape(page) else 'Pionowe'
+                    orient = 'Poziome' if self._is_landscape(idx) else 'Pionowe'
                     if dim_label not in dim_to_pages:
                         dim_to_pages[dim_label] = {'Pionowe': [], 'Poziome': []}
                     dim_to_pages[dim_label][orient].append(idx)
@@ -4415,8 +7325,7 @@ class PDFAnalysisDialog(tk.Toplevel):
                     format_orientation_totals[dim_label]['Poziome'].extend(orient_dict['Poziome'])
             else:
                 for idx in data['pages']:
-                    page = self.viewer.pdf_document[idx]
-                    orient = 'Poziome' if self._is_landscape(page) else 'Pionowe'
+                    orient = 'Poziome' if self._is_landscape(idx) else 'Pionowe'
                     if fmt not in format_orientation_totals:
                         format_orientation_totals[fmt] = {'Pionowe': [], 'Poziome': []}
                     format_orientation_totals[fmt][orient].append(idx)
@@ -4505,19 +7414,7 @@ class PDFAnalysisDialog(tk.Toplevel):
             self.viewer.update_focus_display()
             
             # Scroll to first selected page
-            if self.viewer.active_page_index in self.viewer.thumb_frames:
-                frame = self.viewer.thumb_frames[self.viewer.active_page_index]
-                self.viewer.canvas.yview_moveto(0)  # Reset scroll first
-                frame.update_idletasks()
-                # Calculate position
-                frame_y = frame.winfo_y()
-                canvas_height = self.viewer.canvas.winfo_height()
-                scroll_region = self.viewer.canvas.cget("scrollregion")
-                if scroll_region:
-                    _, _, _, max_y = map(int, scroll_region.split())
-                    if max_y > 0:
-                        fraction = frame_y / max_y
-                        self.viewer.canvas.yview_moveto(max(0, fraction))
+            self.viewer._scroll_to_page(self.viewer.active_page_index, align_top=True)
     
     def close(self):
         """Zamknij okno"""
@@ -4533,6 +7430,195 @@ class PDFAnalysisDialog(tk.Toplevel):
         self.destroy()
 
 
+class PageProfileDialog(tk.Toplevel):
+    """
+    Profil renderowania stron: czas renderu miniatury i miary złożoności każdej strony,
+    posortowane wg kosztu, z mapą ciepła w siatce miniatur i eksportem do CSV.
+    """
+    COLUMNS = (
+        ("page", "Strona", 60),
+        ("time", "Render (ms)", 90),
+        ("content", "Treść (KB)", 80),
+        ("drawings", "Rysunki", 70),
+        ("images", "Obrazy", 60),
+        ("largest", "Największy obraz", 120),
+        ("megapixels", "Megapiksele", 90),
+        ("fonts", "Fonty", 60),
+    )
+
+    def __init__(self, parent, viewer):
+        super().__init__(parent)
+        self.parent = parent
+        self.viewer = viewer
+        self.title("Profil renderowania stron")
+        self.transient(parent)
+        self.resizable(True, True)
+        self.geometry("760x520")
+        self.minsize(500, 300)
+
+        self.rows = []  # Wiersze profilu: słowniki z kluczami jak COLUMNS
+        self.sort_column = "time"
+        self.sort_descending = True
+
+        self.build_ui()
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.after(100, self.profile_pages)
+
+    def build_ui(self):
+        main_frame = ttk.Frame(self, padding="12")
+        main_frame.pack(fill="both", expand=True)
+
+        button_frame = ttk.Frame(main_frame)
+        button_frame.pack(fill="x", pady=(0, 8))
+        ttk.Button(button_frame, text="Profiluj", command=self.profile_pages, width=15).pack(side="left", padx=(0, 8))
+        ttk.Button(button_frame, text="Eksportuj CSV...", command=self.export_csv, width=15).pack(side="left", padx=(0, 8))
+        self.heat_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(button_frame, text="Podświetl ciężkie strony w siatce", variable=self.heat_var,
+                        command=self._apply_heat).pack(side="left")
+
+        self.status_label = ttk.Label(main_frame, text="")
+        self.status_label.pack(fill="x", pady=(0, 4))
+
+        table_frame = ttk.Frame(main_frame)
+        table_frame.pack(fill="both", expand=True, pady=(0, 8))
+        self.tree = ttk.Treeview(table_frame, columns=[column for column, _, _ in self.COLUMNS], show="headings")
+        for column, heading, width in self.COLUMNS:
+            self.tree.heading(column, text=heading, command=lambda c=column: self._sort_by(c))
+            self.tree.column(column, width=width, anchor="center" if column == "largest" else "e")
+        for _, color in self.viewer.HEAT_COLORS:
+            self.tree.tag_configure(color, foreground=color)
+        scrollbar = ttk.Scrollbar(table_frame, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+        # Dwuklik zaznacza stronę w głównym oknie
+        self.tree.bind("<Double-1>", self._on_row_activated)
+
+        ttk.Button(main_frame, text="Zamknij", command=self.close, width=15).pack()
+
+    def profile_pages(self):
+        """Mierzy wszystkie strony dokumentu (czasy zapisane przy renderze w tle są używane ponownie)."""
+        doc = self.viewer.pdf_document
+        if not doc:
+            self.status_label.config(text="Brak otwartego dokumentu PDF.")
+            return
+        self.rows = []
+        page_count = len(doc)
+        started = time.perf_counter()
+        for page_index in range(page_count):
+            if page_index % 10 == 0:
+                self.status_label.config(text=f"Profilowanie strony {page_index + 1} z {page_count}...")
+                self.update()
+                if not self.winfo_exists() or self.viewer.pdf_document is not doc:
+                    return
+            profile = page_profile(doc, doc.load_page(page_index))
+            self.rows.append({
+                "page": page_index + 1,
+                "time": self.viewer.measure_page_render_time(page_index),
+                "content": profile["bajty treści"],
+                "drawings": profile["rysunki"],
+                "images": profile["obrazy"],
+                "largest": profile["największy obraz"],
+                "megapixels": profile["megapiksele obrazów"],
+                "fonts": profile["fonty"],
+            })
+        total = sum(row["time"] for row in self.rows if row["time"] is not None)
+        over_budget = sum(1 for row in self.rows if row["time"] is None)
+        status = f"Stron: {page_count}, łączny czas renderu miniatur: {total * 1000:.0f} ms"
+        if over_budget:
+            status += f", ponad limit czasu: {over_budget}"
+        self.status_label.config(text=f"{status} (profil: {time.perf_counter() - started:.1f} s)")
+        self._apply_heat()
+
+    @staticmethod
+    def _sort_value(row, column):
+        value = row[column]
+        if column == "time" and value is None:
+            return float("inf")  # Strony ponad budżet czasu są najdroższe
+        if column == "largest":
+            width, _, height = value.partition("x")
+            return int(width) * int(height) if value else 0
+        return value
+
+    def _sorted_rows(self):
+        return sorted(self.rows, key=lambda row: self._sort_value(row, self.sort_column), reverse=self.sort_descending)
+
+    def _sort_by(self, column):
+        if column == self.sort_column:
+            self.sort_descending = not self.sort_descending
+        else:
+            self.sort_column, self.sort_descending = column, column != "page"
+        self._fill_tree()
+
+    def _fill_tree(self):
+        self.tree.delete(*self.tree.get_children())
+        for row in self._sorted_rows():
+            color = self.viewer.page_heat_color(row["page"] - 1)
+            self.tree.insert("", "end", iid=str(row["page"] - 1), tags=(color,) if color else (), values=(
+                row["page"],
+                "ponad limit" if row["time"] is None else f"{row['time'] * 1000:.1f}",
+                f"{row['content'] / 1024:.1f}",
+                row["drawings"], row["images"], row["largest"], row["megapixels"], row["fonts"],
+            ))
+
+    def _apply_heat(self):
+        """Włącza/wyłącza mapę ciepła w siatce miniatur (i kolory wierszy tabeli)."""
+        if self.heat_var.get() and self.rows:
+            self.viewer.set_page_heat({row["page"] - 1: row["time"] for row in self.rows})
+        else:
+            self.viewer.set_page_heat(None)
+        self._fill_tree()
+
+    def _on_row_activated(self, event):
+        item = self.tree.identify_row(event.y)
+        if not item or not self.viewer.pdf_document:
+            return
+        page_index = int(item)
+        if not 0 <= page_index < len(self.viewer.pdf_document):
+            return
+        self.viewer.selected_pages = {page_index}
+        self.viewer.update_selection_display()
+        self.viewer.active_page_index = page_index
+        self.viewer.update_focus_display()
+        self.viewer._scroll_to_page(page_index, align_top=True)
+
+    def export_csv(self):
+        """Zapisuje profil (w bieżącej kolejności) do pliku CSV."""
+        if not self.rows:
+            custom_messagebox(self, "Informacja", "Brak danych profilu do eksportu.", typ="info")
+            return
+        filepath = filedialog.asksaveasfilename(
+            parent=self, defaultextension=".csv", filetypes=[("Pliki CSV", "*.csv")],
+            title="Eksportuj profil stron")
+        if not filepath:
+            return
+        try:
+            # utf-8-sig i średnik - plik otwiera się poprawnie w polskim Excelu
+            with open(filepath, "w", newline="", encoding="utf-8-sig") as csv_file:
+                writer = csv.writer(csv_file, delimiter=";")
+                writer.writerow(["strona", "render_ms", "bajty_tresci", "rysunki", "obrazy",
+                                 "najwiekszy_obraz", "megapiksele_obrazow", "fonty"])
+                for row in self._sorted_rows():
+                    writer.writerow([
+                        row["page"], "" if row["time"] is None else f"{row['time'] * 1000:.1f}",
+                        row["content"], row["drawings"], row["images"], row["largest"],
+                        row["megapixels"], row["fonts"],
+                    ])
+        except OSError as e:
+            custom_messagebox(self, "Błąd", f"Nie udało się zapisać pliku CSV: {e}", typ="error")
+            return
+        self.viewer._update_status(f"Profil stron zapisany: {filepath}")
+
+    def close(self):
+        """Zamyka okno i wyłącza mapę ciepła w siatce."""
+        self.viewer.set_page_heat(None)
+        if self.viewer.page_profile_dialog is self:
+            self.viewer.page_profile_dialog = None
+        self.parent.focus_force()
+        self.viewer._bind_mousewheel()
+        self.destroy()
+
+
 # ====================================================================
 # WAIT OVERLAY - Modal popup for blocking UI during operations
 # ====================================================================
@@ -5162,8 +8248,9 @@ class SelectablePDFViewer:
         settings = dialog.result
         if settings is None:
             return
-        # Zapisz stan dokumentu przed jakąkolwiek modyfikacją (undo)
-        self._save_state_to_undo()
+        # Zapisz stan dokumentu przed jakąkolwiek modyfikacją (undo). Zawsze kopie stron:
+        # insert_text dodaje font do zasobów strony, czego PyMuPDF nie wykona w operacji dziennika
+        self._save_state_to_undo(pages=self.selected_pages)
         if settings.get('watermark_shift', False):
             import re
             watermark_pattern = r"\d+:\d{8,}"
@@ -5527,7 +8614,7 @@ class SelectablePDFViewer:
         try:
             pages_to_process = sorted(list(self.selected_pages))
             if pages_to_process:     # Zapisz stan tylko jeśli są strony do modyfikacji
-                self._save_state_to_undo()
+                self._save_state_to_undo(pages=pages_to_process, in_place=True)
             modified_count = 0
             
             # Update status first to ensure it's visible immediately
@@ -5646,6 +8733,7 @@ class SelectablePDFViewer:
             ("Poprzednia strona", "PageUp"),
             ("Następna strona", "PageDown"),
             ("Podgląd strony (popup)", "Środkowy przycisk myszy"),
+            ("Powiększ/pomniejsz miniatury", "Ctrl + kółko myszy"),
             ("Nawigacja", "Strzałki, Spacja, Esc"),
         ]
 
@@ -6008,10 +9096,7 @@ class SelectablePDFViewer:
             
             # 3. RĘCZNE CZYSZCZENIE I ODŚWIEŻENIE WIDOKU
             # Używamy zestawu metod zidentyfikowanych w Twoim kodzie:
-            self.tk_images.clear()
-            for widget in list(self.scrollable_frame.winfo_children()): 
-                widget.destroy()
-            self.thumb_frames.clear()
+            self._clear_thumbnail_grid()
 
             self._reconfigure_grid()
             self.update_tool_button_states()
@@ -6084,12 +9169,8 @@ class SelectablePDFViewer:
         """Zaznacza strony pionowe (wysokość > szerokość)."""
         if not self.pdf_document: return
         
-        indices = []
-        for i in range(len(self.pdf_document)):
-            page = self.pdf_document.load_page(i)
-            # Sprawdzenie, czy wysokość bounding boxu jest większa niż szerokość
-            if page.rect.height > page.rect.width:
-                indices.append(i)
+        meta = self.page_metadata()
+        indices = [i for i in range(len(meta)) if meta.is_portrait(i)]
         self._apply_selection_by_indices(indices)
         self._record_action('select_portrait')
         
@@ -6097,12 +9178,8 @@ class SelectablePDFViewer:
         """Zaznacza strony poziome (szerokość >= wysokość)."""
         if not self.pdf_document: return
         
-        indices = []
-        for i in range(len(self.pdf_document)):
-            page = self.pdf_document.load_page(i)
-            # Sprawdzenie, czy szerokość bounding boxu jest większa lub równa wysokości
-            if page.rect.width >= page.rect.height:
-                indices.append(i)
+        meta = self.page_metadata()
+        indices = [i for i in range(len(meta)) if not meta.is_portrait(i)]
         self._apply_selection_by_indices(indices)
         self._record_action('select_landscape')
 
@@ -6150,9 +9227,8 @@ class SelectablePDFViewer:
             
             for idx, index in enumerate(selected_indices):
                 if index < len(self.pdf_document):
-                    page = self.pdf_document.load_page(index)
-                    
-                    pix = page.get_pixmap(matrix=matrix, alpha=False)
+                    with full_quality_rendering():
+                        pix = self.get_page_displaylist(index).get_pixmap(matrix=matrix, alpha=False)
                     
                     # Generuj unikalną nazwę pliku
                     single_page_range = str(index + 1)
@@ -6160,7 +9236,7 @@ class SelectablePDFViewer:
                         output_dir, base_filename, single_page_range, "png"
                     )
                     
-                    pix.save(output_path)
+                    pixmap_to_image(pix, copy=False).save(output_path, format="PNG", dpi=(export_dpi, export_dpi))
                     exported_count += 1
                     self.update_progressbar(idx + 1)
             
@@ -6190,11 +9266,39 @@ class SelectablePDFViewer:
 
         self.pdf_document = None
         self.selected_pages: Set[int] = set()
-        # Multi-width thumbnail cache: {page_index: {width: ImageTk.PhotoImage}}
-        self.tk_images: Dict[int, Dict[int, ImageTk.PhotoImage]] = {}
+        # Cache miniatur (obrazy PIL, LRU z budżetem bajtów) - klucz: (odcisk treści strony, szerokość, maks. wysokość)
+        try:
+            cache_mb = int(self.prefs_manager.get('thumbnail_cache_mb', '256'))
+        except ValueError:
+            cache_mb = 256
+        self.thumbnail_cache = ThumbnailCache(max(16, cache_mb) * 1024 * 1024)
+        # Sparsowane strony (DisplayList) współdzielone przez podgląd, analizę, eksport i wyszukiwanie pustych stron
+        try:
+            displaylist_mb = int(self.prefs_manager.get('displaylist_cache_mb', '128'))
+        except ValueError:
+            displaylist_mb = 128
+        self.displaylist_cache = DisplayListCache(max(8, displaylist_mb) * 1024 * 1024)
+        self._displaylist_document = None
+        # Indeks metadanych stron (wymiary, obrót, format) - zamiast load_page przy każdym odczycie
+        self.page_metadata_index = PageMetadataIndex()
+        # Odciski treści stron (xref strony -> skrót) liczone leniwie dla bieżącego obiektu dokumentu
+        self._page_fingerprints: Dict[int, str] = {}
+        self._fingerprint_document = None
+        # Baza źródła wątków renderujących: (dokument, filepath, data, {xref strony: (indeks, /Rotate)})
+        # i xrefy stron zmienionych w miejscu od jej zapisu (patrz _ensure_render_source)
+        self._render_base = None
+        self._render_changed_xrefs: Set[int] = set()
         self.icons: Dict[str, Union[ImageTk.PhotoImage, str]] = {}
         
+        # Wirtualizowana siatka: ramki tylko dla widocznych wierszy (+ margines), reszta w puli
         self.thumb_frames: Dict[int, 'ThumbnailFrame'] = {}
+        self._frame_pool: List['ThumbnailFrame'] = []
+        self._grid_cols = 1
+        self._grid_cell_width = 1
+        self._grid_row_height = 1
+        self._thumb_max_height = 1
+        self._visible_update_id = None
+        self._hide_mouse_focus = False
         self.active_page_index = 0 
 
         self.clipboard: Optional[bytes] = None 
@@ -6203,16 +9307,72 @@ class SelectablePDFViewer:
         # Track current page preview popup (only one at a time)
         self.current_preview_popup: Optional['PagePreviewPopup'] = None
         
-        # Thumbnail settings - fixed width, no zoom
-        self.thumb_width = 205          # Fixed thumbnail width
+        # Thumbnail settings - szerokość wg poziomu powiększenia (Ctrl+kółko myszy)
+        self.THUMB_ZOOM_LEVELS = (120, 160, 205, 260, 330)  # Poziomy piramidy miniatur (szerokość w px)
+        self.thumb_zoom_index = self.THUMB_ZOOM_LEVELS.index(205)
+        self.thumb_width = self.THUMB_ZOOM_LEVELS[self.thumb_zoom_index]
+        # Największy poziom użyty dla dokumentu - w tej szerokości renderuje MuPDF,
+        # mniejsze poziomy powstają przez zmniejszenie obrazu w PIL
+        self._pyramid_base_width = self.thumb_width
         self.THUMB_PADDING = 0          # Padding between thumbnails
         self.min_cols = 2               # Minimum columns (for safety)
-        self.max_cols = 8               # Maximum columns (for safety)
+        self.max_cols = 12              # Maximum columns (for safety)
+        self.THUMB_MAX_ASPECT = 1.6     # Maks. stosunek wysokości do szerokości pola miniatury
+        self._thumb_max_aspect = self.THUMB_MAX_ASPECT  # Bieżący stosunek (wg najwyższej strony dokumentu)
+        self.GRID_MARGIN_ROWS = 2       # Dodatkowe wiersze renderowane nad i pod widokiem
+        self.MAX_DRAFT_IMAGES = 1000    # Limit szkiców oczekujących na ostrą miniaturę
+        # Siatka z widgetów (ThumbnailFrame) albo z elementów canvasu (ThumbnailCanvasCell)
+        self._canvas_item_grid = self.prefs_manager.get('thumbnail_grid_mode', 'frames') == 'canvas'
         self.MIN_WINDOW_WIDTH = 950
         
-        self.undo_stack: List[bytes] = []
-        self.redo_stack: List[bytes] = []
+        self.undo_stack: List[UndoStep] = []
+        self.redo_stack: List[UndoStep] = []
+        # Wspólne dane kroków historii (adresowane skrótem, starsze pakowane i zrzucane na dysk)
+        self.undo_store = UndoBlobStore(self._undo_memory_budget_pref())
         self.max_stack_size = 50
+        # Otwarta operacja dziennika MuPDF: (dokument, JournalStep) - zamykana przy następnym zapisie historii
+        self._journal_op = None
+        # Dziennik sesji na dysku (odzyskiwanie po awarii) i strony zmienione od ostatniego rekordu
+        self.session_journal: Optional[SessionJournal] = None
+        self._session_document = None  # Obiekt dokumentu, do którego odnoszą się xrefy dziennika
+        self._session_changed_xrefs: Set[int] = set()
+        self._session_record_id = None
+        
+        # Renderowanie miniatur w tle (własne instancje dokumentu w wątkach roboczych)
+        try:
+            render_workers = int(self.prefs_manager.get('thumbnail_render_workers', '2'))
+        except ValueError:
+            render_workers = 2
+        try:
+            disk_cache_mb = int(self.prefs_manager.get('thumbnail_disk_cache_mb', '512'))
+        except ValueError:
+            disk_cache_mb = 512
+        self.thumbnail_disk_cache = ThumbnailDiskCache(
+            THUMBNAIL_CACHE_DIR, max(0, disk_cache_mb) * 1024 * 1024)
+        self.thumbnail_renderer = ThumbnailRenderer(
+            master, self._on_thumbnail_rendered, max_workers=render_workers,
+            disk_cache=self.thumbnail_disk_cache,
+            progressive=self.prefs_manager.get('thumbnail_progressive', 'True') == 'True',
+            on_stats=self._on_render_stats, on_timeout=self._on_thumbnail_timeout,
+            time_budget_ms=self._render_budget_pref(), on_color=self._on_thumbnail_color,
+            on_render_time=self._on_thumbnail_render_time,
+            backend='processes' if self.prefs_manager.get('thumbnail_render_backend', 'threads') == 'processes' else 'threads')
+        self.thumbnail_renderer.color_samples = self._color_samples_pref()
+        # Odciski treści stron, których render przekroczył budżet czasu (placeholder z renderem na żądanie)
+        self._complex_fingerprints: Set[str] = set()
+        # Kolory mapy ciepła stron wg czasu renderu (profil stron), kluczowane odciskiem treści
+        self._heat_colors: Dict[str, str] = {}
+        self.page_profile_dialog = None
+        # Dokument, którego miniatury /Thumb są aktualne (otwarty plik do pierwszej modyfikacji)
+        self._embedded_thumbnails_document = None
+        self._apply_thumbnail_quality()
+        self._last_view_first = 0  # Pierwsza widoczna strona (kierunek przewijania dla kolejki renderowania)
+        self._scroll_settle_id = None  # Timer końca przewijania (przywrócenie kolejności ostrych renderów)
+        # Szkice z pierwszego przebiegu (do czasu nadejścia ostrej miniatury)
+        self._draft_images: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+        self._document_password: Optional[str] = None
+        self._document_id: Optional[str] = None  # Identyfikator pliku dla cache miniatur na dysku
+        self._placeholder_images: Dict[tuple, ImageTk.PhotoImage] = {}
         
         # Debouncing for window resize events
         self._resize_timer = None
@@ -6355,18 +9515,24 @@ class SelectablePDFViewer:
         self.progress_bar = ttk.Progressbar(status_frame, orient="horizontal", length=200, mode="determinate")
         self.progress_bar.pack(side=tk.RIGHT, padx=(5, 5))
         self.progress_bar.pack_forget()  # Ukryj na starcie
+        
+        # Stan kolejki renderowania miniatur (głębokość, opóźnienie)
+        self.render_stats_label = tk.Label(status_frame, text="", anchor=tk.E, bg="#f0f0f0", fg="gray")
+        self.render_stats_label.pack(side=tk.RIGHT, padx=(5, 5))
 
 
         self.canvas = tk.Canvas(master, bg="#F5F5F5") 
         self.scrollbar = tk.Scrollbar(master, orient="vertical", command=self.canvas.yview)
         
-        self.scrollable_frame = tk.Frame(self.canvas, bg="#F5F5F5") 
-        
-        self.canvas_window_id = self.canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
-        
         self.canvas.bind("<Configure>", self._reconfigure_grid) 
-        
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        if self._canvas_item_grid:
+            # Komórki nie są widgetami - stronę pod kursorem wyznacza arytmetyka siatki
+            self.canvas.bind("<Button-1>", self._on_canvas_grid_click)
+            self.canvas.bind("<Button-2>", self._on_canvas_grid_middle_click)
+            self.canvas.bind("<Button-3>", self._on_canvas_grid_right_click)
+        
+        # Każda zmiana widoku (przewijanie, zmiana rozmiaru) przepina ramki do widocznych stron
+        self.canvas.configure(yscrollcommand=self._on_canvas_yscroll)
         self.scrollbar.pack(side="right", fill="y")
         self.canvas.pack(side="left", fill="both", expand=True) 
 
@@ -6377,6 +9543,8 @@ class SelectablePDFViewer:
         
         self.update_tool_button_states() 
         self._setup_drag_and_drop_file()
+        # Dzienniki sesji po awarii - propozycja odzyskania, gdy okno jest już widoczne
+        self.master.after(200, self._offer_session_recovery)
 
     # --- Metody obsługi GUI i zdarzeń (Bez zmian) ---
     
@@ -6394,10 +9562,19 @@ class SelectablePDFViewer:
                 self.save_document() 
                 if len(self.undo_stack) > 0:
                     return 
+                self.thumbnail_renderer.shutdown()
+                self.undo_store.close()
+                self._end_session_journal()
                 self.master.quit() 
             else: 
+                self.thumbnail_renderer.shutdown()
+                self.undo_store.close()
+                self._end_session_journal()
                 self.master.quit()
         else:
+            self.thumbnail_renderer.shutdown()
+            self.undo_store.close()
+            self._end_session_journal()
             self.master.quit()
 
     def _set_initial_geometry(self):
@@ -6494,6 +9671,8 @@ class SelectablePDFViewer:
         self.edit_menu = tk.Menu(menu_bar, tearoff=0)
         menu_bar.add_cascade(label="Edycja", menu=self.edit_menu)
         self._populate_edit_menu(self.edit_menu)
+        self.edit_menu.add_separator()
+        self.edit_menu.add_command(label="Rozmiar historii zmian...", command=self.show_undo_history_size, state=tk.DISABLED)
         
         self.modifications_menu = tk.Menu(menu_bar, tearoff=0)
         menu_bar.add_cascade(label="Modyfikacje", menu=self.modifications_menu)
@@ -6507,6 +9686,7 @@ class SelectablePDFViewer:
         self.external_menu = tk.Menu(menu_bar, tearoff=0)
         menu_bar.add_cascade(label="Programy", menu=self.external_menu)
         self.external_menu.add_command(label="Analiza PDF", command=self.show_pdf_analysis, state=tk.DISABLED, accelerator="F11")
+        self.external_menu.add_command(label="Profil renderowania stron", command=self.show_page_profile, state=tk.DISABLED)
         self.external_menu.add_command(label="Konwertuj wybrane strony do grayscale (Ghostscript)", command=self.convert_selected_pages_to_grayscale, state=tk.DISABLED)
         self.external_menu.add_separator()
         self.external_menu.add_command(label="Scalanie plików PDF", command=self.merge_pdf_files)
@@ -6521,6 +9701,17 @@ class SelectablePDFViewer:
     def show_preferences_dialog(self):
         """Wyświetla okno dialogowe preferencji"""
         PreferencesDialog(self.master, self.prefs_manager)
+        # Ustawienia miniatur działające bez ponownego uruchomienia
+        self.thumbnail_renderer.progressive = self.prefs_manager.get('thumbnail_progressive', 'True') == 'True'
+        self.thumbnail_renderer.time_budget_ms = self._render_budget_pref()
+        self.thumbnail_renderer.color_samples = self._color_samples_pref()
+        self.undo_store.budget_bytes = self._undo_memory_budget_pref()
+        if self._apply_thumbnail_quality() and self.pdf_document is not None:
+            # Miniatury w innej jakości - wyrenderuj widoczne od nowa
+            self.thumbnail_cache.clear()
+            self._draft_images.clear()
+            self._clear_thumbnail_grid()
+            self._reconfigure_grid()
         # Restore focus and mousewheel bindings after dialog closes
         self.master.focus_force()
         self._bind_mousewheel()
@@ -6802,6 +9993,69 @@ class SelectablePDFViewer:
     def _get_page_frame(self, index) -> Optional['ThumbnailFrame']:
         return self.thumb_frames.get(index)
 
+    def _page_at_canvas_point(self, x, y):
+        """Zwraca indeks strony pod punktem okna canvasu (arytmetyka siatki) albo None."""
+        if not self.pdf_document or not self._grid_row_height or not self._grid_cell_width:
+            return None
+        col = int(self.canvas.canvasx(x) // self._grid_cell_width)
+        row = int(self.canvas.canvasy(y) // self._grid_row_height)
+        if col < 0 or col >= self._grid_cols or row < 0:
+            return None
+        page_index = row * self._grid_cols + col
+        return page_index if page_index < len(self.pdf_document) else None
+
+    def _on_canvas_grid_click(self, event):
+        page_index = self._page_at_canvas_point(event.x, event.y)
+        if page_index is not None:
+            cell = self.thumb_frames.get(page_index)
+            if cell is not None and cell.hit_render_button(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)):
+                self.render_complex_page(page_index)
+                return
+            self._handle_lpm_click(page_index, event)
+
+    def _on_canvas_grid_middle_click(self, event):
+        page_index = self._page_at_canvas_point(event.x, event.y)
+        if page_index is not None:
+            self._show_page_preview(page_index)
+        return "break"
+
+    def _on_canvas_grid_right_click(self, event):
+        page_index = self._page_at_canvas_point(event.x, event.y)
+        if page_index is not None:
+            self._show_page_context_menu(event, page_index)
+
+    def _show_page_preview(self, page_index):
+        """Pokazuje podgląd strony w popupie (zamyka poprzedni)."""
+        # Close previous popup if exists
+        if self.current_preview_popup:
+            try:
+                if self.current_preview_popup.winfo_exists():
+                    self.current_preview_popup._cleanup_and_close()
+            except tk.TclError:
+                # Widget already destroyed, just clear the reference
+                self.current_preview_popup = None
+        
+        # Create new popup and store reference
+        self.current_preview_popup = PagePreviewPopup(
+            self.master, 
+            self.pdf_document, 
+            page_index,
+            self
+        )
+        return "break"  # Prevent event propagation to single-click handler
+
+    def _show_page_context_menu(self, event, page_index):
+        """Menu kontekstowe strony (PPM) - zaznacza stronę, jeśli nie była zaznaczona."""
+        self.active_page_index = page_index
+        
+        if page_index not in self.selected_pages:
+             self.selected_pages.clear()
+             self.selected_pages.add(page_index)
+             self.update_selection_display()
+        
+        self.update_focus_display(hide_mouse_focus=False) 
+        self.context_menu.tk_popup(event.x_root, event.y_root)
+
     def _move_focus_and_scroll(self, delta: int):
         if not self.pdf_document: return
         new_index = self.active_page_index + delta
@@ -6809,21 +10063,27 @@ class SelectablePDFViewer:
         if 0 <= new_index <= max_index:
             self.active_page_index = new_index
             self.update_focus_display(hide_mouse_focus=False)  
-            frame = self._get_page_frame(self.active_page_index)
-            if frame:
-                self.canvas.update_idletasks()
-                y1 = frame.winfo_y()
-                y2 = frame.winfo_y() + frame.winfo_height()
-                bbox = self.canvas.bbox("all")
-                total_height = bbox[3] if bbox is not None else 1
-                norm_top = y1 / total_height
-                norm_bottom = y2 / total_height
-                current_top, current_bottom = self.canvas.yview()
-                if norm_top < current_top:
-                    self.canvas.yview_moveto(norm_top)
-                elif norm_bottom > current_bottom:
-                    scroll_pos = norm_bottom - (current_bottom - current_top)
-                    self.canvas.yview_moveto(scroll_pos)
+            self._scroll_to_page(self.active_page_index)
+
+    def _scroll_to_page(self, page_index, align_top=False):
+        """
+        Przewija siatkę tak, aby wiersz ze stroną był widoczny.
+        Pozycja wiersza wynika z arytmetyki siatki - strona nie musi mieć ramki.
+        """
+        if not self.pdf_document or len(self.pdf_document) == 0:
+            return
+        num_rows = math.ceil(len(self.pdf_document) / self._grid_cols)
+        total_height = max(1, num_rows * self._grid_row_height)
+        y1 = (page_index // self._grid_cols) * self._grid_row_height
+        y2 = y1 + self._grid_row_height
+        norm_top = y1 / total_height
+        norm_bottom = y2 / total_height
+        current_top, current_bottom = self.canvas.yview()
+        if align_top or norm_top < current_top:
+            self.canvas.yview_moveto(norm_top)
+        elif norm_bottom > current_bottom:
+            scroll_pos = norm_bottom - (current_bottom - current_top)
+            self.canvas.yview_moveto(scroll_pos)
     
     def _jump_to_first_page(self):
         """Przejdź do pierwszej strony (Home)"""
@@ -6831,9 +10091,7 @@ class SelectablePDFViewer:
             return
         self.active_page_index = 0
         self.update_focus_display(hide_mouse_focus=False)
-        frame = self._get_page_frame(0)
-        if frame:
-            self.canvas.yview_moveto(0)
+        self.canvas.yview_moveto(0)
     
     def _jump_to_last_page(self):
         """Przejdź do ostatniej strony (End)"""
@@ -6841,47 +10099,28 @@ class SelectablePDFViewer:
             return
         self.active_page_index = len(self.pdf_document) - 1
         self.update_focus_display(hide_mouse_focus=False)
-        frame = self._get_page_frame(self.active_page_index)
-        if frame:
-            self.canvas.yview_moveto(1.0)
+        self.canvas.yview_moveto(1.0)
+    
+    def _rows_per_view(self):
+        """Liczba pełnych wierszy miniatur mieszczących się w oknie."""
+        canvas_height = self.canvas.winfo_height()
+        return max(1, canvas_height // max(1, self._grid_row_height))
     
     def _page_up(self):
         """Przewiń w górę o jedną 'stronę' miniatur (PageUp)"""
         if not self.pdf_document:
             return
-        # Oblicz ile wierszy mieści się w oknie
-        canvas_height = self.canvas.winfo_height()
-        # Oszacuj wysokość wiersza (średnia wysokość miniatury + padding)
-        if self.thumb_frames:
-            first_frame = self._get_page_frame(0)
-            if first_frame:
-                row_height = first_frame.winfo_height() + self.THUMB_PADDING
-                rows_per_page = max(1, canvas_height // row_height)
-                # Przesuń fokus o liczbę miniatur odpowiadającą liczbie wierszy * liczbie kolumn
-                delta = -(rows_per_page * self._get_current_num_cols())
-                self._move_focus_and_scroll(delta)
-                return
-        # Fallback - przesuń o 10 stron
-        self._move_focus_and_scroll(-10)
+        # Przesuń fokus o liczbę miniatur odpowiadającą liczbie wierszy * liczbie kolumn
+        delta = -(self._rows_per_view() * self._get_current_num_cols())
+        self._move_focus_and_scroll(delta)
     
     def _page_down(self):
         """Przewiń w dół o jedną 'stronę' miniatur (PageDown)"""
         if not self.pdf_document:
             return
-        # Oblicz ile wierszy mieści się w oknie
-        canvas_height = self.canvas.winfo_height()
-        # Oszacuj wysokość wiersza (średnia wysokość miniatury + padding)
-        if self.thumb_frames:
-            first_frame = self._get_page_frame(0)
-            if first_frame:
-                row_height = first_frame.winfo_height() + self.THUMB_PADDING
-                rows_per_page = max(1, canvas_height // row_height)
-                # Przesuń fokus o liczbę miniatur odpowiadającą liczbie wierszy * liczbie kolumn
-                delta = rows_per_page * self._get_current_num_cols()
-                self._move_focus_and_scroll(delta)
-                return
-        # Fallback - przesuń o 10 stron
-        self._move_focus_and_scroll(10)
+        # Przesuń fokus o liczbę miniatur odpowiadającą liczbie wierszy * liczbie kolumn
+        delta = self._rows_per_view() * self._get_current_num_cols()
+        self._move_focus_and_scroll(delta)
                         
     def _handle_lpm_click(self, page_index, event):
         # Validate page_index before using it
@@ -7008,6 +10247,8 @@ class SelectablePDFViewer:
             "Zamień strony miejscami": two_pages_state,
             "Usuń puste strony": reverse_state,
             "Analiza PDF": reverse_state,
+            "Profil renderowania stron": reverse_state,
+            "Rozmiar historii zmian...": reverse_state,
             "Konwertuj wybrane strony do grayscale (Ghostscript)": delete_state
             
         }
@@ -7059,6 +10300,7 @@ class SelectablePDFViewer:
 
         try:
             if self.pdf_document: self.pdf_document.close()
+            self._end_session_journal()
             
             # Krok 1: inicjalizacja progresu i status
             # Update status FIRST, then show progress bar to ensure message is visible
@@ -7091,25 +10333,31 @@ class SelectablePDFViewer:
                     )
                     self._update_status("BŁĄD: Nieprawidłowe hasło do pliku PDF.")
                     return
+            else:
+                password = None
                 
             
             # Krok 4: czyszczenie i GUI
             # Status is updated and visible immediately thanks to _update_status() calling update_idletasks()
             self._update_status("Wczytywanie dokumentu i czyszczenie widoku...")
             self.pdf_document = doc
+            # Niezmodyfikowany plik wątki robocze mogą czytać wprost z dysku
+            self._document_password = password
+            self._document_id = os.path.normcase(os.path.realpath(filepath))
+            self.thumbnail_cache.clear()
+            self._draft_images.clear()
+            self.displaylist_cache.clear()
+            self._set_render_base(filepath=filepath)
+            self._embedded_thumbnails_document = doc  # /Thumb z pliku jako pierwszy przebieg miniatur
+            self._heat_colors.clear()
             self.selected_pages = set()
-            self.tk_images = {}
             self.undo_stack.clear()
             self.redo_stack.clear()
             self.clipboard = None
             self.pages_in_clipboard_count = 0
             self.active_page_index = 0
-            self.thumb_frames.clear()
-            self.undo_stack.clear()
-            self.redo_stack.clear()
-            for widget in list(self.scrollable_frame.winfo_children()):
-                widget.destroy()
-            self.thumb_width = 205  # Reset to default thumbnail width
+            self._clear_thumbnail_grid()
+            self._pyramid_base_width = self.thumb_width  # Nowy dokument - piramida od bieżącego poziomu
             self._reconfigure_grid()
             
             # Final status update - will be immediately visible
@@ -7119,6 +10367,7 @@ class SelectablePDFViewer:
             self.update_tool_button_states()
             self.update_focus_display()
             self.prefs_manager.set('last_opened_file', filepath)   
+            self._start_session_journal(filepath)
             
         except Exception as e:
             self._update_status(f"BŁĄD: Nie udało się wczytać pliku PDF: {e}")
@@ -7146,11 +10395,19 @@ class SelectablePDFViewer:
         if self.pdf_document is not None:
             self.pdf_document.close()
             self.pdf_document = None
+        self._end_session_journal()
+        self.thumbnail_renderer.set_source(None)
+        self._render_base = None
+        self._document_password = None
+        self._document_id = None
+        self._embedded_thumbnails_document = None
+        self._heat_colors.clear()
+        self.thumbnail_cache.clear()
+        self._draft_images.clear()
+        self.displaylist_cache.clear()
         self.selected_pages.clear()
-        self.tk_images.clear()
-        self.thumb_frames.clear()
-        for widget in list(self.scrollable_frame.winfo_children()):
-            widget.destroy()
+        self._clear_thumbnail_grid()
+        self._reconfigure_grid()
         self.undo_stack.clear()
         self.redo_stack.clear()
         self.clipboard = None
@@ -7189,14 +10446,19 @@ class SelectablePDFViewer:
         image_width_pt = (image_width_px / image_dpi) * 72
         image_height_pt = (image_height_px / image_dpi) * 72
 
-        # Stwórz nowy dokument PDF
+        # Stwórz nowy dokument PDF (bez pliku źródłowego - dziennik sesji nie ma na czym odtwarzać zmian)
+        self._end_session_journal()
         self.pdf_document = fitz.open()
+        self._document_password = None
+        self._document_id = None
+        self.thumbnail_cache.clear()
+        self._draft_images.clear()
+        self.displaylist_cache.clear()
+        self._invalidate_render_source()
         self.undo_stack.clear()
         self.redo_stack.clear()
         self.selected_pages.clear()
-        self.tk_images.clear()
-        for widget in list(self.scrollable_frame.winfo_children()): widget.destroy()
-        self.thumb_frames.clear()
+        self._clear_thumbnail_grid()
 
         # Nowa strona o rozmiarze obrazu
         page = self.pdf_document.new_page(width=image_width_pt, height=image_height_pt)
@@ -7285,7 +10547,7 @@ class SelectablePDFViewer:
                 else:
                     insert_index = len(self.pdf_document)
                             
-            self._save_state_to_undo()
+            self._save_state_to_undo(pages=())
             num_inserted = len(selected_indices)
             temp_doc_for_insert = fitz.open()
             
@@ -7303,9 +10565,7 @@ class SelectablePDFViewer:
             # Select the newly imported pages
             self.selected_pages = set(range(insert_index, insert_index + num_inserted))
             
-            self.tk_images.clear()
-            for widget in list(self.scrollable_frame.winfo_children()): widget.destroy()
-            self.thumb_frames.clear()
+            self._clear_thumbnail_grid()
 
             self._reconfigure_grid()
             self.update_selection_display()
@@ -7457,17 +10717,14 @@ class SelectablePDFViewer:
             else:
                 insert_index = len(self.pdf_document)
 
-            self._save_state_to_undo()
+            self._save_state_to_undo(pages=())
             self.pdf_document.insert_pdf(imported_doc, from_page=0, to_page=0, start_at=insert_index)
             
             # Select the newly imported image page
             self.selected_pages = {insert_index}
             self.active_page_index = insert_index
 
-            self.tk_images.clear()
-            for widget in list(self.scrollable_frame.winfo_children()):
-                widget.destroy()
-            self.thumb_frames.clear()
+            self._clear_thumbnail_grid()
 
             self._reconfigure_grid()
             self.update_selection_display()
@@ -7544,22 +10801,249 @@ class SelectablePDFViewer:
         """
         self.wait_overlay.hide()
             
-    def _save_state_to_undo(self):
-        """Zapisuje bieżący stan dokumentu na stosie undo i czyści stos redo."""
+    def _save_state_to_undo(self, pages=None, in_place=False):
+        """
+        Zapisuje bieżący stan dokumentu na stosie undo i czyści stos redo.
+
+        pages to indeksy stron, które operacja usunie lub zmieni w miejscu - tylko one
+        są kopiowane (UndoStep); dodawanie, przestawianie i obracanie stron nie wymaga
+        kopii (pages=()). Bez pages zapisywana jest pełna migawka - dla operacji, które
+        budują dokument od nowa.
+
+        in_place=True oznacza operację, która nie zmienia liczby ani kolejności stron -
+        przy preferencji undo_backend = 'journal' jest zapisywana w dzienniku MuPDF
+        (JournalStep) zamiast kopii stron.
+        """
         if self.pdf_document:
-            buffer = self.pdf_document.write()
-            self.undo_stack.append(buffer)
+            if in_place and self.prefs_manager.get('undo_backend', 'pages') == 'journal':
+                self._start_journal_op(pages)
+            else:
+                self._end_journal_session()
+                self.undo_stack.append(UndoStep.capture(self.pdf_document, self.undo_store, pages))
+            self._mark_session_changed(range(len(self.pdf_document)) if pages is None else pages)
             if len(self.undo_stack) > self.max_stack_size:
                 self.undo_stack.pop(0)
             # Każda nowa modyfikacja czyści stos redo
             self.redo_stack.clear()
+            # Dokument zaraz się zmieni - wątki renderujące muszą dostać nową migawkę
+            self._invalidate_render_source(pages)
+            # ... a miniatury /Thumb z pliku mogą przestać odpowiadać treści stron
+            self._embedded_thumbnails_document = None
             self.update_tool_button_states()
         else:
             self.undo_stack.clear()
             self.redo_stack.clear()
-            print("DEBUG: Czyszczenie historii _save_state_to_undo")
-            self.update_tool_button_states()
-            
+            print("DEBUG: Czyszczenie historii _save_state_to_undo")
+            self.update_tool_button_states()
+            
+    def _start_journal_op(self, pages):
+        """Otwiera operację dziennika MuPDF dla edycji w miejscu i odkłada JournalStep na stos undo."""
+        doc = self.pdf_document
+        self._end_journal_op()
+        if not doc.journal_is_enabled():
+            doc.journal_enable()
+        step = JournalStep(doc.journal_position()[0], pages)
+        # Operacja zostaje otwarta do następnego zapisu historii, cofnięcia lub zapisu pliku -
+        # obejmuje wszystkie zmiany wykonane przez bieżące polecenie
+        doc.journal_start_op("edycja")
+        self._journal_op = (doc, step)
+        self.undo_stack.append(step)
+
+    def _end_journal_op(self):
+        """Zamyka otwartą operację dziennika i zapamiętuje pozycję dziennika po niej."""
+        if self._journal_op is None:
+            return
+        doc, step = self._journal_op
+        self._journal_op = None
+        if doc is not self.pdf_document or doc.is_closed:
+            return
+        doc.journal_stop_op()
+        step.after = doc.journal_position()[0]
+
+    def _prepare_direct_access(self):
+        """
+        Przygotowuje dokument do odczytu tekstu i rysunków stron (get_text, search_for,
+        get_drawings) lub zmian poza historią. Przy włączonym dzienniku MuPDF każdy zapis
+        wymaga otwartej operacji - także wewnętrzny: odczyt tekstu obróconej strony
+        tymczasowo zeruje jej /Rotate. Bez otwartej operacji dziennik jest kończony.
+        """
+        if self._journal_op is None:
+            self._end_journal_session()
+
+    def _end_journal_session(self):
+        """
+        Kończy pracę z dziennikiem MuPDF przed operacją, której dziennik nie obsługuje
+        (insert_pdf i new_page przy włączonym dzienniku zgłaszają błąd).
+
+        Kroki JournalStep na szczytach stosów są zamieniane na UndoStep - dziennik jest
+        przewijany do stanu, który krok przywraca, i kopiowane są tylko strony zmienione
+        przez krok. Potem dziennik jest odpinany od dokumentu (JournalStep.discard):
+        obiekt dokumentu, numery obiektów i źródło renderowania zostają bez zmian.
+        """
+        doc = self.pdf_document
+        if not doc or not doc.journal_is_enabled():
+            return
+        self._end_journal_op()
+        position = doc.journal_position()[0]
+        for stack in (self.undo_stack, self.redo_stack):
+            index = len(stack)
+            while index > 0 and stack[index - 1].in_place:
+                index -= 1
+                step = stack[index]
+                JournalStep.seek(doc, step.before if step.undo else step.after)
+                stack[index] = UndoStep.capture(doc, self.undo_store, step.pages)
+            JournalStep.seek(doc, position)
+        JournalStep.discard(doc)
+
+    def _start_session_journal(self, source_path):
+        """Zaczyna dziennik sesji (odzyskiwanie po awarii) dla dokumentu wczytanego z source_path."""
+        self._end_session_journal()
+        if self.prefs_manager.get('session_journal', 'True') != 'True' or not self.pdf_document:
+            return
+        if self._document_password is not None:
+            # Dziennik zapisuje treść stron bez szyfrowania - dokumenty z hasłem są pomijane
+            return
+        try:
+            self.session_journal = SessionJournal.start(SESSION_JOURNAL_DIR, source_path, self.pdf_document)
+        except OSError as e:
+            print(f"[SESJA] Nie można utworzyć dziennika sesji w {SESSION_JOURNAL_DIR}: {e}")
+            return
+        self._session_document = self.pdf_document
+
+    def _end_session_journal(self):
+        """Kończy dziennik sesji i usuwa jego plik (dokument zamknięty lub zapisany)."""
+        if self._session_record_id is not None:
+            self.master.after_cancel(self._session_record_id)
+            self._session_record_id = None
+        if self.session_journal is not None:
+            self.session_journal.close()
+            self.session_journal = None
+        self._session_document = None
+        self._session_changed_xrefs.clear()
+
+    def _mark_session_changed(self, pages=()):
+        """Zapamiętuje strony zmieniane w miejscu i planuje dopisanie stanu dokumentu do dziennika sesji."""
+        if self.session_journal is None:
+            return
+        page_count = len(self.pdf_document)
+        self._session_changed_xrefs.update(
+            self.pdf_document.page_xref(page_index) for page_index in pages if 0 <= page_index < page_count)
+        if self._session_record_id is None:
+            self._session_record_id = self.master.after(SESSION_RECORD_DELAY_MS, self._write_session_record)
+
+    def _write_session_record(self):
+        """Dopisuje do dziennika sesji stan dokumentu po zakończonej operacji."""
+        if self._session_record_id is not None:
+            self.master.after_cancel(self._session_record_id)
+            self._session_record_id = None
+        doc = self.pdf_document
+        if self.session_journal is None or doc is None:
+            return
+        if self.progress_bar.winfo_manager():
+            # Operacja wciąż trwa (pasek postępu) - stan zapisywany po jej zakończeniu
+            self._session_record_id = self.master.after(SESSION_RECORD_DELAY_MS, self._write_session_record)
+            return
+        try:
+            reset = doc is not self._session_document
+            changed = set(self._session_changed_xrefs)
+            base = None
+            if reset or all(doc.page_xref(i) in changed for i in range(len(doc))):
+                # Dziennik nie zna żadnej strony - zamiast kopiować cały dokument bierze bajty,
+                # które wątki renderujące i tak dostają po podmianie dokumentu (baza źródła)
+                self._ensure_render_source()
+                base = self._render_base_state()
+                if base is not None:
+                    changed.update(base[2])
+                    base = base[:2]
+            self.session_journal.record(doc, self.status_bar.cget("text"), changed, reset=reset, base=base)
+        except Exception as e:
+            print(f"[SESJA] Nie można zapisać dziennika sesji: {e}")
+            self._end_session_journal()
+            self._update_status(f"BŁĄD: Dziennik sesji wyłączony - nie udało się go zapisać: {e}")
+            return
+        self._session_document = doc
+        self._session_changed_xrefs.clear()
+
+    def _offer_session_recovery(self):
+        """Po starcie proponuje odtworzenie sesji przerwanej awarią programu (z dziennika sesji)."""
+        for path in SessionJournal.find_orphans(SESSION_JOURNAL_DIR):
+            if self.pdf_document is not None:
+                return  # Otwarty już dokument - pozostałe dzienniki przy następnym uruchomieniu
+            try:
+                header, records = SessionJournal.read(path)
+            except (OSError, ValueError) as e:
+                print(f"[SESJA] Nieczytelny dziennik sesji {path}: {e}")
+                records = []
+            if not records:
+                self._remove_session_file(path)
+                continue
+            source = header["source"]
+            started = datetime.fromtimestamp(header["started"]).strftime("%Y-%m-%d %H:%M")
+            if not SessionJournal.source_matches(header):
+                custom_messagebox(self.master, "Odzyskiwanie sesji",
+                                  f"Nie można odzyskać zmian z sesji rozpoczętej {started}:\n"
+                                  f"plik {source} został zmieniony, przeniesiony lub usunięty.", typ="warning")
+                self._remove_session_file(path)
+                continue
+            last_meta = records[-1][0]
+            last_time = datetime.fromtimestamp(last_meta["time"]).strftime("%Y-%m-%d %H:%M")
+            answer = custom_messagebox(
+                self.master, "Odzyskiwanie sesji",
+                f"Program nie został poprawnie zamknięty podczas pracy nad plikiem:\n{source}\n\n"
+                f"Niezapisanych zmian w dzienniku: {len(records)} (ostatnia {last_time}: {last_meta['op']})\n\n"
+                "Czy odtworzyć te zmiany?", typ="question")
+            if answer:
+                self._recover_session(path, header, records)
+                return
+            self._remove_session_file(path)
+
+    @staticmethod
+    def _remove_session_file(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"[SESJA] Nie można usunąć dziennika sesji {path}: {e}")
+
+    def _recover_session(self, path, header, records):
+        """Otwiera plik źródłowy sesji i odtwarza na nim zapisane zmiany (z historią cofnij)."""
+        self.open_pdf(filepath=header["source"])
+        if self.pdf_document is None:
+            return  # Błąd otwarcia pokazany w pasku statusu - dziennik zostaje na później
+        self._update_status("Odtwarzanie zmian z dziennika sesji...")
+        self.show_progressbar(maximum=len(records))
+        progress = iter(range(1, len(records) + 1))
+
+        def before_record(removed):
+            # Każdy rekord to krok historii - odtworzone zmiany można cofać jak zwykłe operacje
+            self._save_state_to_undo(pages=removed)
+            self.update_progressbar(next(progress))
+
+        try:
+            SessionJournal.replay(self.pdf_document, header, records, before_record)
+        except Exception as e:
+            self.hide_progressbar()
+            custom_messagebox(self.master, "Odzyskiwanie sesji",
+                              f"Nie udało się odtworzyć zmian z dziennika sesji: {e}", typ="error")
+            # Dokument mógł zostać częściowo zmieniony - wczytaj plik źródłowy od nowa
+            self.undo_stack.clear()
+            self.redo_stack.clear()
+            self.open_pdf(filepath=header["source"])
+            self._remove_session_file(path)
+            return
+        self.hide_progressbar()
+        # Odtworzony stan trafia do nowego dziennika, zanim stary zostanie usunięty
+        self._write_session_record()
+        if self.session_journal is None or self.session_journal.flush():
+            self._remove_session_file(path)
+        self._invalidate_render_source()
+        self.selected_pages.clear()
+        self.active_page_index = 0
+        self._clear_thumbnail_grid()
+        self._reconfigure_grid()
+        self.update_tool_button_states()
+        self.update_focus_display()
+        self._update_status(f"Odtworzono {len(records)} zmian z dziennika sesji. Zapisz dokument, aby je zachować.")
+
     def _get_page_bytes(self, page_indices: Set[int]) -> bytes:
         temp_doc = fitz.open()
         sorted_indices = sorted(list(page_indices))
@@ -7587,7 +11071,7 @@ class SelectablePDFViewer:
             self._update_status("BŁĄD: Zaznacz strony do wycięcia.")
             return
         try:
-            self._save_state_to_undo()
+            self._save_state_to_undo(pages=self.selected_pages)
             self.clipboard = self._get_page_bytes(self.selected_pages)
             self.pages_in_clipboard_count = len(self.selected_pages)
             pages_to_delete = sorted(list(self.selected_pages), reverse=True)
@@ -7603,9 +11087,7 @@ class SelectablePDFViewer:
             else:
                 self.active_page_index = 0
             
-            self.tk_images.clear()
-            for widget in list(self.scrollable_frame.winfo_children()): widget.destroy()
-            self.thumb_frames.clear()  
+            self._clear_thumbnail_grid()
             self._reconfigure_grid()
             self.update_tool_button_states()
             self.update_focus_display()
@@ -7649,7 +11131,7 @@ class SelectablePDFViewer:
             self._perform_paste(target_index)
         else:
             try:
-                self._save_state_to_undo()
+                self._save_state_to_undo(pages=())
                 # Sort selected pages rosnąco (wstawianie od końca nie sprawdza się, bo za każdym razem przesuwamy dokument)
                 sorted_pages = sorted(self.selected_pages)
                 new_page_indices = set()
@@ -7675,10 +11157,7 @@ class SelectablePDFViewer:
                 temp_doc.close()
                 self.selected_pages = new_page_indices
 
-                self.tk_images.clear()
-                for widget in list(self.scrollable_frame.winfo_children()):
-                    widget.destroy()
-                self.thumb_frames.clear()
+                self._clear_thumbnail_grid()
                 self._reconfigure_grid()
                 self.update_selection_display()
                 self.update_tool_button_states()
@@ -7697,7 +11176,7 @@ class SelectablePDFViewer:
 
     def _perform_paste(self, target_index: int):
         try:
-            self._save_state_to_undo()
+            self._save_state_to_undo(pages=())
             temp_doc = fitz.open("pdf", self.clipboard)
             num_inserted = len(temp_doc)
             
@@ -7711,10 +11190,7 @@ class SelectablePDFViewer:
             # Select the newly pasted pages
             self.selected_pages = set(range(target_index, target_index + num_inserted))
 
-            self.tk_images.clear()
-            for widget in list(self.scrollable_frame.winfo_children()):
-                widget.destroy()
-            self.thumb_frames.clear()
+            self._clear_thumbnail_grid()
             self._reconfigure_grid()
             self.update_selection_display()
             self.update_tool_button_states()
@@ -7754,7 +11230,7 @@ class SelectablePDFViewer:
         deleted_count = 0
         try:
             if save_state:
-                self._save_state_to_undo()
+                self._save_state_to_undo(pages=pages_to_delete)
             
             self.show_progressbar(maximum=len(pages_to_delete))
             self._update_status("Usuwanie stron...")
@@ -7766,9 +11242,7 @@ class SelectablePDFViewer:
             
             self.hide_progressbar()
             self.selected_pages.clear()
-            self.tk_images.clear()
-            for widget in list(self.scrollable_frame.winfo_children()): widget.destroy()
-            self.thumb_frames.clear()  
+            self._clear_thumbnail_grid()
             self.total_pages = len(self.pdf_document)
             self.active_page_index = min(self.active_page_index, self.total_pages - 1)
             self.active_page_index = max(0, self.active_page_index)
@@ -7927,147 +11401,131 @@ class SelectablePDFViewer:
         if len(self.undo_stack) == 0:
             self._update_status("Brak operacji do cofnięcia!")
             return
+        self._apply_history_step(self.undo_stack, self.redo_stack, "cofnięciu",
+                                 "Cofnięto ostatnią operację. Odświeżanie miniatur...",
+                                 "BŁĄD: Nie udało się cofnąć operacji")
 
-        # Zapisz bieżący stan na stos redo
-        if self.pdf_document:
-            current_state = self.pdf_document.write()
-            self.redo_stack.append(current_state)
-            if len(self.redo_stack) > self.max_stack_size:
-                self.redo_stack.pop(0)
-
-        # Pobierz poprzedni stan ze stosu undo
-        previous_state_bytes = self.undo_stack.pop()
-        
-        try:
-            old_page_count = len(self.pdf_document) if self.pdf_document else 0
-
-            if self.pdf_document:
-                self.pdf_document.close()
-            self.pdf_document = fitz.open("pdf", previous_state_bytes)
-            new_page_count = len(self.pdf_document)
-
-            # Przywróć selekcję i indeks aktywnej strony
-            self.selected_pages.clear()
-
-            # Jeśli liczba stron się nie zmieniła – nie czyść ramek/widgetów!
-            if old_page_count == new_page_count and self.thumb_frames:
-                self.tk_images.clear()
-                # Pokaz progress bar dla odświeżenia miniatur (jeśli plik jest duży)
-                if new_page_count > 10:
-                    self.show_progressbar(maximum=new_page_count, mode="determinate")
-                else:
-                    self.show_progressbar(maximum=1, mode="determinate")
-                self._update_status("Przywracanie dokumentu po cofnięciu...")
-
-                # Validate and clamp active_page_index to valid range
-                if self.pdf_document and new_page_count > 0:
-                    self.active_page_index = min(self.active_page_index, new_page_count - 1)
-                    self.active_page_index = max(0, self.active_page_index)
-                else:
-                    self.active_page_index = 0
-
-                for idx in range(new_page_count):
-                    self._update_status("Cofnięto ostatnią operację. Odświeżanie miniatur...")
-                    self.update_single_thumbnail(idx)
-                    if new_page_count > 10:
-                        self.update_progressbar(idx + 1)
-            else:
-                # Liczba stron się zmieniła: czyść wszystko i przebuduj siatkę
-                self.selected_pages.clear()
-                self.tk_images.clear()
-                self.thumb_frames.clear()
-                for widget in list(self.scrollable_frame.winfo_children()):
-                    widget.destroy()
-                self._reconfigure_grid()
-                # Validate and clamp active_page_index to valid range
-                if self.pdf_document and new_page_count > 0:
-                    self.active_page_index = min(self.active_page_index, new_page_count - 1)
-                    self.active_page_index = max(0, self.active_page_index)
-                else:
-                    self.active_page_index = 0
-
-            self.update_tool_button_states()
-            self.update_focus_display()
-            self.hide_progressbar()
-            self._update_status("Cofnięto ostatnią operację. Odświeżanie miniatur...")
-        except Exception as e:
-            self.hide_progressbar()
-            self._update_status(f"BŁĄD: Nie udało się cofnąć operacji: {e}")
-            self.pdf_document = None
-            self.update_tool_button_states()
-            
     def redo(self):
         """Ponów cofniętą operację - przywraca stan ze stosu redo."""
         if len(self.redo_stack) == 0:
             self._update_status("Brak operacji do ponowienia!")
             return
-
-        # Zapisz bieżący stan na stos undo
-        if self.pdf_document:
-            current_state = self.pdf_document.write()
-            self.undo_stack.append(current_state)
-            if len(self.undo_stack) > self.max_stack_size:
-                self.undo_stack.pop(0)
-
-        # Pobierz następny stan ze stosu redo
-        next_state_bytes = self.redo_stack.pop()
-        
+        self._apply_history_step(self.redo_stack, self.undo_stack, "ponowieniu",
+                                 "Ponowiono operację. Odświeżanie miniatur...",
+                                 "BŁĄD: Nie udało się ponowić operacji")
+
+    def show_undo_history_size(self):
+        """Pokazuje, ile zajmuje historia cofnij/ponów i gdzie są jej dane (pamięć, kompresja, dysk)."""
+        MB = 1024 * 1024
+        stats = self.undo_store.stats()
+        steps = [("Cofnij", index, step) for index, step in enumerate(reversed(self.undo_stack), start=1)]
+        steps += [("Ponów", index, step) for index, step in enumerate(reversed(self.redo_stack), start=1)]
+        # Rozmiar kroku liczony bez współdzielenia - ile zająłby jako osobna kopia
+        step_sizes = [(sum(blob.size for blob in step.blobs()), label, index) for label, index, step in steps]
+        unique_bytes = stats["raw_bytes"] + stats["packed_size"] + stats["file_size"]
+        snapshot_count = sum(1 for _, _, step in steps if step.snapshot is not None)
+        journal_count = sum(1 for _, _, step in steps if step.in_place)
+
+        lines = [
+            f"Kroki: cofnij {len(self.undo_stack)}, ponów {len(self.redo_stack)} (pełne migawki: {snapshot_count}, w dzienniku MuPDF: {journal_count})",
+            f"Dane historii: {unique_bytes / MB:.1f} MB (bez współdzielenia: {sum(size for size, _, _ in step_sizes) / MB:.1f} MB)",
+            "",
+            f"W pamięci, bez kompresji: {stats['raw_bytes'] / MB:.1f} MB ({stats['raw_count']} bloków)",
+            f"W pamięci, spakowane: {stats['packed_bytes'] / MB:.1f} MB z {stats['packed_size'] / MB:.1f} MB ({stats['packed_count']} bloków)",
+            f"Na dysku: {stats['file_size'] / MB:.1f} MB ({stats['file_count']} bloków, pliki tymczasowe: {stats['disk_bytes'] / MB:.1f} MB)",
+            f"Budżet pamięci historii: {self.undo_store.budget_bytes / MB:.0f} MB",
+        ]
+        largest = sorted(step_sizes, reverse=True)[:5]
+        if largest:
+            lines.append("")
+            lines.append("Największe kroki:")
+            lines.extend(f"  {label} {index}: {size / MB:.1f} MB" for size, label, index in largest)
+        custom_messagebox(self.master, "Rozmiar historii zmian", "\n".join(lines), typ="info")
+
+    def _apply_history_step(self, source_stack, target_stack, action_name, done_message, error_message):
+        """
+        Przywraca krok z source_stack (UndoStep.apply), a krok odwrotny odkłada na target_stack.
+        Kroki stronowe zmieniają dokument w miejscu; migawka podmienia obiekt dokumentu.
+        Krok dziennika (JournalStep) odświeża tylko zmienione miniatury, bez przebudowy siatki.
+        Krok, którego nie udało się przywrócić, wraca na source_stack, a dokument zostaje otwarty.
+        """
+        step = None
+        applied = False
         try:
+            if source_stack[-1].in_place:
+                self._end_journal_op()
+            else:
+                # Krok stronowy lub migawka - dalej bez dziennika MuPDF
+                self._end_journal_session()
+            step = source_stack.pop()
+            if not step.ready:
+                self._update_status("Kończenie zapisu historii zmian...")
             old_page_count = len(self.pdf_document) if self.pdf_document else 0
 
-            if self.pdf_document:
+            document, inverse, changed, renumbered = step.apply(self.pdf_document, self.undo_store)
+            if document is not self.pdf_document:
                 self.pdf_document.close()
-            self.pdf_document = fitz.open("pdf", next_state_bytes)
+                self.pdf_document = document
+            # Strony przywrócone z kopii mają nowe xrefy - dalsze kroki w tym samym
+            # kierunku historii muszą się do nich odwoływać (aż do punktu kontrolnego,
+            # za którym xrefy należą do innej wersji dokumentu)
+            for remaining in reversed(source_stack):
+                if remaining.snapshot is not None:
+                    break
+                remaining.renumber(renumbered)
+            target_stack.append(inverse)
+            applied = True
+            if len(target_stack) > self.max_stack_size:
+                target_stack.pop(0)
+            # Strony zmienione w miejscu (obrót, treść) zachowują xref - trzeba je wskazać wprost
+            self._mark_session_changed(changed)
+            self._invalidate_render_source(changed)
+            if step.in_place and len(self.pdf_document) == old_page_count:
+                # Dziennik przywrócił treść stron w tym samym obiekcie dokumentu - wystarczy
+                # odświeżyć zmienione miniatury (siatka, selekcja i przewinięcie bez zmian)
+                for page_index in changed:
+                    self.update_single_thumbnail(page_index)
+                self.update_tool_button_states()
+                self.update_focus_display()
+                self.hide_progressbar()
+                self._update_status(done_message)
+                return
+            # Strona zmieniona w miejscu zachowuje xref - indeks metadanych trzeba odświeżyć wprost
+            for page_index in changed:
+                self.page_metadata_index.update_page(self.pdf_document, page_index)
             new_page_count = len(self.pdf_document)
 
             # Przywróć selekcję i indeks aktywnej strony
             self.selected_pages.clear()
 
-            # Jeśli liczba stron się nie zmieniła – nie czyść ramek/widgetów!
+            # Cache jest kluczowany odciskiem treści, więc renderowane są wyłącznie
+            # strony, których treść różni się od stanu sprzed operacji.
             if old_page_count == new_page_count and self.thumb_frames:
-                self.tk_images.clear()
-                # Pokaz progress bar dla odświeżenia miniatur (jeśli plik jest duży)
-                if new_page_count > 10:
-                    self.show_progressbar(maximum=new_page_count, mode="determinate")
-                else:
-                    self.show_progressbar(maximum=1, mode="determinate")
-                self._update_status("Przywracanie dokumentu po ponowieniu...")
+                self._update_status(f"Przywracanie dokumentu po {action_name}...")
 
-                # Validate and clamp active_page_index to valid range
-                if self.pdf_document and new_page_count > 0:
-                    self.active_page_index = min(self.active_page_index, new_page_count - 1)
-                    self.active_page_index = max(0, self.active_page_index)
-                else:
-                    self.active_page_index = 0
-
-                for idx in range(new_page_count):
-                    self._update_status("Ponowiono operację. Odświeżanie miniatur...")
-                    self.update_single_thumbnail(idx)
-                    if new_page_count > 10:
-                        self.update_progressbar(idx + 1)
+            # Validate and clamp active_page_index to valid range
+            if new_page_count > 0:
+                self.active_page_index = min(self.active_page_index, new_page_count - 1)
+                self.active_page_index = max(0, self.active_page_index)
             else:
-                # Liczba stron się zmieniła: czyść wszystko i przebuduj siatkę
-                self.selected_pages.clear()
-                self.tk_images.clear()
-                self.thumb_frames.clear()
-                for widget in list(self.scrollable_frame.winfo_children()):
-                    widget.destroy()
-                self._reconfigure_grid()
-                # Validate and clamp active_page_index to valid range
-                if self.pdf_document and new_page_count > 0:
-                    self.active_page_index = min(self.active_page_index, new_page_count - 1)
-                    self.active_page_index = max(0, self.active_page_index)
-                else:
-                    self.active_page_index = 0
+                self.active_page_index = 0
+
+            self._clear_thumbnail_grid()
+            self._reconfigure_grid()
 
             self.update_tool_button_states()
             self.update_focus_display()
             self.hide_progressbar()
-            self._update_status("Ponowiono operację. Odświeżanie miniatur...")
+            self._update_status(done_message)
         except Exception as e:
+            if step is not None and not applied:
+                source_stack.append(step)
             self.hide_progressbar()
-            self._update_status(f"BŁĄD: Nie udało się ponowić operacji: {e}")
-            self.pdf_document = None
+            self._update_status(f"{error_message}: {e}")
+            # Krok stronowy mógł zmienić dokument częściowo - siatka pokazuje jego bieżący stan
+            self._invalidate_render_source()
+            self._clear_thumbnail_grid()
+            self._reconfigure_grid()
             self.update_tool_button_states()
         
     def save_document(self):
@@ -8096,10 +11554,20 @@ class SelectablePDFViewer:
             self.prefs_manager.set('last_save_path', os.path.dirname(filepath))
         
         try:
-            # Zapisz PDF do bufora
-            temp_buffer = io.BytesIO()
-            self.pdf_document.save(temp_buffer, garbage=4, clean=True, pretty=True)
-            pdf_bytes = temp_buffer.getvalue()
+            # Zapisz PDF do bufora (otwarta operacja dziennika MuPDF nie może objąć zapisu)
+            self._end_journal_op()
+            # garbage=4 przenumerowuje obiekty także w dokumencie, który zapisuje - porządkowana
+            # jest kopia, więc xrefy otwartego dokumentu (kroki historii, odciski stron) zostają
+            copy = fitz.open("pdf", self._render_base_bytes() or self.pdf_document.tobytes(garbage=0))
+            try:
+                pdf_bytes = copy.tobytes(garbage=4, clean=True, pretty=True)
+            finally:
+                copy.close()
+            
+            # Miniatury stron w pliku (/Thumb) - przed watermarkiem, pypdf zachowuje je na stronach
+            if self.prefs_manager.get('thumbnail_embed_on_save', 'False') == 'True':
+                self._update_status("Zapisywanie miniatur stron w pliku...")
+                pdf_bytes = embed_page_thumbnails(pdf_bytes, self._thumbnails_for_embedding(pdf_bytes))
             
             # Sprawdź czy dodać watermark na podstawie preferencji
             add_watermark = self.prefs_manager.get('watermark_on_save', 'False') == 'True'
@@ -8121,12 +11589,64 @@ class SelectablePDFViewer:
             # Po zapisaniu czyścimy stosy undo/redo
             self.undo_stack.clear()
             self.redo_stack.clear()
+            # Zmiany są w pliku - dalsze odzyskiwanie po awarii zaczyna się od zapisanej wersji
+            self._start_session_journal(filepath)
             print("DEBUG: Czyszczenie historii save_document")
             self.update_tool_button_states() 
             
         except Exception as e:
             self._update_status(f"BŁĄD: Nie udało się zapisać pliku: {e}")
             
+    def _thumbnails_for_embedding(self, pdf_bytes):
+        """
+        Miniatury wszystkich stron do zapisu jako /Thumb: z cache miniatur (wg indeksu
+        strony otwartego dokumentu), a brakujące renderowane w rozmiarze
+        EMBEDDED_THUMB_MAX_SIZE w wątku pomocniczym z pdf_bytes - zapisywanej kopii
+        z tymi samymi stronami. Strony przekraczające budżet czasu renderu są pomijane.
+        """
+        thumbnails = {}
+        missing = []
+        for page_index in range(len(self.pdf_document)):
+            image = self._cached_thumbnail(page_index)
+            if image is not None:
+                thumbnails[page_index] = image
+            elif not self.is_complex_page(page_index):
+                missing.append(page_index)
+        if not missing:
+            return thumbnails
+
+        rendered = {}
+        errors = []
+
+        def render_missing():
+            try:
+                doc = fitz.open("pdf", pdf_bytes)
+                try:
+                    for page_index in missing:
+                        with full_quality_rendering():
+                            rendered[page_index] = render_page_thumbnail(doc[page_index], EMBEDDED_THUMB_MAX_SIZE,
+                                                                         max_height=EMBEDDED_THUMB_MAX_SIZE)
+                finally:
+                    doc.close()
+            except Exception as e:
+                errors.append(e)
+
+        worker = threading.Thread(target=render_missing, name="EmbeddedThumbnails", daemon=True)
+        self.show_progressbar(maximum=len(missing))
+        try:
+            worker.start()
+            # Okno odświeża się w trakcie renderu (jak przy konwersji Ghostscriptem)
+            while worker.is_alive():
+                worker.join(0.05)
+                self.update_progressbar(len(rendered))
+                self.master.update()
+        finally:
+            self.hide_progressbar()
+        if errors:
+            raise errors[0]
+        thumbnails.update(rendered)
+        return thumbnails
+
     def rotate_selected_page(self, angle):
         if not self.pdf_document or not self.selected_pages: 
             self._update_status("BŁĄD: Zaznacz strony do obrotu.")
@@ -8139,8 +11659,11 @@ class SelectablePDFViewer:
             self._record_action('rotate_right')
         
         pages_to_rotate = sorted(list(self.selected_pages))
+        # Obrócone miniatury powstaną z obecnych (transpozycja obrazu zamiast renderowania)
+        transpose = self.ROTATION_TRANSPOSE.get(angle % 360)
+        source_images = {page_index: self._cached_thumbnail(page_index) for page_index in pages_to_rotate}
         try:
-            self._save_state_to_undo()
+            self._save_state_to_undo(pages=(), in_place=True)
             self.show_progressbar(maximum=len(pages_to_rotate))
             rotated_count = 0
             for idx, page_index in enumerate(pages_to_rotate):
@@ -8158,7 +11681,9 @@ class SelectablePDFViewer:
             for i, page_index in enumerate(pages_to_rotate):
                 self._update_status(f"Obrócono {rotated_count} stron o {angle} stopni. Odświeżanie miniatur...")
                
-                self.update_single_thumbnail(page_index)
+                source = source_images.get(page_index)
+                derived = source.transpose(transpose) if source is not None and transpose is not None else None
+                self.update_single_thumbnail(page_index, derived_image=derived)
                 self.update_progressbar(i + 1)
             self.hide_progressbar()
             
@@ -8195,9 +11720,13 @@ class SelectablePDFViewer:
         width, height = (595.276, 841.89)  # Domyślny A4
 
         try:
-            self._save_state_to_undo()
-
             sorted_pages = sorted(self.selected_pages)
+            # Wymiary sąsiednich stron z indeksu (przed wstawianiem, które przesuwa pozycje)
+            meta = self.page_metadata()
+            neighbor_sizes = {p: meta.size(p) for p in sorted_pages if p < len(meta)}
+
+            self._save_state_to_undo(pages=())
+
             new_page_indices = set()
             offset = 0
 
@@ -8206,12 +11735,8 @@ class SelectablePDFViewer:
             self._update_status("Wstawianie pustych stron...")
 
             for idx, page_index in enumerate(sorted_pages):
-                try:
-                    rect = self.pdf_document[page_index + offset].rect
-                    width = rect.width
-                    height = rect.height  
-                except Exception:
-                    pass  # Zostaw domyślne
+                if page_index in neighbor_sizes:
+                    width, height = neighbor_sizes[page_index]
 
                 if before:
                     target_page = page_index + offset
@@ -8229,10 +11754,10 @@ class SelectablePDFViewer:
 
             self.selected_pages = new_page_indices
 
-            self.tk_images.clear()
-            for widget in list(self.scrollable_frame.winfo_children()):
-                widget.destroy()
-            self.thumb_frames.clear()
+            self._clear_thumbnail_grid()
+            # Miniatura pustej strony to biały prostokąt - bez renderowania
+            for page_index in new_page_indices:
+                self._put_derived_thumbnail(page_index, None)
             self._reconfigure_grid()
             self.update_selection_display()
             self.update_tool_button_states()
@@ -8268,11 +11793,16 @@ class SelectablePDFViewer:
                 return
 
         try:
-            self._save_state_to_undo()
-
             # Sort pages in ascending order
             sorted_pages = sorted(self.selected_pages)
+            # Kopie dostaną miniatury oryginałów (te same obrazy, bez renderowania)
+            source_images = {page_index: self._cached_thumbnail(page_index) for page_index in sorted_pages}
+            source_fingerprints = {page_index: self._page_fingerprint(page_index) for page_index in sorted_pages}
+
+            self._save_state_to_undo(pages=())
+
             new_page_indices = set()
+            copies = {}
             offset = 0
             
             self.show_progressbar(maximum=len(sorted_pages))
@@ -8293,6 +11823,7 @@ class SelectablePDFViewer:
                 temp_doc.close()
                 # Wstawiona strona jest zawsze na pozycji idx+1
                 new_page_indices.add(idx + 1)
+                copies[idx + 1] = original_index
                 offset += 1
                 self.update_progressbar(idx_progress + 1)
 
@@ -8300,10 +11831,14 @@ class SelectablePDFViewer:
             self.selected_pages = new_page_indices
 
             # Odświeżenie GUI
-            self.tk_images.clear()
-            for widget in list(self.scrollable_frame.winfo_children()):
-                widget.destroy()
-            self.thumb_frames.clear()
+            self._clear_thumbnail_grid()
+            for page_index, original_index in copies.items():
+                # Wynik wykrywania koloru oryginału dotyczy tej samej treści - kopia go dziedziczy
+                self.page_metadata_index.copy_color_spread(source_fingerprints[original_index],
+                                                           self._page_fingerprint(page_index))
+                image = source_images.get(original_index)
+                if image is not None:
+                    self._put_derived_thumbnail(page_index, image)
             self._reconfigure_grid()
             self.update_selection_display()
             self.update_tool_button_states()
@@ -8324,7 +11859,7 @@ class SelectablePDFViewer:
             return
         
         try:
-            self._save_state_to_undo()
+            self._save_state_to_undo(pages=self.selected_pages)
             
             # Pokaż pasek postępu (4 kroki: kopiuj stronę 1, kopiuj stronę 2, usuń, wstaw)
             self.show_progressbar(maximum=4)
@@ -8334,6 +11869,11 @@ class SelectablePDFViewer:
             pages = sorted(list(self.selected_pages))
             page1_idx = pages[0]
             page2_idx = pages[1]
+            # Zamienione strony dostaną swoje dotychczasowe miniatury i wyniki wykrywania koloru
+            image1 = self._cached_thumbnail(page1_idx)
+            image2 = self._cached_thumbnail(page2_idx)
+            fingerprint1 = self._page_fingerprint(page1_idx)
+            fingerprint2 = self._page_fingerprint(page2_idx)
             
             # Create temporary documents for both pages
             temp_doc1 = fitz.open()
@@ -8356,10 +11896,12 @@ class SelectablePDFViewer:
             
             temp_doc1.close()
             temp_doc2.close()
+            self.page_metadata_index.copy_color_spread(fingerprint2, self._page_fingerprint(page1_idx))
+            self.page_metadata_index.copy_color_spread(fingerprint1, self._page_fingerprint(page2_idx))
             
             # Odśwież tylko zamienione miniatury
-            self.update_single_thumbnail(page1_idx)
-            self.update_single_thumbnail(page2_idx)
+            self.update_single_thumbnail(page1_idx, derived_image=image2)
+            self.update_single_thumbnail(page2_idx, derived_image=image1)
             
             self.update_selection_display()
             self.update_tool_button_states()
@@ -8489,10 +12031,10 @@ class SelectablePDFViewer:
                         scale_y = bitmap_h / page_h
                     
                     # Renderuj bitmapę z zachowaniem proporcji
-                    pix = src_page.get_pixmap(matrix=fitz.Matrix(scale_x, scale_y).prerotate(rotate), alpha=False)
-                    img_bytes = pix.tobytes("png")
+                    with full_quality_rendering():
+                        pix = src_page.get_pixmap(matrix=fitz.Matrix(scale_x, scale_y).prerotate(rotate), alpha=False)
                     rect = fitz.Rect(cell_x + offset_x, cell_y + offset_y, cell_x + offset_x + render_width, cell_y + offset_y + render_height)
-                    new_page.insert_image(rect, stream=img_bytes)
+                    new_page.insert_image(rect, pixmap=pix)
                 else:
                     # Tryb "stretch" lub "dimensions" - rozciągnij do komórki
                     bitmap_w = int(round(cell_width * TARGET_DPI * PT_TO_INCH))
@@ -8506,10 +12048,10 @@ class SelectablePDFViewer:
                         scale_y = bitmap_h / page_h
 
                     # Renderuj bitmapę w bardzo wysokiej rozdzielczości, z ewentualnym obrotem
-                    pix = src_page.get_pixmap(matrix=fitz.Matrix(scale_x, scale_y).prerotate(rotate), alpha=False)
-                    img_bytes = pix.tobytes("png")
+                    with full_quality_rendering():
+                        pix = src_page.get_pixmap(matrix=fitz.Matrix(scale_x, scale_y).prerotate(rotate), alpha=False)
                     rect = fitz.Rect(cell_x, cell_y, cell_x + cell_width, cell_y + cell_height)
-                    new_page.insert_image(rect, stream=img_bytes)
+                    new_page.insert_image(rect, pixmap=pix)
 
             # Przypadek specjalny: jeśli 1 strona, powiel ją na wszystkich komórkach jednego arkusza
             if num_pages == 1:
@@ -8518,7 +12060,7 @@ class SelectablePDFViewer:
                     result_doc = fitz.open()
                 else:
                     # Dla append używamy bieżącego dokumentu
-                    self._save_state_to_undo()
+                    self._save_state_to_undo(pages=())
                     result_doc = self.pdf_document
                 
                 new_page = result_doc.new_page(width=sheet_width_pt, height=sheet_height_pt)
@@ -8543,7 +12085,7 @@ class SelectablePDFViewer:
                     result_doc = fitz.open()
                 else:
                     # Dla append używamy bieżącego dokumentu
-                    self._save_state_to_undo()
+                    self._save_state_to_undo(pages=())
                     result_doc = self.pdf_document
                 
                 self.show_progressbar(maximum=num_pages)
@@ -8606,10 +12148,7 @@ class SelectablePDFViewer:
                     self._update_status("Anulowano zapisywanie.")
             else:
                 # Dodano do bieżącego dokumentu - odśwież GUI
-                self.tk_images.clear()
-                for widget in list(self.scrollable_frame.winfo_children()):
-                    widget.destroy()
-                self.thumb_frames.clear()
+                self._clear_thumbnail_grid()
                 self._reconfigure_grid()
                 self.update_tool_button_states()
                 self.update_focus_display()
@@ -8630,6 +12169,10 @@ class SelectablePDFViewer:
         self.canvas.bind_all("<MouseWheel>", self._on_mousewheel) 
         self.canvas.bind_all("<Button-4>", self._on_mousewheel)
         self.canvas.bind_all("<Button-5>", self._on_mousewheel)
+        # Ctrl+kółko: powiększenie miniatur
+        self.canvas.bind_all("<Control-MouseWheel>", self._on_zoom_wheel)
+        self.canvas.bind_all("<Control-Button-4>", self._on_zoom_wheel)
+        self.canvas.bind_all("<Control-Button-5>", self._on_zoom_wheel)
     
     def _on_mousewheel(self, event):
         # Oblicz różnicę w pozycji yview w zależności od scrolla
@@ -8642,25 +12185,45 @@ class SelectablePDFViewer:
             new_pos = min(1, current_top + step)
             self.canvas.yview_moveto(new_pos)
             
+    def _on_zoom_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.set_thumbnail_zoom(self.thumb_zoom_index + 1)
+        elif event.num == 5 or event.delta < 0:
+            self.set_thumbnail_zoom(self.thumb_zoom_index - 1)
+        return "break"
+
+    def set_thumbnail_zoom(self, zoom_index):
+        """
+        Ustawia poziom powiększenia miniatur (indeks w THUMB_ZOOM_LEVELS) i przebudowuje siatkę.
+        Zmniejszenie korzysta z miniatur większego poziomu (zmiana rozmiaru w PIL);
+        powiększenie ponad dotychczasowy poziom renderuje strony od nowa i staje się bazą piramidy.
+        """
+        zoom_index = max(0, min(len(self.THUMB_ZOOM_LEVELS) - 1, zoom_index))
+        if zoom_index == self.thumb_zoom_index:
+            return
+        self.thumb_zoom_index = zoom_index
+        self.thumb_width = self.THUMB_ZOOM_LEVELS[zoom_index]
+        if self.pdf_document is not None:
+            self._pyramid_base_width = max(self._pyramid_base_width, self.thumb_width)
+        self._update_status(f"Powiększenie miniatur: {self.thumb_width} px")
+        self._reconfigure_grid()
+
     def _get_current_num_cols(self):
-        """Calculate current number of columns based on canvas width and thumb_width"""
+        """Zwraca liczbę kolumn bieżącego układu siatki miniatur"""
         if not self.pdf_document:
             return 1
-        
-        actual_canvas_width = self.canvas.winfo_width()
-        scrollbar_safety = 25
-        available_width = max(100, actual_canvas_width - scrollbar_safety)
-        thumb_with_padding = self.thumb_width + (2 * self.THUMB_PADDING)
-        num_cols = max(self.min_cols, int(available_width / thumb_with_padding))
-        num_cols = min(self.max_cols, num_cols)
-        return max(1, num_cols)
+        return max(1, self._grid_cols)
 
     def _reconfigure_grid(self, event=None):
         # Poprawka: sprawdzanie, czy dokument istnieje i nie jest zamknięty (NIE używaj "not self.pdf_document"!)
         if self.pdf_document is None or getattr(self.pdf_document, "is_closed", False):
-            self.canvas.config(scrollregion=self.canvas.bbox("all"))
+            self._release_all_thumbnail_frames()
+            self.canvas.config(scrollregion=(0, 0, 0, 0))
             return
 
+        # Przebudowa zwykle następuje po zmianie struktury dokumentu
+        self.page_metadata_index.mark_dirty()
+
         # Debouncing: cancel previous timer if exists
         if self._resize_timer is not None:
             self.master.after_cancel(self._resize_timer)
@@ -8669,12 +12232,17 @@ class SelectablePDFViewer:
         self._resize_timer = self.master.after(self._resize_delay, self._do_reconfigure_grid)
 
     def _do_reconfigure_grid(self):
-        """Actual grid reconfiguration logic (debounced)"""
+        """
+        Actual grid reconfiguration logic (debounced).
+        Wylicza układ wirtualnej siatki (kolumny, wysokość wiersza) i scrollregion
+        z liczby stron - bez tworzenia ramek dla niewidocznych stron.
+        """
         self._resize_timer = None
 
         # Poprawka: sprawdzanie, czy dokument istnieje i nie jest zamknięty (NIE używaj "not self.pdf_document"!)
         if self.pdf_document is None or getattr(self.pdf_document, "is_closed", False):
-            self.canvas.config(scrollregion=self.canvas.bbox("all"))
+            self._release_all_thumbnail_frames()
+            self.canvas.config(scrollregion=(0, 0, 0, 0))
             return
 
         # Save current scroll position (fractional, 0.0-1.0)
@@ -8689,225 +12257,629 @@ class SelectablePDFViewer:
         scrollbar_safety = 25  
         available_width = max(100, actual_canvas_width - scrollbar_safety)
 
-        # Calculate number of columns based on current thumbnail width
-        thumb_with_padding = self.thumb_width + (2 * self.THUMB_PADDING)
-        num_cols = max(self.min_cols, int(available_width / thumb_with_padding))
-        num_cols = min(self.max_cols, num_cols)  # Cap at max_cols
+        # Szerokość kolumny (a z nią liczba kolumn) wynika z bieżącego poziomu powiększenia
+        column_width = self.thumb_width
+        self._thumb_max_aspect = min(self.THUMB_MAX_ASPECT, self.page_metadata().max_aspect() or 1.0)
+        self._thumb_max_height = self._level_max_height(column_width)
+        cell_width, row_height = self._measure_thumbnail_cell(column_width, self._thumb_max_height)
 
+        # Calculate number of columns based on the real cell width
+        num_cols = max(self.min_cols, int(available_width / (cell_width + 2 * self.THUMB_PADDING)))
+        num_cols = min(self.max_cols, num_cols)  # Cap at max_cols
         if num_cols < 1:
             num_cols = 1
 
-        column_width = self.thumb_width
+        page_count = len(self.pdf_document)
+        num_rows = math.ceil(page_count / num_cols)
+        self._grid_cols = num_cols
+        self._grid_cell_width = cell_width + 2 * self.THUMB_PADDING
+        self._grid_row_height = row_height + 2 * self.THUMB_PADDING
 
-        # Clean up non-thumbnail widgets
-        for widget in list(self.scrollable_frame.grid_slaves()):
-            if not isinstance(widget, ThumbnailFrame):
-                widget.destroy()
+        # Scrollregion wynika z liczby stron i wysokości wiersza, a nie z bbox("all")
+        self.canvas.config(scrollregion=(0, 0, num_cols * self._grid_cell_width, max(1, num_rows * self._grid_row_height)))
 
-        # Configure grid columns
-        for col in range(self.max_cols):  
-            if col < num_cols:
-                self.scrollable_frame.grid_columnconfigure(col, weight=0, minsize=column_width)
-            else:
-                self.scrollable_frame.grid_columnconfigure(col, weight=0, minsize=0)
+        # Rozmiar komórki mógł się zmienić - przepnij ramki od nowa
+        self._release_all_thumbnail_frames()
+        self.canvas.yview_moveto(saved_scroll)
+        self._update_visible_thumbnails()
 
-        # Create or update widgets
-        if not self.thumb_frames:
-            self._create_widgets(num_cols, column_width)
-        else:
-            self._update_widgets(num_cols, column_width)
-
-        self.scrollable_frame.update_idletasks()  
-        bbox = self.canvas.bbox("all")
-        if bbox is not None:
-            self.canvas.config(scrollregion=(bbox[0], 0, bbox[2], bbox[3]))
-            self.canvas.coords(self.canvas_window_id, 0, 0)
-            # Restore previous scroll position
-            self.canvas.yview_moveto(saved_scroll)
+        self.update_selection_display()
+        self.update_focus_display()
+
+    def _level_max_height(self, column_width):
+        """Wysokość pola miniatury dla szerokości: wg najwyższej strony dokumentu, ograniczona THUMB_MAX_ASPECT."""
+        return max(1, int(column_width * self._thumb_max_aspect))
+
+    def _measure_thumbnail_cell(self, column_width, max_height):
+        """Mierzy rozmiar ramki miniatury z obrazem column_width x max_height (wraz z etykietami)."""
+        if self._canvas_item_grid:
+            return ThumbnailCanvasCell.cell_size(column_width, max_height)
+        probe = self._acquire_thumbnail_frame()
+        probe.column_width = column_width
+        probe.img_label.config(image=self._get_placeholder_image(column_width, max_height))
+        probe.page_label.config(text="Strona")
+        probe.format_label.config(text="A4")
+        probe.update_idletasks()
+        size = (probe.winfo_reqwidth(), probe.winfo_reqheight())
+        self._frame_pool.append(probe)
+        return size
+
+    def _on_canvas_yscroll(self, first, last):
+        """yscrollcommand canvasu: aktualizuje pasek przewijania i widoczne ramki."""
+        self.scrollbar.set(first, last)
+        if self._visible_update_id is None:
+            self._visible_update_id = self.master.after_idle(self._update_visible_thumbnails)
+
+    def _visible_page_range(self, margin_rows=None):
+        """Zwraca zakres indeksów stron w widocznych wierszach (+ margin_rows wierszy marginesu, domyślnie GRID_MARGIN_ROWS)."""
+        if margin_rows is None:
+            margin_rows = self.GRID_MARGIN_ROWS
+        page_count = len(self.pdf_document)
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first_row = max(0, int(top // self._grid_row_height) - margin_rows)
+        last_row = int(bottom // self._grid_row_height) + margin_rows
+        first = min(page_count, first_row * self._grid_cols)
+        last = min(page_count, (last_row + 1) * self._grid_cols)
+        return range(first, last)
+
+    def _update_visible_thumbnails(self):
+        """Przepina ramki z puli do stron w widocznym obszarze; pozostałe wracają do puli."""
+        self._visible_update_id = None
+        if self.pdf_document is None or getattr(self.pdf_document, "is_closed", False):
+            return
+        visible = self._visible_page_range()
+        self._update_render_priorities()
+        for page_index in list(self.thumb_frames):
+            if page_index not in visible:
+                self._release_thumbnail_frame(page_index)
+        for page_index in visible:
+            if page_index in self.thumb_frames:
+                continue
+            frame = self._acquire_thumbnail_frame()
+            frame.column_width = self.thumb_width
+            frame.bind_page(page_index)
+            frame.set_selected(page_index in self.selected_pages)
+            frame.set_focused(page_index == self.active_page_index and not self._hide_mouse_focus)
+            row, col = divmod(page_index, self._grid_cols)
+            frame.place_cell(col * self._grid_cell_width + self.THUMB_PADDING,
+                             row * self._grid_row_height + self.THUMB_PADDING,
+                             self._grid_cell_width - 2 * self.THUMB_PADDING,
+                             self._grid_row_height - 2 * self.THUMB_PADDING)
+            self.thumb_frames[page_index] = frame
+
+    def _update_render_priorities(self):
+        """Przekazuje kolejce renderowania widoczny zakres stron i kierunek przewijania."""
+        on_screen = self._visible_page_range(margin_rows=0)
+        direction = (on_screen.start > self._last_view_first) - (on_screen.start < self._last_view_first)
+        self._last_view_first = on_screen.start
+        if direction:
+            self._mark_scrolling()
+        # Zlecenia dalej niż dwa ekrany od widoku są anulowane (ramki i tak zostały zwolnione)
+        keep_margin = max(self.GRID_MARGIN_ROWS, 2 * self._rows_per_view())
+        self.thumbnail_renderer.set_viewport(on_screen, direction, keep=self._visible_page_range(margin_rows=keep_margin))
+
+    SCROLL_SETTLE_MS = 250
+
+    def _undo_memory_budget_pref(self):
+        """Budżet pamięci historii cofnij/ponów w bajtach."""
+        try:
+            undo_memory_mb = int(self.prefs_manager.get('undo_memory_mb', '512'))
+        except ValueError:
+            undo_memory_mb = 512
+        return max(16, undo_memory_mb) * 1024 * 1024
+
+    def _render_budget_pref(self):
+        try:
+            return max(0, int(self.prefs_manager.get('thumbnail_render_budget_ms', '3000')))
+        except ValueError:
+            return 3000
+
+    def _color_samples_pref(self):
+        try:
+            return int(self.prefs_manager.get('color_detect_samples', '300'))
+        except ValueError:
+            return 300
+
+    def _apply_thumbnail_quality(self):
+        """Przekazuje kolejce renderowania politykę jakości z preferencji. Zwraca True, jeśli się zmieniła."""
+        try:
+            aa_level = int(self.prefs_manager.get('thumbnail_aa_level', '8'))
+        except ValueError:
+            aa_level = MAX_AA_LEVEL
+        return self.thumbnail_renderer.set_quality(
+            aa_level=aa_level,
+            annots=self.prefs_manager.get('thumbnail_annots', 'True') == 'True',
+            gray_while_scrolling=self.prefs_manager.get('thumbnail_gray_while_scrolling', 'False') == 'True')
+
+    def _mark_scrolling(self):
+        """Przełącza kolejkę renderowania w tryb przewijania do czasu, aż widok się ustabilizuje."""
+        self.thumbnail_renderer.set_scrolling(True)
+        if self._scroll_settle_id is not None:
+            self.master.after_cancel(self._scroll_settle_id)
+        self._scroll_settle_id = self.master.after(self.SCROLL_SETTLE_MS, self._on_scroll_settled)
+
+    def _on_scroll_settled(self):
+        self._scroll_settle_id = None
+        self.thumbnail_renderer.set_scrolling(False)
+
+    def _on_render_stats(self, stats):
+        """Pokazuje w pasku stanu głębokość kolejki renderowania i opóźnienie miniatur."""
+        if not stats['completed'] and not stats['depth']:
+            text = ""
         else:
-            self.canvas.config(scrollregion=(0, 0, actual_canvas_width, 10))
+            text = (f"Miniatury w kolejce: {stats['depth']} | "
+                    f"opóźnienie: {stats['avg_latency_ms']:.0f} ms (ost. {stats['last_latency_ms']:.0f} ms)")
+            if stats['timed_out']:
+                text += f" | ponad limit czasu: {stats['timed_out']}"
+        if self.render_stats_label.cget("text") != text:
+            self.render_stats_label.config(text=text)
+
+    def _acquire_thumbnail_frame(self):
+        """Pobiera ramkę z puli albo tworzy nową (okno na canvasie lub komórkę z elementów canvasu)."""
+        if self._frame_pool:
+            return self._frame_pool.pop()
+        if self._canvas_item_grid:
+            return ThumbnailCanvasCell(self.canvas, self, self.thumb_width)
+        frame = ThumbnailFrame(parent=self.canvas, viewer_app=self, column_width=self.thumb_width)
+        frame.window_id = self.canvas.create_window(-10000, -10000, window=frame, anchor="nw")
+        return frame
+
+    def _release_thumbnail_frame(self, page_index):
+        """Odpina ramkę od strony, przesuwa ją poza obszar widoku i oddaje do puli."""
+        frame = self.thumb_frames.pop(page_index, None)
+        if frame is None:
+            return
+        frame.hide()
+        self._frame_pool.append(frame)
 
+    def _release_all_thumbnail_frames(self):
+        for page_index in list(self.thumb_frames):
+            self._release_thumbnail_frame(page_index)
 
-    def _get_page_size_label(self, page_index):
-        if not self.pdf_document: return ""
-        page = self.pdf_document.load_page(page_index)
-        page_width = page.rect.width
-        page_height = page.rect.height
-        width_mm = round(page_width / 72 * 25.4)
-        height_mm = round(page_height / 72 * 25.4)
-        
-        # Popularne formaty (dopuszczamy tolerancję ±5mm)
-        known_formats = {
-            "A6": (105, 148),
-            "A5": (148, 210),
-            "A4": (210, 297),
-            "A3": (297, 420),
-            "A2": (420, 594),
-            "A1": (594, 841),
-            "A0": (841, 1189),
-            # Format B (ISO 216)
-            "B0": (1000, 1414),
-            "B1": (707, 1000),
-            "B2": (500, 707),
-            "B3": (353, 500),
-            "B4": (250, 353),
-            "B5": (176, 250),
-            "B6": (125, 176),
-            "Letter": (216, 279),   # 8.5 × 11 in
-            "Legal": (216, 356),    # 8.5 × 14 in
-            "Tabloid": (279, 432),  # 11 × 17 in
-        }
-        # Tolerancja ±5mm
-        tol = 5
-        for name, (fw, fh) in known_formats.items():
-            if (abs(width_mm - fw) <= tol and abs(height_mm - fh) <= tol) or \
-               (abs(width_mm - fh) <= tol and abs(height_mm - fw) <= tol):
-                if abs(width_mm - fw) < abs(width_mm - fh):
-                    return name
-                else:
-                    return f"{name} (Poziom)"
-        return f"{width_mm} x {height_mm} mm"
+    def _clear_thumbnail_grid(self):
+        """
+        Zwalnia wszystkie ramki do puli (przed przebudową siatki).
+        Cache miniatur zostaje - jego klucze nie zależą od kolejności stron,
+        a odciski treści zostaną przeliczone dla ponownie wiązanych ramek.
+        """
+        self._page_fingerprints.clear()
+        self.page_metadata_index.mark_dirty()
+        self._release_all_thumbnail_frames()
 
 
-    def _create_widgets(self, num_cols, column_width):
-        """Tworzy wszystkie ramki miniatur dla aktualnego dokumentu PDF."""
-        page_count = len(self.pdf_document)
-        # Dodaj pasek postępu tylko przy większej liczbie stron (np. 10+), by nie przeszkadzać przy szybkim ładowaniu
-        if page_count > 10:
-            self.show_progressbar(maximum=page_count, mode="determinate")
-        for i in range(page_count):
-            page_frame = ThumbnailFrame(
-                parent=self.scrollable_frame,  
-                viewer_app=self,  
-                page_index=i,  
-                column_width=column_width
-            )
-            page_frame.grid(row=i // num_cols, column=i % num_cols, padx=self.THUMB_PADDING, pady=self.THUMB_PADDING, sticky="n")  
-            self.thumb_frames[i] = page_frame  
-            if page_count > 10:
-                self.update_progressbar(i + 1)
-        if page_count > 10:
-            self.hide_progressbar()
-        self.update_selection_display()
-        self.update_focus_display()
+    def _get_page_size_label(self, page_index):
+        if not self.pdf_document: return ""
+        return self.page_metadata().size_label(page_index)
 
-    def _update_widgets(self, num_cols, column_width):
-        page_count = len(self.pdf_document)
-        frame_bg = "#F5F5F5"
-
-        # Dodaj brakujące ramki miniaturek
-        for i in range(page_count):
-            if i not in self.thumb_frames:
-                page_frame = ThumbnailFrame(
-                    parent=self.scrollable_frame,
-                    viewer_app=self,
-                    page_index=i,
-                    column_width=column_width
-                )
-                self.thumb_frames[i] = page_frame
-
-        # Usuń nadmiarowe ramki (jeśli stron jest mniej niż widgetów)
-        to_remove = [idx for idx in self.thumb_frames if idx >= page_count]
-        for idx in to_remove:
-            self.thumb_frames[idx].destroy()
-            del self.thumb_frames[idx]
-
-        for i in range(page_count):
-            page_frame = self.thumb_frames[i]
-            page_frame.grid(row=i // num_cols, column=i % num_cols, padx=self.THUMB_PADDING, pady=self.THUMB_PADDING, sticky="n")
-            img_tk = self._render_and_scale(i, column_width)
-            page_frame.img_label.config(image=img_tk)
-            page_frame.img_label.image = img_tk
-            outer_frame_children = page_frame.outer_frame.winfo_children()
-            if len(outer_frame_children) > 2:
-                outer_frame_children[1].config(text=f"Strona {i + 1}", bg=frame_bg)
-                outer_frame_children[2].config(text=self._get_page_size_label(i), bg=frame_bg)
+    def page_metadata(self):
+        """Zwraca indeks metadanych stron uzgodniony z bieżącym dokumentem."""
+        self.page_metadata_index.sync(self.pdf_document)
+        return self.page_metadata_index
 
-        self.update_selection_display()
-        self.update_focus_display()
 
-    
     def _render_and_scale(self, page_index, column_width):
         """
-        Renderuje miniaturę strony PDF bezpośrednio w docelowym rozmiarze.
+        Zwraca miniaturę strony PDF w docelowym rozmiarze.
         
-        Funkcja generuje miniaturę dla zadanej strony PDF, renderując ją 
-        bezpośrednio w docelowej szerokości (column_width), zachowując 
-        proporcje strony. Wykorzystuje cache dla optymalizacji.
+        Jeśli miniatura jest w cache, zwraca ją od razu. W przeciwnym razie
+        zleca renderowanie w tle (ThumbnailRenderer) i zwraca szary placeholder
+        o właściwych proporcjach - gotowy obraz podmieni _on_thumbnail_rendered.
         
         Args:
             page_index: Indeks strony do renderowania (0-based)
             column_width: Docelowa szerokość miniatury w pikselach
             
         Returns:
-            ImageTk.PhotoImage: Obiekt z miniaturą gotową do wyświetlenia w Tkinter
+            ImageTk.PhotoImage: Miniatura lub placeholder gotowy do wyświetlenia w Tkinter
         """
-        # Sprawdź cache
-        if page_index in self.tk_images and column_width in self.tk_images[page_index]:
-            print(f"[CACHE] Używam cache dla strony {page_index}, szerokość {column_width}")
-            return self.tk_images[page_index][column_width]
-
-        print(f"[RENDER] Generuję miniaturę dla strony {page_index}, szerokość {column_width}")
-        
-        # Załaduj stronę i pobierz jej wymiary
+        # Sprawdź cache (PhotoImage powstaje tylko dla ramki, która wyświetli miniaturę)
+        key = self._thumbnail_key(page_index, column_width)
+        image = self.thumbnail_cache.get(key)
+        if image is None:
+            image = self._downsample_from_pyramid(page_index, key)
+        if image is not None:
+            return ImageTk.PhotoImage(image)
+
+        if key[0] in self._complex_fingerprints:
+            # Strona przekroczyła budżet czasu - renderowana tylko na żądanie (przycisk na miniaturze)
+            return self._get_placeholder_image(*self._thumbnail_image_size(page_index, column_width, self._thumb_max_height))
+
+        draft = self._draft_images.get(key)
+        if draft is None:
+            draft = self._embedded_thumbnail_draft(page_index, key)
+        if draft is not None:
+            # Szkic (lub miniatura wyprowadzona z innej) jest - brakuje tylko ostrej wersji,
+            # której zlecenie mogło zostać anulowane przy przewijaniu
+            self._request_thumbnail(page_index, key, sharp_only=True)
+            return ImageTk.PhotoImage(draft)
+
+        # Miniatura musi zmieścić się w polu wiersza wirtualnej siatki
+        width, height = self._thumbnail_image_size(page_index, column_width, self._thumb_max_height)
+        self._request_thumbnail(page_index, key)
+        return self._get_placeholder_image(width, height)
+
+    def _embedded_thumbnail_draft(self, page_index, key):
+        """
+        Szkic miniatury z obrazu /Thumb zapisanego w pliku (tylko dla dokumentu bez zmian
+        od otwarcia). Zawsze trafia do szkiców - ostry render i tak zostanie zlecony.
+        """
+        if self._embedded_thumbnails_document is not self.pdf_document or self.pdf_document is None:
+            return None
+        image = read_embedded_thumbnail(self.pdf_document, page_index)
+        if image is None:
+            return None
+        image = image.resize(self._thumbnail_image_size(page_index, key[1], key[2]), Image.BILINEAR)
+        self._remember_draft(key, image)
+        return image
+
+    def _request_thumbnail(self, page_index, key, sharp_only=False, unbounded=False):
+        """Zleca render miniatury dla klucza key - w szerokości bazy piramidy, jeśli jest większa."""
+        column_width = key[1]
+        render_width = max(column_width, self._pyramid_base_width)
+        render_key = key if render_width == column_width else (key[0], render_width, self._level_max_height(render_width))
+        self._ensure_render_source()
+        self.thumbnail_renderer.request(render_key, page_index, render_width, render_key[2],
+                                        content_digest=key[0], sharp_only=sharp_only, unbounded=unbounded)
+
+    def is_complex_page(self, page_index):
+        """Czy render miniatury strony przekroczył budżet czasu (i czeka na render na żądanie)."""
+        return bool(self._complex_fingerprints) and self._page_fingerprint(page_index) in self._complex_fingerprints
+
+    def _on_thumbnail_timeout(self, key, page_index, elapsed):
+        """Render miniatury przekroczył budżet czasu - strona dostaje placeholder z przyciskiem renderu."""
+        self._complex_fingerprints.add(key[0])
+        page_frame = self.thumb_frames.get(page_index)
+        if page_frame is not None and self._thumbnail_key(page_index, page_frame.column_width)[0] == key[0]:
+            page_frame.set_complex(True)
+        self._update_status(f"Strona {page_index + 1} jest zbyt złożona do szybkiego renderu miniatury "
+                            f"(> {elapsed * 1000:.0f} ms) - użyj przycisku na miniaturze.")
+
+    def _on_thumbnail_render_time(self, key, seconds):
+        """Zapisuje w indeksie stron czas ostrego renderu miniatury (dane profilu stron)."""
+        self.page_metadata_index.set_render_time(key[0], seconds)
+
+    def measure_page_render_time(self, page_index):
+        """
+        Czas renderu miniatury strony w bieżącej szerokości i polityce jakości: zapisany
+        przy renderze w tle albo zmierzony teraz tą samą drogą co w wątkach roboczych
+        (ciężkie strony w procesie roboczym z budżetem czasu).
+        Zwraca sekundy albo None, jeśli strona przekracza budżet czasu.
+        """
+        key = self._thumbnail_key(page_index, self.thumb_width)
+        if key[0] in self._complex_fingerprints:
+            return None
+        seconds = self.page_metadata_index.render_time(key[0])
+        if seconds is not None:
+            return seconds
+        renderer = self.thumbnail_renderer
         page = self.pdf_document.load_page(page_index)
-        page_width = page.rect.width
-        page_height = page.rect.height
-        aspect_ratio = page_height / page_width if page_width != 0 else 1
-        
-        # Oblicz docelowe wymiary miniatury
-        final_thumb_width = column_width
-        final_thumb_height = int(final_thumb_width * aspect_ratio)
-        if final_thumb_width <= 0:
-            final_thumb_width = 1
-        if final_thumb_height <= 0:
-            final_thumb_height = 1
+        if renderer.time_budget_ms and sum(len(stream) for stream in page_content_streams(self.pdf_document, page)) > COMPLEX_CONTENT_BYTES:
+            # Źródło wątków renderujących - bez serializacji dokumentu dla każdej ciężkiej strony
+            self._ensure_render_source()
+            image, seconds, _ = renderer.render_isolated(page_index, key[1], key[2],
+                                                         timeout=renderer.time_budget_ms / 1000) or (None, None, {})
+            if image is None:
+                self._complex_fingerprints.add(key[0])
+                return None
+        else:
+            with aa_level_rendering(renderer.aa_level):
+                started = time.perf_counter()
+                render_page_thumbnail(page, key[1], key[2], annots=renderer.annots)
+                seconds = time.perf_counter() - started
+        self.page_metadata_index.set_render_time(key[0], seconds)
+        return seconds
+
+    # Mapa ciepła: (udział w czasie najwolniejszej strony, kolor); szybsze strony nie są wyróżniane
+    HEAT_COLORS = ((0.66, "#C62828"), (0.33, "#EF6C00"), (0.1, "#F9A825"))
+    HEAT_MIN_SECONDS = 0.02
+
+    def set_page_heat(self, render_times):
+        """
+        Podświetla w siatce strony wg czasu renderu ({indeks strony: sekundy albo None
+        dla stron ponad budżet czasu}); None wyłącza mapę ciepła.
+        """
+        self._heat_colors.clear()
+        if render_times:
+            slowest = max((seconds for seconds in render_times.values() if seconds is not None), default=0.0)
+            for page_index, seconds in render_times.items():
+                if seconds is None:
+                    color = self.HEAT_COLORS[0][1]
+                elif seconds < self.HEAT_MIN_SECONDS:
+                    continue
+                else:
+                    color = next((color for share, color in self.HEAT_COLORS if seconds >= share * slowest), None)
+                if color is not None:
+                    self._heat_colors[self._page_fingerprint(page_index)] = color
+        for page_index, page_frame in self.thumb_frames.items():
+            page_frame.set_heat(self.page_heat_color(page_index))
+
+    def page_heat_color(self, page_index):
+        """Kolor strony na mapie ciepła albo None."""
+        if not self._heat_colors:
+            return None
+        return self._heat_colors.get(self._page_fingerprint(page_index))
+
+    def render_complex_page(self, page_index):
+        """Renderuje na żądanie miniaturę strony, która przekroczyła budżet czasu (bez limitu, w tle)."""
+        if not self.pdf_document or not 0 <= page_index < len(self.pdf_document):
+            return
+        key = self._thumbnail_key(page_index, self.thumb_width)
+        self._complex_fingerprints.discard(key[0])
+        page_frame = self.thumb_frames.get(page_index)
+        if page_frame is not None:
+            page_frame.set_complex(False)
+        self._request_thumbnail(page_index, key, sharp_only=True, unbounded=True)
+        self._update_status(f"Renderowanie złożonej strony {page_index + 1} w tle...")
+
+    def _thumbnail_image_size(self, page_index, column_width, max_height):
+        page_width, page_height = self.page_metadata().size(page_index)
+        return thumbnail_size(fitz.Rect(0, 0, page_width, page_height), column_width, max_height)
+
+    def _downsample_from_pyramid(self, page_index, key):
+        """
+        Miniatura dla klucza key zmniejszona z najbliższego większego poziomu piramidy
+        (zamiast renderowania przez MuPDF) albo None, jeśli żaden poziom nie jest w cache.
+        """
+        fingerprint, column_width, max_height = key
+        for width in self.THUMB_ZOOM_LEVELS:
+            if width <= column_width:
+                continue
+            source_key = (fingerprint, width, self._level_max_height(width))
+            if source_key not in self.thumbnail_cache:
+                continue
+            source = self.thumbnail_cache.get(source_key)
+            image = source.resize(self._thumbnail_image_size(page_index, column_width, max_height), Image.LANCZOS)
+            self.thumbnail_cache.put(key, image)
+            return image
+        return None
 
-        print(f"final_thumb_width={final_thumb_width}, final_thumb_height={final_thumb_height}")
+    def _page_fingerprint(self, page_index):
+        """
+        Zwraca odcisk treści strony (strumienie zawartości, zasoby, obrót, pola strony).
+        Wynik jest zapamiętywany per xref strony do najbliższej zmiany dokumentu.
+        """
+        if self._fingerprint_document is not self.pdf_document:
+            self._page_fingerprints.clear()
+            self._fingerprint_document = self.pdf_document
+        xref = self.pdf_document.page_xref(page_index)
+        fingerprint = self._page_fingerprints.get(xref)
+        if fingerprint is None:
+            page = self.pdf_document.load_page(page_index)
+            fingerprint = page_content_digest(self.pdf_document, page)
+            self._page_fingerprints[xref] = fingerprint
+        return fingerprint
+
+    def get_page_displaylist(self, page_index):
+        """
+        Zwraca sparsowaną stronę (fitz.DisplayList) z cache współdzielonego przez
+        podgląd, analizę, eksport i usuwanie pustych stron. Kluczem jest odcisk
+        treści strony, więc edytowana strona jest parsowana od nowa. DisplayList
+        odwołuje się do obiektów dokumentu - po podmianie dokumentu cache jest czyszczony.
+        """
+        if self._displaylist_document is not self.pdf_document:
+            self.displaylist_cache.clear()
+            self._displaylist_document = self.pdf_document
+        return self.displaylist_cache.get(self._page_fingerprint(page_index), self.pdf_document, page_index)
 
-        # Oblicz współczynnik skalowania aby renderować bezpośrednio w docelowym rozmiarze
-        # PyMuPDF renderuje w 72 DPI domyślnie, więc obliczamy skalę na podstawie tego
-        scale_x = final_thumb_width / page_width
-        scale_y = final_thumb_height / page_height
-        # Użyj mniejszej skali aby zachować proporcje
-        scale = min(scale_x, scale_y)
-        
-        # Renderuj stronę w docelowym rozmiarze
-        mat = fitz.Matrix(scale, scale)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
+    def _thumbnail_key(self, page_index, column_width):
+        """
+        Klucz cache miniatury: odcisk treści strony zamiast indeksu. Wpisy pozostają
+        poprawne po przestawieniu stron i po podmianie dokumentu (cofnij/ponów) -
+        ponownie renderowane są tylko strony, których treść faktycznie się zmieniła.
+        """
+        return (self._page_fingerprint(page_index), column_width, self._thumb_max_height)
 
-        # Konwertuj do PIL Image
-        img_data = pix.tobytes("ppm")
-        image = Image.open(io.BytesIO(img_data))
+    def _invalidate_render_source(self, pages=None):
+        """
+        Unieważnia migawkę dokumentu w wątkach renderujących (po każdej zmianie dokumentu).
+        pages to indeksy stron zmienianych w miejscu (jak w _save_state_to_undo) - strony
+        dodane, usunięte, przestawione i obrócone są rozpoznawane bez nich; None oznacza
+        zmiany dowolnych stron, po których trzeba przekazać wątkom cały dokument.
+        """
+        self.thumbnail_renderer.set_source(None)
+        self._page_fingerprints.clear()
+        self.page_metadata_index.mark_dirty()
+        if pages is None:
+            self._render_base = None
+        elif self._render_base is not None and self._render_base[0] is self.pdf_document:
+            page_count = len(self.pdf_document)
+            self._render_changed_xrefs.update(
+                self.pdf_document.page_xref(page_index) for page_index in pages if 0 <= page_index < page_count)
+
+    def _set_render_base(self, filepath=None, data=None):
+        """
+        Ustawia źródło wątków renderujących (niezmieniony plik albo bajty PDF) odpowiadające
+        bieżącemu dokumentowi i zapamiętuje je jako bazę dla nakładek kolejnych edycji.
+        """
+        doc = self.pdf_document
+        pages = {}
+        for page_index in range(len(doc)):
+            xref = doc.page_xref(page_index)
+            pages[xref] = (page_index, UndoStep._read_rotate(doc, xref))
+        self._render_base = (doc, filepath, data, pages)
+        self._render_changed_xrefs.clear()
+        self.thumbnail_renderer.set_source(filepath=filepath, data=data, password=self._document_password,
+                                           document_id=self._document_id)
+
+    def _render_base_bytes(self):
+        """
+        Bajty bazy wątków renderujących, jeśli dokładnie odpowiadają bieżącemu dokumentowi
+        (ta sama kolejność stron, obroty i brak zmian w miejscu), inaczej None.
+        """
+        doc = self.pdf_document
+        base = self._render_base
+        if base is None or base[0] is not doc or base[2] is None or self._render_changed_xrefs:
+            return None
+        base_pages = base[3]
+        if len(base_pages) != len(doc):
+            return None
+        for page_index in range(len(doc)):
+            xref = doc.page_xref(page_index)
+            if base_pages.get(xref) != (page_index, UndoStep._read_rotate(doc, xref)):
+                return None
+        return base[2]
 
-        print(f"Image.size (po renderowaniu): {image.size}")
+    def _render_base_state(self):
+        """
+        (bajty bazy wątków renderujących, lista (xref, obrót) jej stron, xrefy stron
+        zmienionych w miejscu od jej zapisu) albo None, jeśli baza nie opisuje
+        bieżącego obiektu dokumentu lub nie ma bajtów (baza to plik na dysku).
+        """
+        base = self._render_base
+        if base is None or base[0] is not self.pdf_document or base[2] is None:
+            return None
+        pages = sorted(base[3].items(), key=lambda item: item[1][0])
+        return base[2], [(xref, rotation) for xref, (_, rotation) in pages], set(self._render_changed_xrefs)
 
-        # Jeśli rozmiar nie jest dokładnie zgodny z targetem (przez zaokrąglenia),
-        # dostosuj do dokładnej wielkości
-        if image.size != (final_thumb_width, final_thumb_height):
-            image = image.resize((final_thumb_width, final_thumb_height), Image.BILINEAR)
-            print(f"Resized image size: {image.size}")
+    def _render_overlay(self):
+        """
+        Nakładka dla ThumbnailRenderer.set_source: (bajty PDF ze stronami zmienionymi od zapisu
+        bazy, mapa stron) albo None, jeśli bazy nie ma (podmiana dokumentu) lub zmian jest za dużo.
+        """
+        doc = self.pdf_document
+        if self._render_base is None or self._render_base[0] is not doc:
+            return None
+        base_pages = self._render_base[3]
+        pages = []
+        changed = []
+        for page_index in range(len(doc)):
+            xref = doc.page_xref(page_index)
+            base_page = base_pages.get(xref)
+            if (base_page is None or xref in self._render_changed_xrefs
+                    or base_page[1] != UndoStep._read_rotate(doc, xref)):
+                changed.append(page_index)
+                pages.append(-len(changed))
+            else:
+                pages.append(base_page[0])
+        if len(changed) > RENDER_OVERLAY_MAX_PAGES:
+            return None
+        if not changed:
+            return None, pages
+        overlay = fitz.open()
+        try:
+            for page_index in changed:
+                overlay.insert_pdf(doc, from_page=page_index, to_page=page_index)
+            return overlay.tobytes(), pages
+        finally:
+            overlay.close()
 
-        # Konwertuj do PhotoImage dla Tkinter
-        img_tk = ImageTk.PhotoImage(image)
-        
-        # Zapisz w cache
-        if page_index not in self.tk_images:
-            self.tk_images[page_index] = {}
-        self.tk_images[page_index][column_width] = img_tk
+    def _ensure_render_source(self):
+        """
+        Przekazuje wątkom renderującym aktualną migawkę dokumentu, jeśli jej nie mają.
+        Po edycji w miejscu jest to baza z nakładką zmienionych stron - kopiowane są tylko
+        te strony; cały dokument jest serializowany (jako nowa baza) dopiero po jego
+        podmianie albo przy zbyt wielu zmienionych stronach.
+        """
+        if self.thumbnail_renderer.has_source() or not self.pdf_document:
+            return
+        overlay = self._render_overlay()
+        if overlay is None:
+            self._set_render_base(data=self.pdf_document.write())
+            return
+        _, filepath, data, _ = self._render_base
+        self.thumbnail_renderer.set_source(filepath=filepath, data=data, password=self._document_password,
+                                           document_id=self._document_id, overlay=overlay)
+
+    def _get_placeholder_image(self, width, height):
+        """Zwraca (współdzielony) szary placeholder o zadanym rozmiarze."""
+        key = (width, height)
+        if key not in self._placeholder_images:
+            image = Image.new("RGB", (width, height), THUMB_PLACEHOLDER_COLOR)
+            self._placeholder_images[key] = ImageTk.PhotoImage(image)
+        return self._placeholder_images[key]
+
+    def _on_thumbnail_rendered(self, key, page_index, image, final=True):
+        """
+        Odbiera gotową miniaturę z wątku renderującego (wywoływane w wątku GUI).
+        Szkic (final=False) jest tylko wyświetlany - do cache trafia ostra wersja.
+        """
+        if not self.pdf_document or page_index >= len(self.pdf_document):
+            return
+        if final:
+            self._draft_images.pop(key, None)
+            self.thumbnail_cache.put(key, image)
+            self._complex_fingerprints.discard(key[0])
+        else:
+            self._remember_draft(key, image)
 
-        print(f"[CACHE UPDATE] Dodano do cache: strona {page_index}, szerokość {column_width}")
+        page_frame = self.thumb_frames.get(page_index)
+        if page_frame is None:
+            return
+        frame_key = self._thumbnail_key(page_index, page_frame.column_width)
+        if frame_key != key:
+            # Render bazy piramidy dla mniejszego poziomu - zmniejsz do rozmiaru ramki
+            if frame_key[0] != key[0] or frame_key[1] >= key[1]:
+                return
+            image = image.resize(self._thumbnail_image_size(page_index, frame_key[1], frame_key[2]), Image.LANCZOS)
+            if final:
+                self._draft_images.pop(frame_key, None)
+                self.thumbnail_cache.put(frame_key, image)
+            else:
+                self._remember_draft(frame_key, image)
+        if final:
+            page_frame.set_complex(False)
+        page_frame.set_image(ImageTk.PhotoImage(image))
+
+    def _on_thumbnail_color(self, key, spread, samples):
+        """Zapisuje w indeksie stron wynik wykrywania koloru policzony przy renderze miniatury."""
+        self.page_metadata_index.set_color_spread(key[0], spread, samples)
+
+    def page_color_spread(self, page_index, samples):
+        """Największa różnica kanałów RGB strony (samples próbek) z renderu miniatury albo None."""
+        return self.page_metadata_index.color_spread(self._page_fingerprint(page_index), samples)
+
+    def set_page_color_spread(self, page_index, spread, samples):
+        """Zapisuje wynik wykrywania koloru strony policzony poza rendererem miniatur (np. w analizie)."""
+        self.page_metadata_index.set_color_spread(self._page_fingerprint(page_index), spread, samples)
+
+    def _remember_draft(self, key, image):
+        self._draft_images[key] = image
+        self._draft_images.move_to_end(key)
+        while len(self._draft_images) > self.MAX_DRAFT_IMAGES:
+            self._draft_images.popitem(last=False)
+
+    # Obrót strony o kąt (zgodnie z ruchem wskazówek zegara) -> transpozycja obrazu PIL
+    ROTATION_TRANSPOSE = {90: Image.ROTATE_270, 180: Image.ROTATE_180, 270: Image.ROTATE_90}
+
+    def _cached_thumbnail(self, page_index):
+        """Ostra miniatura strony z cache (dla bieżącej szerokości) albo None - bez zlecania renderu."""
+        if not self.pdf_document or not 0 <= page_index < len(self.pdf_document):
+            return None
+        return self.thumbnail_cache.get(self._thumbnail_key(page_index, self.thumb_width))
 
-        return img_tk
+    def _put_derived_thumbnail(self, page_index, image):
+        """
+        Wstawia do cache miniaturę strony wyprowadzoną z innego obrazu (obrót, kopia
+        strony) zamiast renderować ją przez MuPDF; image=None oznacza pustą, białą stronę.
+        Obraz jest dopasowywany do rozmiaru miniatury; jeśli wymagałoby to powiększenia,
+        trafia tylko do szkiców, a ostrą wersję zleci _render_and_scale. Wyniku wykrywania
+        koloru z takiego obrazu się nie zapisuje - przeskalowany obraz nie jest renderem strony.
+        """
+        key = self._thumbnail_key(page_index, self.thumb_width)
+        if key in self.thumbnail_cache:
+            return
+        size = self._thumbnail_image_size(page_index, self.thumb_width, self._thumb_max_height)
+        if image is None:
+            image = Image.new("RGB", size, "white")
+        upscaled = size[0] > image.width or size[1] > image.height
+        if image.size != size:
+            image = image.resize(size, Image.BILINEAR)
+        if upscaled:
+            self._remember_draft(key, image)
+        else:
+            self._draft_images.pop(key, None)
+            self.thumbnail_cache.put(key, image)
 
     def _clear_thumbnail_cache(self, page_index):
         """
-        Usuwa cache miniatury dla konkretnej strony.
+        Unieważnia odcisk treści strony - zmieniona strona dostanie nowy klucz cache.
+        Stare wpisy zostają w LRU (przydadzą się, jeśli cofnięcie przywróci tę treść).
         """
-        if page_index in self.tk_images:
-            del self.tk_images[page_index]
+        if self.pdf_document and 0 <= page_index < len(self.pdf_document):
+            self._page_fingerprints.pop(self.pdf_document.page_xref(page_index), None)
 
-    def update_single_thumbnail(self, page_index, column_width=None):
+    def update_single_thumbnail(self, page_index, column_width=None, derived_image=None):
         """
         Odświeża tylko konkretną miniaturę bez przebudowy całej siatki.
         Używane dla operacji, które zmieniają zawartość strony, ale nie liczbę stron.
@@ -8915,34 +12887,40 @@ class SelectablePDFViewer:
         Args:
             page_index: Indeks strony do odświeżenia
             column_width: Szerokość kolumny (jeśli None, używa bieżącej self.thumb_width)
+            derived_image: Gotowy obraz nowej treści strony (np. obrócona miniatura) -
+                           trafia do cache zamiast renderowania
         """
         if not self.pdf_document or page_index >= len(self.pdf_document):
             return
         
-        if page_index not in self.thumb_frames:
+        # Usuń cache dla tej strony (także gdy strona jest poza widokiem)
+        self._clear_thumbnail_cache(page_index)
+        self.page_metadata_index.update_page(self.pdf_document, page_index)
+        if derived_image is not None:
+            self._put_derived_thumbnail(page_index, derived_image)
+        
+        # Strona wyższa niż pole wiersza (np. obrót w dokumencie poziomym) wymaga nowego układu
+        rect = fitz.Rect(0, 0, *self.page_metadata_index.size(page_index))
+        if rect.width > 0 and rect.height / rect.width * self.thumb_width > self._thumb_max_height + 1:
+            if self._thumb_max_height < int(self.thumb_width * self.THUMB_MAX_ASPECT):
+                self._reconfigure_grid()
+        
+        page_frame = self.thumb_frames.get(page_index)
+        if page_frame is None:
             return
         
         # Użyj bieżącej szerokości miniatur, jeśli nie podano
         if column_width is None:
             column_width = self.thumb_width
         
-        # Usuń cache dla tej strony
-        self._clear_thumbnail_cache(page_index)
-        
         # Renderuj nową miniaturę
         img_tk = self._render_and_scale(page_index, column_width)
         
-        # Zaktualizuj obraz w istniejącym ThumbnailFrame
-        page_frame = self.thumb_frames[page_index]
-        if page_frame.img_label:
-            page_frame.img_label.config(image=img_tk)
-            page_frame.img_label.image = img_tk
+        # Zaktualizuj obraz w istniejącej ramce
+        page_frame.set_image(img_tk)
         
         # Zaktualizuj etykietę rozmiaru strony (może się zmienić przy kadracji/zmianie rozmiaru)
-        outer_frame_children = page_frame.outer_frame.winfo_children()
-        if len(outer_frame_children) > 2:
-            frame_bg = page_frame.bg_selected if page_index in self.selected_pages else page_frame.bg_normal
-            outer_frame_children[2].config(text=self._get_page_size_label(page_index), bg=frame_bg)
+        page_frame.set_format_text(self._get_page_size_label(page_index))
 
     def update_selection_display(self):
         # Clean up selected_pages to remove any invalid indices
@@ -8952,20 +12930,9 @@ class SelectablePDFViewer:
         
         num_selected = len(self.selected_pages)
         
+        # Tylko ramki widocznych stron - pozostałe dostaną stan zaznaczenia przy przypięciu
         for frame_index, frame in self.thumb_frames.items():
-            inner_frame = frame.outer_frame
-            if frame_index in self.selected_pages:
-                frame.config(bg=frame.bg_selected)  
-                for widget in inner_frame.winfo_children():
-                    if isinstance(widget, tk.Label) and widget.cget('bg') != 'white':
-                         widget.config(bg=frame.bg_selected)
-                inner_frame.config(bg=frame.bg_selected)
-            else:
-                frame.config(bg=frame.bg_normal)
-                for widget in inner_frame.winfo_children():
-                    if isinstance(widget, tk.Label) and widget.cget('bg') != 'white':
-                         widget.config(bg=frame.bg_normal)
-                inner_frame.config(bg=frame.bg_normal)
+            frame.set_selected(frame_index in self.selected_pages)
 
         self.update_tool_button_states()
         
@@ -9240,7 +13207,8 @@ class SelectablePDFViewer:
             return
         
         try:
-            self._save_state_to_undo()
+            # get_drawings() zapisuje w dokumencie (obrócone strony) - dziennik MuPDF by go odrzucił
+            self._prepare_direct_access()
             empty_pages = []
             
             total_pages = len(self.pdf_document)
@@ -9251,11 +13219,12 @@ class SelectablePDFViewer:
             
             # Identyfikuj puste strony
             for page_index in range(total_pages):
-                page = self.pdf_document[page_index]
-                text = page.get_text().strip()
+                # Tekst ze sparsowanej strony (DisplayList z cache)
+                text = displaylist_text(self.get_page_displaylist(page_index)).strip()
                 
                 # Sprawdź czy strona ma tekst
                 if not text:
+                    page = self.pdf_document[page_index]
                     # Sprawdź czy tło jest białe (bardzo prosty test)
                     # Możemy sprawdzić czy są jakieś rysunki/obrazy
                     drawings = page.get_drawings()
@@ -9272,6 +13241,8 @@ class SelectablePDFViewer:
                 custom_messagebox(self.master, "Informacja", "Nie znaleziono pustych stron w dokumencie.", typ="info")
                 return
             
+            self._save_state_to_undo(pages=empty_pages)
+
             # Zmień pasek na usuwanie stron
             self.show_progressbar(maximum=len(empty_pages))
             self._update_status("Usuwanie pustych stron...")
@@ -9283,10 +13254,7 @@ class SelectablePDFViewer:
             
             # Odśwież widok
             self.selected_pages.clear()
-            self.tk_images.clear()
-            self.thumb_frames.clear()
-            for widget in list(self.scrollable_frame.winfo_children()):
-                widget.destroy()
+            self._clear_thumbnail_grid()
             
             self.active_page_index = 0
             self._reconfigure_grid()
@@ -9397,8 +13365,8 @@ class SelectablePDFViewer:
         import uuid
         
         try:
-            # Zapisz stan do undo
-            self._save_state_to_undo()
+            # Zapisz stan do undo (kopie tylko konwertowanych stron)
+            self._save_state_to_undo(pages=self.selected_pages)
             
             # Pokaż pasek postępu
             self.show_progressbar(maximum=100, mode="indeterminate")
@@ -9547,6 +13515,14 @@ class SelectablePDFViewer:
             # Utwórz nowe okno i zapisz referencję
             self.pdf_analysis_dialog = PDFAnalysisDialog(self.master, self)
     
+    def show_page_profile(self):
+        """Wyświetla okno profilu renderowania stron"""
+        if self.page_profile_dialog and self.page_profile_dialog.winfo_exists():
+            self.page_profile_dialog.lift()
+            self.page_profile_dialog.focus_force()
+        else:
+            self.page_profile_dialog = PageProfileDialog(self.master, self)
+    
     def run_macro(self, macro_name):
         """Uruchamia makro o podanej nazwie"""
         macros = self.prefs_manager.get_profiles('macros')
@@ -9683,11 +13659,12 @@ class SelectablePDFViewer:
             self._update_status("Makro: Brak zaznaczonych stron dla numeracji.")
             return
         
-        doc = self.pdf_document
         MM_PT = self.MM_TO_POINTS
         
         try:
-            self._save_state_to_undo()
+            self._save_state_to_undo(pages=self.selected_pages)
+            # Zapis historii może otworzyć dokument ponownie (koniec sesji dziennika MuPDF)
+            doc = self.pdf_document
             
             # Extract parameters
             start_number = params.get('start_num', 1)
@@ -9846,7 +13823,7 @@ class SelectablePDFViewer:
         try:
             pages_to_process = sorted(list(self.selected_pages))
             if pages_to_process:
-                self._save_state_to_undo()
+                self._save_state_to_undo(pages=pages_to_process, in_place=True)
             modified_count = 0
             
             for page_index in pages_to_process:
@@ -9970,14 +13947,13 @@ class SelectablePDFViewer:
 
     def update_focus_display(self, hide_mouse_focus: bool = False):
         if not self.pdf_document: return
+        self._hide_mouse_focus = hide_mouse_focus
         for index, frame in self.thumb_frames.items():
-            inner_frame = frame.outer_frame
-            if index == self.active_page_index and not hide_mouse_focus:
-                inner_frame.config(highlightbackground=FOCUS_HIGHLIGHT_COLOR, highlightcolor=FOCUS_HIGHLIGHT_COLOR)
-            else:
-                inner_frame.config(highlightbackground=frame.bg_normal, highlightcolor=frame.bg_normal)
+            frame.set_focused(index == self.active_page_index and not hide_mouse_focus)
 
 if __name__ == '__main__':
+    # Render w procesach roboczych (spawn) - wymagane w wersji exe
+    multiprocessing.freeze_support()
     try:
         from tkinterdnd2 import TkinterDnD
         root = TkinterDnD.Tk()
@@ -0,0 +1,151 @@
+"""
+Mikrobenchmark konwersji pixmapy PyMuPDF do obrazu PIL dla miniatur.
+
+Porównuje dawną ścieżkę (pix.tobytes("ppm") + Image.open) z pixmap_to_image()
+z PDFEditor.py na syntetycznym dokumencie. Renderowanie jest wykonywane raz,
+a mierzona jest tylko konwersja, żeby różnica nie ginęła w czasie rasteryzacji.
+Na końcu podaje przepustowość (stron/s) pełnego renderu miniatury dla różnych
+polityk jakości: poziomu antyaliasingu, pomijania adnotacji i skali szarości,
+oraz skalowanie backendu procesowego (RenderProcess) z liczbą procesów.
+
+Użycie:
+    python bench_thumbnails.py [liczba_stron] [szerokość_miniatury]
+"""
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import fitz
+from PIL import Image
+
+from PDFEditor import MAX_AA_LEVEL, RenderProcess, pixmap_to_image, render_page_thumbnail
+
+
+def build_document(page_count):
+    """Tworzy dokument z tekstem, grafiką wektorową i adnotacjami na każdej stronie."""
+    doc = fitz.open()
+    for index in range(page_count):
+        width, height = (842, 595) if index % 7 == 0 else (595, 842)
+        page = doc.new_page(width=width, height=height)
+        page.insert_text((72, 72), f"Strona {index + 1}", fontsize=24)
+        for line in range(20):
+            page.insert_text((72, 120 + line * 18), "Lorem ipsum dolor sit amet " * 3, fontsize=10)
+        page.draw_rect(fitz.Rect(72, 520, 300, 700), color=(0.8, 0.1, 0.1), fill=(0.9, 0.9, 0.2))
+        page.add_highlight_annot(fitz.Rect(72, 110, 400, 160))
+        page.add_freetext_annot(fitz.Rect(320, 520, 520, 600), "Uwaga " * 10, fontsize=9)
+    return doc
+
+
+def convert_ppm(pix):
+    return Image.open(io.BytesIO(pix.tobytes("ppm")))
+
+
+def measure(label, func, pixmaps):
+    start = time.perf_counter()
+    for pix in pixmaps:
+        image = func(pix)
+        image.load()
+    elapsed = time.perf_counter() - start
+    per_page_us = elapsed / len(pixmaps) * 1e6
+    print(f"{label:<28} {elapsed * 1000:9.1f} ms  {per_page_us:8.1f} us/strona")
+    return elapsed
+
+
+def measure_processes(filepath, page_count, thumb_width, process_count):
+    """Renderuje wszystkie strony w process_count procesach; zwraca stron/s (bez startu procesów)."""
+    processes = [RenderProcess() for _ in range(process_count)]
+    try:
+        for process in processes:
+            process.open(0, filepath, None, 0, None)
+        next_page = iter(range(page_count))
+        lock = threading.Lock()
+
+        def work(process):
+            while True:
+                with lock:
+                    page_index = next(next_page, None)
+                if page_index is None:
+                    return
+                process.render(page_index, thumb_width, None)
+
+        threads = [threading.Thread(target=work, args=(process,)) for process in processes]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return page_count / (time.perf_counter() - start)
+    finally:
+        for process in processes:
+            process.close()
+
+
+def main():
+    page_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    thumb_width = int(sys.argv[2]) if len(sys.argv) > 2 else 205
+
+    doc = build_document(page_count)
+    pixmaps = []
+    for page in doc:
+        scale = thumb_width / page.rect.width
+        pixmaps.append(page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False))
+
+    print(f"Stron: {page_count}, szerokość miniatury: {thumb_width}px")
+    old = measure("tobytes('ppm') + Image.open", convert_ppm, pixmaps)
+    new = measure("pixmap_to_image (kopia)", pixmap_to_image, pixmaps)
+    measure("pixmap_to_image (bez kopii)", lambda pix: pixmap_to_image(pix, copy=False), pixmaps)
+    print(f"Przyspieszenie konwersji: {old / new:.1f}x")
+
+    # Pełna ścieżka miniatury (render + konwersja) dla kontekstu
+    start = time.perf_counter()
+    for page in doc:
+        render_page_thumbnail(page, thumb_width)
+    elapsed = time.perf_counter() - start
+    print(f"{'render_page_thumbnail':<28} {elapsed * 1000:9.1f} ms  {elapsed / page_count * 1e6:8.1f} us/strona")
+
+    # Polityki jakości miniatur (antyaliasing jest globalny dla MuPDF)
+    policies = [
+        ("pełna jakość (AA 8)", MAX_AA_LEVEL, {}),
+        ("AA 4", 4, {}),
+        ("AA 0", 0, {}),
+        ("bez adnotacji", MAX_AA_LEVEL, {"annots": False}),
+        ("skala szarości", MAX_AA_LEVEL, {"gray": True}),
+        ("AA 0, bez adnot., szarość", 0, {"annots": False, "gray": True}),
+    ]
+    print()
+    baseline = None
+    try:
+        for label, aa_level, options in policies:
+            fitz.TOOLS.set_aa_level(aa_level)
+            start = time.perf_counter()
+            for page in doc:
+                render_page_thumbnail(page, thumb_width, **options)
+            elapsed = time.perf_counter() - start
+            pages_per_second = page_count / elapsed
+            baseline = baseline or pages_per_second
+            print(f"{label:<28} {pages_per_second:9.1f} stron/s  {pages_per_second / baseline:5.2f}x")
+    finally:
+        fitz.TOOLS.set_aa_level(MAX_AA_LEVEL)
+
+    # Backend procesowy: skalowanie z liczbą procesów (sensowne tylko na wielu rdzeniach)
+    cpu_count = os.cpu_count() or 1
+    counts = sorted({1, cpu_count} | {n for n in (2, 4, 8, 16) if n <= cpu_count})
+    print(f"\nBackend procesowy (rdzeni: {cpu_count})")
+    fd, filepath = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    try:
+        doc.save(filepath)
+        single = None
+        for process_count in counts:
+            pages_per_second = measure_processes(filepath, page_count, thumb_width, process_count)
+            single = single or pages_per_second
+            print(f"{process_count:>3} proc. {pages_per_second:21.1f} stron/s  {pages_per_second / single:5.2f}x")
+    finally:
+        os.remove(filepath)
+
+
+if __name__ == "__main__":
+    main()
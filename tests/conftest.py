@@ -0,0 +1,61 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+GUI_METHODS = ("_record_action", "show_progressbar", "update_progressbar", "hide_progressbar",
+               "update_single_thumbnail", "update_tool_button_states", "update_focus_display",
+               "_update_status", "_clear_thumbnail_grid", "_reconfigure_grid", "update_selection_display")
+
+
+def _make_viewer(doc, undo_backend="journal"):
+    """Przeglądarka bez okna Tk - tylko stan potrzebny historii zmian i operacjom na stronach."""
+    viewer = pe.SelectablePDFViewer.__new__(pe.SelectablePDFViewer)
+    for name in GUI_METHODS:
+        setattr(viewer, name, lambda *args, **kwargs: None)
+    viewer._cached_thumbnail = lambda page_index: None
+    preferences = {"undo_backend": undo_backend}
+    viewer.prefs_manager = SimpleNamespace(get=lambda key, default=None: preferences.get(key, default))
+    viewer.master = None
+    viewer.pdf_document = doc
+    viewer.undo_store = pe.UndoBlobStore()
+    viewer.undo_stack = []
+    viewer.redo_stack = []
+    viewer.max_stack_size = 50
+    viewer.selected_pages = set()
+    viewer.active_page_index = 0
+    viewer.thumb_frames = {}
+    viewer._journal_op = None
+    viewer.session_journal = None
+    viewer._session_document = None
+    viewer._embedded_thumbnails_document = None
+    viewer.thumbnail_renderer = SimpleNamespace(set_source=lambda *args, **kwargs: None)
+    viewer._page_fingerprints = {}
+    viewer._fingerprint_document = None
+    viewer._render_base = None
+    viewer._document_password = None
+    viewer._document_id = None
+    viewer._render_changed_xrefs = set()
+    viewer.page_metadata_index = SimpleNamespace(mark_dirty=lambda: None, update_page=lambda doc, page_index: None)
+    return viewer
+
+
+@pytest.fixture
+def make_viewer():
+    """Fabryka przeglądarek bez okna Tk; magazyn historii każdej z nich jest zamykany po teście."""
+    viewers = []
+
+    def factory(doc, undo_backend="journal"):
+        viewer = _make_viewer(doc, undo_backend)
+        viewers.append(viewer)
+        return viewer
+
+    yield factory
+    for viewer in viewers:
+        viewer.undo_store.close()
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import fitz
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+def test_max_channel_difference_samples_pixels():
+    image = Image.new("RGB", (100, 100), "white")
+    image.putpixel((50, 50), (255, 0, 0))
+    assert pe.max_channel_difference(image) == 255
+    # 300 próbek co 33 piksele omija pojedynczy kolorowy piksel (indeks 5050)
+    assert pe.max_channel_difference(image, 300) == 0
+    assert pe.max_channel_difference(image, 10000) == 255
+    assert pe.max_channel_difference(image.convert("L")) is None
+
+
+def test_color_spread_recorded_for_sample_count():
+    index = pe.PageMetadataIndex()
+    index.set_color_spread("odcisk", 40, 300)
+    assert index.color_spread("odcisk", 300) == 40
+    # Wynik z inną liczbą próbek nie odpowiada preferencji - analiza policzy stronę od nowa
+    assert index.color_spread("odcisk", 100) is None
+    index.set_color_spread("inny", None, 300)
+    assert index.color_spread("inny", 300) is None
+
+
+def test_duplicated_and_swapped_pages_keep_color_result(make_viewer):
+    doc = fitz.open()
+    doc.new_page().draw_rect(fitz.Rect(72, 72, 144, 144), color=(1, 0, 0), fill=(1, 0, 0))
+    doc.new_page().insert_text((72, 72), "Czarno-biała")
+    viewer = make_viewer(fitz.open("pdf", doc.tobytes()), undo_backend="pages")
+    viewer.page_metadata_index = pe.PageMetadataIndex()
+    viewer.set_page_color_spread(0, 255, 300)
+    viewer.set_page_color_spread(1, 0, 300)
+
+    viewer.selected_pages = {0}
+    viewer.duplicate_selected_page()
+    # Kopia ma nowe xrefy (inny odcisk treści), ale ten sam wynik co oryginał
+    assert viewer._page_fingerprint(1) != viewer._page_fingerprint(0)
+    assert [viewer.page_color_spread(i, 300) for i in range(3)] == [255, 255, 0]
+
+    viewer.selected_pages = {0, 2}
+    viewer.swap_pages()
+    assert [viewer.page_color_spread(i, 300) for i in range(3)] == [0, 255, 255]
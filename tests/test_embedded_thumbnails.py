@@ -0,0 +1,76 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import fitz
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+@pytest.fixture
+def pdf_bytes():
+    doc = fitz.open()
+    for _ in range(2):
+        doc.new_page(width=400, height=600)
+    return doc.tobytes()
+
+
+def test_embedded_thumbnail_round_trip(pdf_bytes):
+    image = Image.new("RGB", (400, 600), (200, 30, 30))
+    doc = fitz.open("pdf", pe.embed_page_thumbnails(pdf_bytes, {0: image}))
+    thumbnail = pe.read_embedded_thumbnail(doc, 0)
+    # Dłuższy bok zmniejszony do EMBEDDED_THUMB_MAX_SIZE, proporcje zachowane
+    assert thumbnail.size == (133, pe.EMBEDDED_THUMB_MAX_SIZE)
+    red, green, blue = thumbnail.getpixel((thumbnail.width // 2, thumbnail.height // 2))
+    assert red > 180 and green < 60 and blue < 60
+    assert pe.read_embedded_thumbnail(doc, 1) is None
+
+
+def test_replaced_thumbnail_removed_from_file(pdf_bytes):
+    data = pe.embed_page_thumbnails(pdf_bytes, {0: Image.new("RGB", (40, 60), "red")})
+    # Strony spoza dokumentu są pomijane
+    data = pe.embed_page_thumbnails(data, {0: Image.new("RGB", (40, 60), "blue"), 5: Image.new("RGB", (1, 1))})
+    doc = fitz.open("pdf", data)
+    thumbnails = [xref for xref in range(1, doc.xref_length()) if doc.xref_get_key(xref, "Filter")[1] == "/DCTDecode"]
+    assert [doc.xref_get_key(doc.page_xref(i), "Thumb")[0] for i in range(len(doc))] == ["xref", "null"]
+    assert thumbnails == [int(doc.xref_get_key(doc.page_xref(0), "Thumb")[1].split()[0])]
+    assert pe.read_embedded_thumbnail(doc, 0).getpixel((10, 10))[2] > 180
+
+
+def test_raw_samples_thumbnail_follows_page_rotation(pdf_bytes):
+    doc = fitz.open("pdf", pdf_bytes)
+    xref = doc.get_new_xref()
+    doc.update_object(xref, "<< /Width 4 /Height 6 /ColorSpace /DeviceGray /BitsPerComponent 8 >>")
+    doc.update_stream(xref, bytes(range(24)))
+    doc.xref_set_key(doc.page_xref(0), "Thumb", f"{xref} 0 R")
+    assert pe.read_embedded_thumbnail(doc, 0).size == (4, 6)
+    # Miniatura zapisana bez obrotu jest obracana razem ze stroną
+    doc[0].set_rotation(90)
+    assert pe.read_embedded_thumbnail(doc, 0).size == (6, 4)
+
+
+def test_unsupported_thumbnail_ignored(pdf_bytes):
+    doc = fitz.open("pdf", pdf_bytes)
+    xref = doc.get_new_xref()
+    doc.update_object(xref, "<< /Width 2 /Height 2 /ColorSpace [/Indexed /DeviceRGB 1 <000000FFFFFF>] /BitsPerComponent 8 >>")
+    doc.update_stream(xref, bytes(4))
+    doc.xref_set_key(doc.page_xref(0), "Thumb", f"{xref} 0 R")
+    assert pe.read_embedded_thumbnail(doc, 0) is None
+
+
+def test_missing_thumbnails_rendered_from_saved_copy(make_viewer, pdf_bytes):
+    viewer = make_viewer(fitz.open("pdf", pdf_bytes))
+    cached = Image.new("RGB", (100, 150), "green")
+    viewer._cached_thumbnail = lambda page_index: cached if page_index == 0 else None
+    viewer.is_complex_page = lambda page_index: False
+    viewer.master = SimpleNamespace(update=lambda: None)
+    thumbnails = viewer._thumbnails_for_embedding(pdf_bytes)
+    assert thumbnails[0] is cached
+    # Brakująca miniatura renderowana w rozmiarze /Thumb, bez skalowania obrazu z cache
+    assert max(thumbnails[1].size) == pe.EMBEDDED_THUMB_MAX_SIZE
+    doc = fitz.open("pdf", pe.embed_page_thumbnails(pdf_bytes, thumbnails))
+    assert all(pe.read_embedded_thumbnail(doc, i) is not None for i in range(len(doc)))
@@ -0,0 +1,63 @@
+import os
+import sys
+
+import fitz
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+@pytest.fixture
+def doc():
+    source = fitz.open()
+    for number in range(3):
+        source.new_page().insert_text((72, 72), f"Strona {number + 1}")
+    doc = fitz.open("pdf", source.tobytes())
+    yield doc
+    doc.close()
+
+
+def digests(doc):
+    return [pe.page_content_digest(doc, page) for page in doc]
+
+
+def test_digest_stable_across_reopen_and_reorder(doc):
+    before = digests(doc)
+    assert len(set(before)) == 3
+    reopened = fitz.open("pdf", doc.tobytes())
+    assert digests(reopened) == before
+    # Przestawienie stron nie zmienia treści - skrót idzie za stroną, nie za numerem
+    doc.move_page(2, 0)
+    assert digests(doc) == [before[2], before[0], before[1]]
+
+
+def test_digest_changes_with_content_rotation_and_boxes(doc):
+    before = digests(doc)
+    doc[0].insert_text((72, 200), "Dopisek")
+    doc[1].set_rotation(90)
+    doc[2].set_cropbox(fitz.Rect(0, 0, 300, 300))
+    after = digests(doc)
+    assert all(old != new for old, new in zip(before, after))
+
+
+def test_digest_changes_with_resource_definition(doc):
+    before = digests(doc)
+    font_xref = next(xref for xref, *_ in doc[0].get_fonts())
+    doc.xref_set_key(font_xref, "BaseFont", "/Courier")
+    assert digests(doc)[0] != before[0]
+
+
+def test_thumbnail_keys_follow_pages_through_undo(make_viewer, doc):
+    viewer = make_viewer(doc, undo_backend="pages")
+    viewer._thumb_max_height = 200
+    keys = [viewer._thumbnail_key(i, 150) for i in range(3)]
+    viewer._save_state_to_undo(pages=[1])
+    doc[1].insert_text((72, 200), "Dopisek")
+    viewer._clear_thumbnail_cache(1)
+    edited = viewer._thumbnail_key(1, 150)
+    assert edited != keys[1]
+    viewer.undo()
+    # Po cofnięciu strona ma znów pierwotną treść - i ten sam klucz cache miniatury
+    assert [viewer._thumbnail_key(i, 150) for i in range(3)] == keys
@@ -0,0 +1,50 @@
+import os
+import sys
+
+import fitz
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+@pytest.fixture
+def doc():
+    doc = fitz.open()
+    doc.new_page(width=595, height=842)  # A4
+    doc.new_page(width=842, height=595)  # A4 poziomo
+    doc.new_page(width=595, height=709)  # 210 x 250 mm
+    yield doc
+    doc.close()
+
+
+def test_index_built_from_document(doc):
+    index = pe.PageMetadataIndex()
+    index.sync(doc)
+    assert len(index) == 3
+    assert [index.size_label(i) for i in range(3)] == ["A4", "A4 (Poziom)", "210 x 250 mm"]
+    assert index.size_mm(0) == (210, 297)
+    assert index.is_landscape(1) and index.is_portrait(2)
+    assert index.max_aspect() == pytest.approx(842 / 595)
+
+
+def test_structure_changes_matched_by_xref(doc):
+    index = pe.PageMetadataIndex()
+    index.sync(doc)
+    doc.move_page(2, 0)
+    doc.delete_page(2)
+    doc.new_page(width=420, height=595)  # A5
+    index.mark_dirty()
+    index.sync(doc)
+    assert list(index.xrefs) == [doc.page_xref(i) for i in range(len(doc))]
+    assert [index.size_label(i) for i in range(3)] == ["210 x 250 mm", "A4", "A5"]
+
+
+def test_rotation_updated_per_page(doc):
+    index = pe.PageMetadataIndex()
+    index.sync(doc)
+    doc[0].set_rotation(90)
+    index.update_page(doc, 0)
+    assert index.rotation(0) == 90
+    assert index.size(0) == (842, 595) and index.size_label(0) == "A4 (Poziom)"
@@ -0,0 +1,98 @@
+import os
+import sys
+
+import fitz
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+@pytest.fixture
+def page():
+    doc = fitz.open()
+    page = doc.new_page(width=200, height=300)
+    page.draw_rect(fitz.Rect(0, 0, 100, 300), color=None, fill=(1, 0, 0))
+    yield page
+    doc.close()
+
+
+@pytest.mark.parametrize("colorspace, alpha, mode", [
+    (fitz.csRGB, False, "RGB"),
+    (fitz.csRGB, True, "RGBA"),
+    (fitz.csGRAY, False, "L"),
+    (fitz.csCMYK, False, "CMYK"),
+])
+def test_pixmap_to_image_modes(page, colorspace, alpha, mode):
+    pix = page.get_pixmap(colorspace=colorspace, alpha=alpha)
+    image = pe.pixmap_to_image(pix)
+    assert image.mode == mode and image.size == (pix.width, pix.height)
+    assert image.tobytes() == pix.samples
+
+
+def test_pixmap_to_image_pixels_match_pixmap(page):
+    pix = page.get_pixmap(matrix=fitz.Matrix(0.5, 0.5))
+    assert pe.pixmap_to_image(pix, copy=False).getpixel((10, 10)) == pix.pixel(10, 10)
+    assert pe.pixmap_to_image(pix).getpixel((90, 10)) == (255, 255, 255)
+
+
+def test_displaylist_cache_parses_page_once(page):
+    doc = page.parent
+    doc.new_page().insert_text((72, 72), "Druga")
+    cache = pe.DisplayListCache(max_bytes=10 * 1024 * 1024)
+    first = cache.get("strona 1", doc, 0)
+    assert cache.get("strona 1", doc, 0) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert pe.displaylist_text(cache.get("strona 2", doc, 1)).strip() == "Druga"
+    # Render z DisplayList daje to samo co render strony
+    assert pe.render_page_thumbnail(first, 50).tobytes() == pe.render_page_thumbnail(doc[0], 50).tobytes()
+
+
+def test_displaylist_cache_evicts_over_budget(page):
+    doc = page.parent
+    doc.new_page()
+    cache = pe.DisplayListCache(max_bytes=1)
+    cache.get("strona 1", doc, 0)
+    cache.get("strona 2", doc, 1)
+    # Najnowszy wpis zostaje zawsze, nawet ponad budżet
+    assert len(cache) == 1
+    cache.get("strona 2", doc, 1)
+    assert cache.hits == 1
+
+
+def gray_levels(image):
+    return len([count for count in image.convert("L").histogram() if count])
+
+
+def test_aa_level_applies_only_inside_render(page):
+    page.draw_circle((150, 150), 40, color=(0, 0, 0), width=3)
+    before = fitz.TOOLS.show_aa_level()
+    with pe.aa_level_rendering(0):
+        assert fitz.TOOLS.show_aa_level()["graphics"] == 0
+        sharp = pe.render_page_thumbnail(page, 200)
+    assert fitz.TOOLS.show_aa_level() == before
+    with pe.full_quality_rendering():
+        smooth = pe.render_page_thumbnail(page, 200)
+    # Bez antyaliasingu krawędzie mają tylko kilka odcieni
+    assert gray_levels(sharp) < gray_levels(smooth)
+
+
+def test_set_quality_does_not_change_global_aa_level():
+    before = fitz.TOOLS.show_aa_level()
+    renderer = pe.ThumbnailRenderer(None, lambda *args: None)
+    assert renderer.set_quality(aa_level=2, annots=False)
+    assert fitz.TOOLS.show_aa_level() == before
+    assert renderer._quality_tag() == "aa2-noannots"
+    assert not renderer.set_quality(aa_level=2, annots=False)
+
+
+def test_page_profile_counts_content(page):
+    page.insert_text((20, 40), "Tekst", fontname="helv")
+    page.insert_image(fitz.Rect(100, 100, 150, 150), pixmap=fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 30, 20), False))
+    profile = pe.page_profile(page.parent, page)
+    assert profile["rysunki"] >= 1 and profile["fonty"] == 1
+    assert profile["obrazy"] == 1 and profile["największy obraz"] == "30x20"
+    assert profile["bajty treści"] == len(page.read_contents())
+    counts = pe.count_content_operators(page.parent, page)
+    assert counts["tekst"] == 1 and counts["xobiekty"] == 1
@@ -0,0 +1,113 @@
+import os
+import sys
+
+import fitz
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+@pytest.fixture
+def source_path(tmp_path):
+    doc = fitz.open()
+    for number in range(3):
+        doc.new_page().insert_text((72, 72), f"Strona {number + 1}")
+    path = str(tmp_path / "zrodlo.pdf")
+    doc.save(path)
+    return path
+
+
+def page_texts(doc):
+    return [page.get_text().strip() for page in doc]
+
+
+def record_session(tmp_path, source_path):
+    """Sesja z usunięciem strony, edycją w miejscu i wstawieniem nowej strony; zwraca (ścieżka dziennika, teksty stron)."""
+    doc = fitz.open(source_path)
+    journal = pe.SessionJournal.start(str(tmp_path / "dziennik"), source_path, doc)
+    doc.delete_page(1)
+    journal.record(doc, "usuń")
+    doc[0].insert_text((72, 200), "Dopisek")
+    journal.record(doc, "tekst", changed_xrefs=[doc.page_xref(0)])
+    extra = fitz.open()
+    extra.new_page().insert_text((72, 72), "Nowa")
+    doc.insert_pdf(extra, start_at=1)
+    doc[2].set_rotation(90)
+    journal.record(doc, "wstaw")
+    assert journal.flush()
+    journal.close(remove=False)
+    texts = page_texts(doc)
+    doc.close()
+    return journal.path, texts
+
+
+def replayed_texts(source_path, header, records):
+    doc = fitz.open(source_path)
+    pe.SessionJournal.replay(doc, header, records)
+    texts, rotations = page_texts(doc), [page.rotation for page in doc]
+    doc.close()
+    return texts, rotations
+
+
+def test_session_replayed_from_journal(tmp_path, source_path):
+    path, texts = record_session(tmp_path, source_path)
+    header, records = pe.SessionJournal.read(path)
+    assert [meta["op"] for meta, _ in records] == ["usuń", "tekst", "wstaw"]
+    assert pe.SessionJournal.source_matches(header)
+    # Rekordy zawierają tylko strony, których dziennik jeszcze nie znał
+    assert [len(meta["pages"]) for meta, _ in records] == [0, 1, 1]
+    assert replayed_texts(source_path, header, records) == (texts, [0, 0, 90])
+
+
+def test_record_with_crc_mismatch_ends_recovery(tmp_path, source_path):
+    path, _ = record_session(tmp_path, source_path)
+    header, records = pe.SessionJournal.read(path)
+    with open(path, "r+b") as journal_file:
+        # Uszkodzony bajt w danych ostatniego rekordu
+        journal_file.seek(-10, os.SEEK_END)
+        byte = journal_file.read(1)
+        journal_file.seek(-10, os.SEEK_END)
+        journal_file.write(bytes([byte[0] ^ 0xFF]))
+    header, damaged = pe.SessionJournal.read(path)
+    assert [meta["op"] for meta, _ in damaged] == ["usuń", "tekst"]
+    texts, _ = replayed_texts(source_path, header, damaged)
+    assert texts == ["Strona 1\nDopisek", "Strona 3"]
+
+
+def test_torn_last_record_skipped(tmp_path, source_path):
+    path, _ = record_session(tmp_path, source_path)
+    with open(path, "r+b") as journal_file:
+        journal_file.truncate(os.path.getsize(path) - 5)
+    _, records = pe.SessionJournal.read(path)
+    assert [meta["op"] for meta, _ in records] == ["usuń", "tekst"]
+
+
+def test_journal_removed_on_clean_close(tmp_path, source_path):
+    doc = fitz.open(source_path)
+    journal = pe.SessionJournal.start(str(tmp_path / "dziennik"), source_path, doc)
+    doc.delete_page(0)
+    journal.record(doc, "usuń")
+    journal.close()
+    doc.close()
+    assert not os.path.exists(journal.path)
+    assert pe.SessionJournal.find_orphans(str(tmp_path / "dziennik")) == []
+
+
+def test_new_document_object_recorded_from_base(tmp_path, source_path):
+    doc = fitz.open(source_path)
+    journal = pe.SessionJournal.start(str(tmp_path / "dziennik"), source_path, doc)
+    # Nowy obiekt dokumentu (np. po operacji przez pypdf) - numery xref tracą znaczenie
+    data = fitz.open(source_path).tobytes(garbage=0)
+    doc = fitz.open("pdf", data)
+    base_pages = [(doc.page_xref(i), 0) for i in range(len(doc))]
+    doc[1].insert_text((72, 200), "Dopisek")
+    journal.record(doc, "nowy dokument", changed_xrefs=[doc.page_xref(1)], reset=True, base=(data, base_pages))
+    assert journal.flush()
+    journal.close(remove=False)
+    header, records = pe.SessionJournal.read(journal.path)
+    # Pełny stan bazy, potem tylko zmieniona strona
+    assert [len(payload) == len(data) for _, payload in records] == [True, False]
+    assert [len(meta["pages"]) for meta, _ in records] == [3, 1]
+    assert replayed_texts(source_path, header, records)[0] == page_texts(doc)
@@ -0,0 +1,52 @@
+import os
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+def image(size=10):
+    return Image.new("RGB", (size, size), "white")
+
+
+def test_least_recently_used_evicted_over_budget():
+    cache = pe.ThumbnailCache(max_bytes=3 * 300)
+    for key in "abc":
+        cache.put(key, image())
+    assert cache.get("a") is not None  # "a" ostatnio używany - wyrzucony będzie "b"
+    cache.put("d", image())
+    assert "b" not in cache and len(cache) == 3
+    assert cache.current_bytes == 900 and cache.evictions == 1
+    cache.discard_where(lambda key: key in ("a", "c"))
+    assert len(cache) == 1 and cache.current_bytes == 300
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 0
+
+
+def test_disk_cache_round_trip_and_prune(tmp_path):
+    directory = str(tmp_path / "cache")
+    cache = pe.ThumbnailDiskCache(directory, max_bytes=1024 * 1024)
+    key = pe.ThumbnailDiskCache.make_key("plik.pdf", "skrot", 150, 200)
+    assert key != pe.ThumbnailDiskCache.make_key("plik.pdf", "skrot", 150, None)
+    assert cache.get(key) is None
+    cache.put(key, Image.new("RGB", (20, 30), (10, 200, 30)))
+    restored = cache.get(key)
+    assert restored.size == (20, 30) and restored.getpixel((5, 5)) == (10, 200, 30)
+
+    # Po przekroczeniu limitu usuwane są tylko pliki miniatur, nie inne pliki katalogu cache
+    with open(os.path.join(directory, "complex_pages.log"), "w", encoding="utf-8") as log_file:
+        log_file.write("log\n")
+    cache.max_bytes = 1
+    cache.put(pe.ThumbnailDiskCache.make_key("plik.pdf", "inny", 150, 200), image(40))
+    assert cache.get(key) is None
+    assert os.path.exists(os.path.join(directory, "complex_pages.log"))
+
+
+def test_disabled_disk_cache(tmp_path):
+    cache = pe.ThumbnailDiskCache(str(tmp_path / "cache"), max_bytes=0)
+    cache.put("klucz", image())
+    assert not cache.enabled and cache.get("klucz") is None
+    assert not os.path.exists(tmp_path / "cache")
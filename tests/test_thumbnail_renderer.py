@@ -0,0 +1,179 @@
+import os
+import sys
+import time
+
+import fitz
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+class FakeMaster:
+    """Zamiast pętli Tk: after() tylko zapamiętuje wywołania, run() wykonuje je po kolei."""
+
+    def __init__(self):
+        self.callbacks = []
+
+    def after(self, delay_ms, callback, *args):
+        self.callbacks.append(callback)
+        return len(self.callbacks)
+
+    def after_cancel(self, callback_id):
+        pass
+
+    def run(self, until, timeout=20.0):
+        deadline = time.perf_counter() + timeout
+        while not until() and time.perf_counter() < deadline:
+            if self.callbacks:
+                self.callbacks.pop(0)()
+            time.sleep(0.01)
+
+
+@pytest.fixture
+def pdf_bytes():
+    doc = fitz.open()
+    for number in range(6):
+        page = doc.new_page(width=200, height=300)
+        page.insert_text((20, 40), f"Strona {number + 1}")
+    return doc.tobytes()
+
+
+def render_all(pdf_bytes, pages, **options):
+    master = FakeMaster()
+    results = {}
+    renderer = pe.ThumbnailRenderer(master, lambda key, page_index, image, final: results.update({key: image}),
+                                     **options)
+    try:
+        renderer.set_source(data=pdf_bytes)
+        for page_index in pages:
+            renderer.request(("strona", page_index), page_index, 100)
+        master.run(lambda: len(results) == len(pages))
+    finally:
+        renderer.shutdown()
+    return results
+
+
+def test_thread_pool_renders_requested_pages(pdf_bytes):
+    results = render_all(pdf_bytes, range(6), max_workers=3)
+    assert sorted(results) == [("strona", i) for i in range(6)]
+    assert all(image.size == (100, 150) for image in results.values())
+
+
+def test_results_of_old_source_discarded(pdf_bytes):
+    master = FakeMaster()
+    results = []
+    renderer = pe.ThumbnailRenderer(master, lambda key, page_index, image, final: results.append(key), max_workers=1)
+    try:
+        renderer.set_source(data=pdf_bytes)
+        renderer.request("stary", 0, 100)
+        # Nowe źródło przed odebraniem wyników - zlecenia starej generacji nie wracają
+        renderer.set_source(data=pdf_bytes)
+        renderer.request("nowy", 1, 100)
+        master.run(lambda: "nowy" in results)
+    finally:
+        renderer.shutdown()
+    assert results == ["nowy"]
+
+
+def test_each_worker_renders_from_its_own_document(pdf_bytes):
+    master = FakeMaster()
+    results = []
+    opened = []
+    renderer = pe.ThumbnailRenderer(master, lambda key, page_index, image, final: results.append(key), max_workers=3)
+    get_document = renderer._get_document
+
+    def recording_get_document(job):
+        doc, index = get_document(job)
+        opened.append((pe.threading.get_ident(), doc))
+        time.sleep(0.05)  # Żeby zlecenia rozeszły się po wszystkich wątkach
+        return doc, index
+
+    renderer._get_document = recording_get_document
+    try:
+        renderer.set_source(data=pdf_bytes)
+        for page_index in range(6):
+            renderer.request(page_index, page_index, 100)
+        master.run(lambda: len(results) == 6)
+    finally:
+        renderer.shutdown()
+    documents = {}
+    for thread_id, doc in opened:
+        documents.setdefault(id(doc), set()).add(thread_id)
+    assert len(documents) > 1
+    assert all(len(threads) == 1 for threads in documents.values())
+
+
+def test_process_backend_matches_thread_backend(pdf_bytes):
+    threaded = render_all(pdf_bytes, [0, 3])
+    isolated = render_all(pdf_bytes, [0, 3], backend="processes")
+    assert all(isolated[key].tobytes() == threaded[key].tobytes() for key in threaded)
+
+
+
+@pytest.fixture
+def heavy_pdf_bytes():
+    """Strona 0 z treścią ponad COMPLEX_CONTENT_BYTES (render trwa sekundy), strona 1 lekka."""
+    doc = fitz.open()
+    doc.new_page(width=200, height=300)
+    doc.new_page(width=200, height=300).insert_text((20, 40), "Lekka")
+    lines = b"".join(b"%d %d m %d %d l S\n" % (i % 200, i % 300, (i * 7) % 200, (i * 3) % 300) for i in range(120000))
+    xref = doc.get_new_xref()
+    doc.update_object(xref, "<<>>")
+    doc.update_stream(xref, lines)
+    doc.xref_set_key(doc.page_xref(0), "Contents", f"{xref} 0 R")
+    return doc.tobytes()
+
+
+@pytest.fixture
+def shared_source():
+    blocks = []
+
+    def share(data):
+        block = pe.shared_memory.SharedMemory(create=True, size=len(data))
+        block.buf[:len(data)] = data
+        blocks.append(block)
+        return block.name, len(data)
+
+    yield share
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def test_render_process_replaced_after_timeout(heavy_pdf_bytes, shared_source):
+    process = pe.RenderProcess()
+    try:
+        assert process.open(1, None, *shared_source(heavy_pdf_bytes), None)
+        first_pid = process.process.pid
+        # Przekroczony limit zatrzymuje proces; następne polecenie uruchamia nowy
+        assert process.render(0, 100, None, timeout=0.2) is None and not process.is_running()
+        assert process.open(1, None, *shared_source(heavy_pdf_bytes), None)
+        image, _ = process.render(1, 100, None)
+        assert image.size == (100, 150) and process.process.pid != first_pid
+    finally:
+        process.close()
+
+
+def test_heavy_page_over_budget_reported_and_logged(heavy_pdf_bytes, tmp_path, monkeypatch):
+    monkeypatch.setattr(pe, "COMPLEX_PAGES_LOG", str(tmp_path / "cache" / "complex_pages.log"))
+    master = FakeMaster()
+    results, timeouts = {}, []
+    renderer = pe.ThumbnailRenderer(master, lambda key, page_index, image, final: results.update({key: image}),
+                                    max_workers=1, time_budget_ms=200,
+                                    on_timeout=lambda key, page_index, elapsed: timeouts.append(key))
+    try:
+        renderer.set_source(data=heavy_pdf_bytes)
+        renderer.request("ciężka", 0, 100)
+        renderer.request("lekka", 1, 100)
+        master.run(lambda: timeouts and "lekka" in results)
+        # Ten sam proces roboczy wątku - po zabiciu na limicie uruchomiony od nowa
+        assert len(renderer._processes) == 1
+        counts = renderer.render_isolated(1, 100)[2]
+    finally:
+        renderer.shutdown()
+    assert timeouts == ["ciężka"] and "ciężka" not in results
+    assert counts["tekst"] > 0
+    with open(tmp_path / "cache" / "complex_pages.log", encoding="utf-8") as log_file:
+        assert "strona 1\tprzerwano po" in log_file.read()
@@ -0,0 +1,107 @@
+import os
+import sys
+
+import fitz
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+@pytest.fixture
+def store():
+    store = pe.UndoBlobStore()
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def doc():
+    source = fitz.open()
+    for number in range(3):
+        source.new_page().insert_text((72, 72), f"Strona {number + 1}")
+    source[0].insert_link({"kind": fitz.LINK_GOTO, "from": fitz.Rect(72, 100, 200, 120), "page": 1})
+    source.set_toc([[1, "Druga", 2]])
+    doc = fitz.open("pdf", source.tobytes())
+    yield doc
+    doc.close()
+
+
+def page_texts(doc):
+    return [page.get_text().strip() for page in doc]
+
+
+def test_in_place_page_restored_in_same_page_object(doc, store):
+    xrefs = [doc.page_xref(i) for i in range(len(doc))]
+    step = pe.UndoStep.capture(doc, store, [1])
+    doc[1].insert_text((72, 300), "Numer strony", fontname="Courier")
+
+    doc, redo_step, changed, renumbered = step.apply(doc, store)
+    assert changed == [1] and renumbered == {}
+    assert [doc.page_xref(i) for i in range(len(doc))] == xrefs
+    assert page_texts(doc) == ["Strona 1", "Strona 2", "Strona 3"]
+    # Zakładka i odnośnik wskazują wciąż tę samą stronę
+    assert doc.get_toc() == [[1, "Druga", 2]]
+    assert doc[0].get_links()[0]["page"] == 1
+
+    doc, step, changed, _ = redo_step.apply(doc, store)
+    assert changed == [1]
+    assert page_texts(doc)[1] == "Strona 2\nNumer strony"
+
+
+def test_undo_redo_cycles_do_not_add_objects(doc, store):
+    step = pe.UndoStep.capture(doc, store, [1])
+    doc[1].insert_text((72, 300), "Numer strony", fontname="Courier")
+    doc, step, _, _ = step.apply(doc, store)
+    xref_length = doc.xref_length()
+    for _ in range(4):
+        doc, step, _, _ = step.apply(doc, store)
+        doc, step, _, _ = step.apply(doc, store)
+    assert doc.xref_length() == xref_length
+    assert page_texts(doc)[1] == "Strona 2"
+
+
+def test_deleted_page_restored_from_copy(doc, store):
+    step = pe.UndoStep.capture(doc, store, [1])
+    deleted_xref = doc.page_xref(1)
+    doc.delete_page(1)
+
+    doc, redo_step, changed, renumbered = step.apply(doc, store)
+    assert changed == []
+    assert list(renumbered) == [deleted_xref]
+    assert doc.page_xref(1) == renumbered[deleted_xref]
+    assert page_texts(doc) == ["Strona 1", "Strona 2", "Strona 3"]
+
+    doc, _, _, _ = redo_step.apply(doc, store)
+    assert page_texts(doc) == ["Strona 1", "Strona 3"]
+
+
+def test_history_round_trip_through_viewer(make_viewer, doc):
+    viewer = make_viewer(doc, undo_backend="pages")
+    states = [(page_texts(doc), [page.rotation for page in doc])]
+
+    def record():
+        document = viewer.pdf_document
+        states.append((page_texts(document), [page.rotation for page in document]))
+
+    viewer._save_state_to_undo(pages=[1])
+    doc.delete_page(1)
+    record()
+    viewer._save_state_to_undo(pages=())
+    extra = fitz.open()
+    extra.new_page().insert_text((72, 72), "Nowa")
+    doc.insert_pdf(extra, start_at=0)
+    record()
+    viewer._save_state_to_undo(pages=[2])
+    doc[2].insert_text((72, 300), "Dopisek")
+    doc[2].set_rotation(180)
+    record()
+
+    for expected in reversed(states[:-1]):
+        viewer.undo()
+        assert (page_texts(viewer.pdf_document), [page.rotation for page in viewer.pdf_document]) == expected
+    for expected in states[1:]:
+        viewer.redo()
+        assert (page_texts(viewer.pdf_document), [page.rotation for page in viewer.pdf_document]) == expected
+    assert viewer.redo_stack == [] and len(viewer.undo_stack) == 3
@@ -0,0 +1,134 @@
+import os
+import sys
+
+import fitz
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+@pytest.fixture
+def viewer(make_viewer):
+    doc = fitz.open()
+    for number in range(3):
+        doc.new_page().insert_text((72, 72), f"Strona {number + 1}")
+    viewer = make_viewer(fitz.open("pdf", doc.tobytes()))
+    yield viewer
+    viewer.pdf_document.close()
+
+
+def rotate_first_page(viewer):
+    viewer.selected_pages = {0}
+    viewer.rotate_selected_page(90)
+    assert isinstance(viewer.undo_stack[-1], pe.JournalStep)
+    assert viewer.pdf_document[0].rotation == 90
+
+
+def test_text_of_rotated_page_after_journalled_rotate(viewer):
+    rotate_first_page(viewer)
+    # Cofnij/ponów zamyka operację dziennika - dokument zostaje z dziennikiem bez otwartej operacji
+    viewer.undo()
+    viewer.redo()
+    assert viewer.pdf_document.journal_is_enabled() and viewer._journal_op is None
+
+    viewer._prepare_direct_access()
+    page = viewer.pdf_document[0]
+    assert "Strona 1" in page.get_text()
+    assert page.search_for("Strona 1")
+    assert page.rotation == 90
+
+    # Historia przetrwała zakończenie dziennika
+    viewer.undo()
+    assert viewer.pdf_document[0].rotation == 0
+    viewer.redo()
+    assert viewer.pdf_document[0].rotation == 90
+
+
+def test_text_inside_open_journal_operation(viewer):
+    rotate_first_page(viewer)
+    viewer._prepare_direct_access()
+    # Operacja obrotu jest jeszcze otwarta - dziennik zostaje, odczyt trafia do tej operacji
+    assert viewer.pdf_document.journal_is_enabled()
+    assert "Strona 1" in viewer.pdf_document[0].get_text()
+    viewer.undo()
+    assert viewer.pdf_document[0].rotation == 0
+
+
+def test_remove_empty_pages_after_journalled_rotate(viewer, monkeypatch):
+    # Strona bez tekstu, ale z rysunkiem - skanowanie sięga po get_drawings()
+    doc = viewer.pdf_document
+    doc.new_page().draw_rect(fitz.Rect(72, 72, 144, 144), color=(0, 0, 0), fill=(1, 0, 0))
+    doc.new_page()
+    viewer.selected_pages = {3}
+    viewer.rotate_selected_page(90)
+    viewer.undo()
+    viewer.redo()
+    assert doc[3].rotation == 90 and viewer._journal_op is None
+    errors = []
+    monkeypatch.setattr(pe, "custom_messagebox",
+                        lambda master, title, message, typ="info": errors.append(message) if typ == "error" else True)
+    viewer.get_page_displaylist = lambda page_index: viewer.pdf_document[page_index].get_displaylist()
+    viewer.remove_empty_pages()
+    assert errors == []
+    assert len(viewer.pdf_document) == 4
+    assert viewer.pdf_document[3].rotation == 90
+
+
+def insert_copy_of_first_page(viewer):
+    """Operacja strukturalna - insert_pdf przy włączonym dzienniku zgłosiłby błąd."""
+    viewer._save_state_to_undo(pages=())
+    source = fitz.open()
+    source.new_page().insert_text((72, 72), "Kopia")
+    viewer.pdf_document.insert_pdf(source)
+    source.close()
+
+
+def test_structural_operation_after_journalled_rotate_keeps_document(viewer):
+    doc = viewer.pdf_document
+    rotate_first_page(viewer)
+    insert_copy_of_first_page(viewer)
+    # Dziennik odpięty bez zapisu i ponownego otwierania dokumentu
+    assert viewer.pdf_document is doc
+    assert not doc.journal_is_enabled()
+    assert len(doc) == 4 and doc[0].rotation == 90
+    assert [type(step) for step in viewer.undo_stack] == [pe.UndoStep, pe.UndoStep]
+
+    viewer.undo()
+    assert len(viewer.pdf_document) == 3 and viewer.pdf_document[0].rotation == 90
+    viewer.undo()
+    assert viewer.pdf_document[0].rotation == 0
+    viewer.redo()
+    viewer.redo()
+    assert len(viewer.pdf_document) == 4
+    assert [page.rotation for page in viewer.pdf_document] == [90, 0, 0, 0]
+
+
+def test_journalled_redo_step_converted_at_session_end(viewer):
+    rotate_first_page(viewer)
+    viewer.undo()
+    assert isinstance(viewer.redo_stack[-1], pe.JournalStep)
+    # Odczyt poza operacją kończy dziennik - krok ponawiania zostaje, już jako stronowy
+    viewer._prepare_direct_access()
+    assert not viewer.pdf_document.journal_is_enabled()
+    assert viewer.undo_stack == []
+    assert isinstance(viewer.redo_stack[-1], pe.UndoStep)
+    viewer.redo()
+    assert viewer.pdf_document[0].rotation == 90
+    viewer.undo()
+    assert viewer.pdf_document[0].rotation == 0
+
+
+def test_journal_enabled_again_after_structural_operation(viewer):
+    rotate_first_page(viewer)
+    insert_copy_of_first_page(viewer)
+    viewer.rotate_selected_page(90)
+    assert isinstance(viewer.undo_stack[-1], pe.JournalStep)
+    assert viewer.pdf_document.journal_is_enabled()
+    assert viewer.pdf_document[0].rotation == 180
+    viewer.undo()
+    assert viewer.pdf_document[0].rotation == 90
+    viewer.undo()
+    viewer.undo()
+    assert len(viewer.pdf_document) == 3 and viewer.pdf_document[0].rotation == 0
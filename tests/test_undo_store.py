@@ -0,0 +1,80 @@
+import gc
+import os
+import sys
+
+import fitz
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PDFEditor as pe
+
+
+@pytest.fixture
+def store():
+    store = pe.UndoBlobStore()
+    yield store
+    store.close()
+
+
+def test_same_content_stored_once(store):
+    first = store.put(b"strumien" * 10)
+    assert store.put(b"strumien" * 10) is first
+    text = store.put("<< /Type /Page >>")
+    assert text.data == "<< /Type /Page >>"
+    assert store.nbytes == 80 + len("<< /Type /Page >>")
+
+
+def test_blob_released_with_last_step(store):
+    blob = store.put(b"dane kroku")
+    assert store.nbytes == len(b"dane kroku")
+    del blob
+    gc.collect()
+    assert store.nbytes == 0
+
+
+def test_old_blobs_compressed_and_spilled_round_trip(store):
+    data = b"0 0 m 100 100 l S\n" * 500
+    text = "<< /Length 9000 >>" + " " * 2000
+    blob, text_blob = store.put(data), store.put(text)
+    store._generation += 2  # Dwie kolejne migawki - bloki należą już do starszego stanu
+    store._compress_old_blobs()
+    assert blob.state[0] == text_blob.state[0] == "zlib"
+    assert blob.memory_bytes < len(data)
+    assert blob.data == data and text_blob.data == text
+
+    store.budget_bytes = 0
+    store._spill_over_budget()
+    assert blob.state[0] == "file" and blob.memory_bytes == 0
+    assert blob.data == data and text_blob.data == text
+    stats = store.stats()
+    assert stats["file_count"] == 2 and stats["disk_bytes"] > 0
+
+
+def test_incompressible_blob_stays_raw(store):
+    noise = os.urandom(4096)
+    blob = store.put(noise)
+    store._generation += 2
+    store._compress_old_blobs()
+    assert blob.state[0] == "raw" and blob.incompressible
+
+
+def test_snapshot_captured_in_background(store):
+    source = fitz.open()
+    for number in range(3):
+        source.new_page().insert_text((72, 72), f"Strona {number + 1}")
+    doc = fitz.open("pdf", source.tobytes())
+    xrefs = [doc.page_xref(i) for i in range(len(doc))]
+    snapshot = pe.DocumentSnapshot.capture_async(doc.tobytes(), store)
+    doc.delete_pages([0, 1])
+    snapshot.wait()
+    assert snapshot.ready and snapshot.error is None
+    # Dokument z migawki ma te same numery obiektów co dokument w chwili zapisu
+    restored = snapshot.open()
+    assert [restored.page_xref(i) for i in range(len(restored))] == xrefs
+    assert [page.get_text().strip() for page in restored] == ["Strona 1", "Strona 2", "Strona 3"]
+    # Kolejna migawka tego samego dokumentu dzieli z poprzednią niezmienione obiekty
+    before = store.nbytes
+    second = pe.DocumentSnapshot.capture_async(restored.tobytes(), store)
+    second.wait()
+    assert store.nbytes == before